@@ -8,7 +8,7 @@ just an attempt to display the workings of the minimax algorithm with
 alpha-beta pruning in Python.
 """
 
-from chess.lib.core import legalMoves, makeMove
+from chess.lib.core import legalMoves, doMove, undoMove
 from chess.lib.heuristics import *
 
 INF = 1000000
@@ -50,6 +50,8 @@ def evaluate(board):
     return score
 
 # This is the Mini-Max algorithm, implemented with alpha-beta pruning.
+# The moves are made and taken back on the board itself, which is left as it
+# was when the function returns.
 def miniMax(side, board, flags, depth=DEPTH, alpha=-INF, beta=INF):
     if depth == 0:
         return evaluate(board)
@@ -57,8 +59,9 @@ def miniMax(side, board, flags, depth=DEPTH, alpha=-INF, beta=INF):
     if not side:
         bestVal = -INF
         for fro, to in legalMoves(side, board, flags):
-            movedata = makeMove(side, board, fro, to, flags)
-            nodeVal = miniMax(*movedata, depth - 1, alpha, beta)
+            newflags, undo = doMove(side, board, fro, to, flags)
+            nodeVal = miniMax(not side, board, newflags, depth - 1, alpha, beta)
+            undoMove(board, undo)
             if nodeVal > bestVal:
                 bestVal = nodeVal
                 if depth == DEPTH:
@@ -70,8 +73,9 @@ def miniMax(side, board, flags, depth=DEPTH, alpha=-INF, beta=INF):
     else:
         bestVal = INF
         for fro, to in legalMoves(side, board, flags):
-            movedata = makeMove(side, board, fro, to, flags)
-            nodeVal = miniMax(*movedata, depth - 1, alpha, beta)
+            newflags, undo = doMove(side, board, fro, to, flags)
+            nodeVal = miniMax(not side, board, newflags, depth - 1, alpha, beta)
+            undoMove(board, undo)
             if nodeVal < bestVal:
                 bestVal = nodeVal
                 if depth == DEPTH:
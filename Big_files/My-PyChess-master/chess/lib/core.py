@@ -3,41 +3,137 @@ This file is a part of My-PyChess application.
 In this file, we define the core chess-related functions.
 For a better understanding of the variables used here, checkout docs.txt
 """
+# The steps of the knight and the king, and the lines a rook and a bishop
+# slide along, as [dx, dy] pairs.
+KNIGHT = ((1, 2), (1, -2), (-1, 2), (-1, -2), (2, 1), (2, -1), (-2, 1), (-2, -1))
+KING = ((-1, -1), (0, -1), (1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0))
+STRAIGHT = ((1, 0), (-1, 0), (0, 1), (0, -1))
+DIAGONAL = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+# The index of a square in the square list of a board, squares off the board
+# have no index. The square [x, y] has index (y - 1) * 8 + (x - 1). A piece
+# can be given for the square it is on.
+def sqIndex(pos):
+    x, y = pos[0], pos[1]
+    if 0 < x < 9 and 0 < y < 9:
+        return y * 8 + x - 9
+
+# Builds the square list of a board from its piece lists, and puts it as the
+# third element of the board. Every square has either None or a (side, piece)
+# pair, where piece is the same list object as the one in board[side], so the
+# pieces on the squares can be found without going through the piece lists.
+def indexBoard(board):
+    squares = [None] * 64
+    for side in range(2):
+        for piece in board[side]:
+            squares[sqIndex(piece[:2])] = (side, piece)
+    board[2:] = [squares]
+    return board
+
+# Returns the (side, piece) pair on a square, None if empty or off the board.
+def getSquare(board, pos):
+    i = sqIndex(pos)
+    if i is not None:
+        return board[2][i]
+
 # A simple function to make a copy of the board
 def copy(board):
-    return [[list(j) for j in board[i]] for i in range(2)]       
+    return indexBoard([[list(j) for j in board[i]] for i in range(2)])
         
 # Return the type of piece given it's position. Return None if Empty.
 def getType(side, board, pos):
-    for piece in board[side]:
-        if piece[:2] == pos:
-            return piece[2]
+    sq = getSquare(board, pos)
+    if sq is not None and sq[0] == side:
+        return sq[1][2]
 
 # Determine wether the position given is occupied by a piece of the given side.
 def isOccupied(side, board, pos):
-    return getType(side, board, pos) is not None
+    sq = getSquare(board, pos)
+    return sq is not None and sq[0] == side
 
 # Determine wether the position(s) given is(are) empty or not
 def isEmpty(board, *poslist):
     for pos in poslist:
-        for side in range(2):
-            if isOccupied(side, board, pos):
-                return False
+        if getSquare(board, pos) is not None:
+            return False
     return True
 
-# Determine wether the king of a given side is in check or not.
-def isChecked(side, board):
+# Return the position of the king of the given side.
+def getKing(side, board):
     for piece in board[side]:
         if piece[2] == "k":
-            for i in board[not side]:
-                if piece[:2] in rawMoves(not side, board, i):
-                    return True
-            return False
+            return piece[:2]
+
+# Determine wether the position given is attacked by a piece of the given side.
+# Rather than going through the moves of all the pieces of the side, this looks
+# outwards from the position: a step away for pawns, knights and kings, and
+# along the lines for the first piece in the way.
+def isAttacked(side, board, pos):
+    squares = board[2]
+    x, y = pos
+    # White pawns capture upwards, so they attack from the row below
+    dy = -1 if side else 1
+    for dx in (-1, 1):
+        sq = getSquare(board, [x + dx, y + dy])
+        if sq is not None and sq[0] == side and sq[1][2] == "p":
+            return True
+
+    for steps, ptype in ((KNIGHT, "n"), (KING, "k")):
+        for dx, dy in steps:
+            sq = getSquare(board, [x + dx, y + dy])
+            if sq is not None and sq[0] == side and sq[1][2] == ptype:
+                return True
+
+    for lines, ptypes in ((STRAIGHT, "rq"), (DIAGONAL, "bq")):
+        for dx, dy in lines:
+            i, j = x + dx, y + dy
+            while 0 < i < 9 and 0 < j < 9:
+                sq = squares[j * 8 + i - 9]
+                if sq is not None:
+                    if sq[0] == side and sq[1][2] in ptypes:
+                        return True
+                    break
+                i, j = i + dx, j + dy
+    return False
+
+# Determine wether the king of a given side is in check or not.
+def isChecked(side, board):
+    king = getKing(side, board)
+    return king is not None and isAttacked(not side, board, king)
+
+# Return what is needed to know which moves of a side are legal, without
+# playing them: the position of its king, wether the king is in check, and
+# the pieces that are pinned to the king. The pins are a dictionary from the
+# square index of the pinned piece to the [dx, dy] line of the pin.
+def checkInfo(side, board):
+    king = getKing(side, board)
+    if king is None:
+        return None, False, {}
+
+    squares = board[2]
+    pins = {}
+    for lines, ptypes in ((STRAIGHT, "rq"), (DIAGONAL, "bq")):
+        for dx, dy in lines:
+            pinned = None
+            i, j = king[0] + dx, king[1] + dy
+            while 0 < i < 9 and 0 < j < 9:
+                sq = squares[j * 8 + i - 9]
+                if sq is not None:
+                    if sq[0] != side:
+                        if pinned is not None and sq[1][2] in ptypes:
+                            pins[pinned] = (dx, dy)
+                        break
+                    if pinned is not None:
+                        break
+                    pinned = j * 8 + i - 9
+                i, j = i + dx, j + dy
+    return king, isAttacked(not side, board, king), pins
 
 # Determine all the possible LEGAL moves available for the side.
 def legalMoves(side, board, flags):
+    info = checkInfo(side, board)
     for piece in board[side]:
-        for pos in availableMoves(side, board, piece, flags):
+        for pos in availableMoves(side, board, piece, flags, info):
             yield [piece[:2], pos]
             
 # This function returns wether a game has ended or not
@@ -47,40 +143,84 @@ def isEnd(side, board, flags):
     return True
 
 # This function moves the piece from one coordinate to other while handling the
-# capture of enemy, pawn promotion and en-passent. 
-# One thing to note that this function directly modifies global value of the
-# board variable from within the function, so pass a copy of the board
-# variable if you do not want global modification of the variable.
-def move(side, board, fro, to, promote="p"):
+# capture of enemy, castling, pawn promotion and en-passent.
+# The move is made on the board itself, no copy is made, and the function
+# returns the updated flags (None if no flags are given) and an undo record. Passing the record to
+# undoMove() takes the move back, so that the board is the same as before,
+# down to the order of the pieces in the piece lists.
+def doMove(side, board, fro, to, flags, promote="q"):
+    squares = board[2]
     UP = 8 if side else 1
     DOWN = 1 if side else 8
-    ALLOWENP = fro[1] == 4 + side and to[0] != fro[0] and isEmpty(board, to)
-    for piece in board[not side]:
-        if piece[:2] == to:
-            board[not side].remove(piece)
-            break
+    mover = squares[sqIndex(fro)]
+    piece = mover[1]
 
-    for piece in board[side]:
-        if piece[:2] == fro:
-            piece[:2] = to
-            if piece[2] == "k":
-                if fro[0] - to[0] == 2:
-                    move(side, board, [1, DOWN], [4, DOWN])
-                elif to[0] - fro[0] == 2:
-                    move(side, board, [8, DOWN], [6, DOWN])
-                    
-            if piece[2] == "p":
-                if to[1] == UP:
-                    board[side].remove(piece)
-                    board[side].append([to[0], UP, promote])
-                if ALLOWENP:
-                    board[not side].remove([to[0], fro[1], "p"])
-            break
-    return board
+    # For en-passent, the captured pawn is not on the square moved to
+    cap = to
+    if (piece[2] == "p" and fro[1] == 4 + side and to[0] != fro[0]
+            and squares[sqIndex(to)] is None):
+        cap = [to[0], fro[1]]
+    captured = squares[sqIndex(cap)]
+    capIndex = None
+    if captured is not None:
+        capIndex = board[not side].index(captured[1])
+        del board[not side][capIndex]
+        squares[sqIndex(cap)] = None
+
+    squares[sqIndex(fro)] = None
+    piece[:2] = to
+    squares[sqIndex(to)] = mover
+
+    rook = None
+    if piece[2] == "k" and abs(fro[0] - to[0]) == 2:
+        rfro, rto = ([1, DOWN], [4, DOWN]) if to[0] < fro[0] else ([8, DOWN], [6, DOWN])
+        rook = squares[sqIndex(rfro)]
+        squares[sqIndex(rfro)] = None
+        rook[1][:2] = rto
+        squares[sqIndex(rto)] = rook
+
+    pawnIndex = None
+    if piece[2] == "p" and to[1] == UP:
+        pawnIndex = board[side].index(piece)
+        del board[side][pawnIndex]
+        board[side].append([to[0], UP, promote])
+        squares[sqIndex(to)] = (side, board[side][-1])
+
+    undo = (side, flags, fro, mover, cap, captured, capIndex, rook, pawnIndex)
+    if flags is None:
+        return None, undo
+    return updateFlags(side, board, fro, to, flags), undo
+
+# This function takes back a move made by doMove(), given its undo record.
+# It returns the flags from before the move.
+def undoMove(board, undo):
+    side, flags, fro, mover, cap, captured, capIndex, rook, pawnIndex = undo
+    squares = board[2]
+    piece = mover[1]
+    if pawnIndex is not None:
+        board[side].pop()
+        board[side].insert(pawnIndex, piece)
+
+    if rook is not None:
+        squares[sqIndex(rook[1])] = None
+        rook[1][:2] = [1 if rook[1][0] == 4 else 8, fro[1]]
+        squares[sqIndex(rook[1])] = rook
+
+    squares[sqIndex(piece)] = None
+    piece[:2] = fro
+    squares[sqIndex(fro)] = mover
+
+    if captured is not None:
+        board[not side].insert(capIndex, captured[1])
+        squares[sqIndex(cap)] = captured
+    return flags
 
 # This function returns wether a move puts ones own king at check
 def moveTest(side, board, fro, to):
-    return not isChecked(side, move(side, copy(board), fro, to))
+    undo = doMove(side, board, fro, to, None)[1]
+    ret = not isChecked(side, board)
+    undoMove(board, undo)
+    return ret
 
 # This function returns wether a move is valid or not
 def isValidMove(side, board, flags, fro, to):
@@ -89,24 +229,24 @@ def isValidMove(side, board, flags, fro, to):
         if to in rawMoves(side, board, piece, flags):
             return moveTest(side, board, fro, to)
 
-# This is an important wrapper function. It makes the move, updates the
-# flags and flips the side, returning the updated data.
+# This is an important wrapper function. It makes the move on a copy of the
+# board, updates the flags and flips the side, returning the updated data.
 def makeMove(side, board, fro, to, flags, promote="q"):
-    newboard = move(side, copy(board), fro, to, promote)
-    newflags = updateFlags(side, newboard, fro, to, flags)
+    newboard = copy(board)
+    newflags = doMove(side, newboard, fro, to, flags, promote)[0]
     return not side, newboard, newflags
 
 # Does a routine check to update all the flags required for castling and
 # enpassent. This function needs to be called AFTER every move played.
 def updateFlags(side, board, fro, to, flags):
     castle = list(flags[0])
-    if [5, 8, "k"] not in board[0] or [1, 8, "r"] not in board[0]:
+    if getType(0, board, [5, 8]) != "k" or getType(0, board, [1, 8]) != "r":
         castle[0] = False
-    if [5, 8, "k"] not in board[0] or [8, 8, "r"] not in board[0]:
+    if getType(0, board, [5, 8]) != "k" or getType(0, board, [8, 8]) != "r":
         castle[1] = False
-    if [5, 1, "k"] not in board[1] or [1, 1, "r"] not in board[1]:
+    if getType(1, board, [5, 1]) != "k" or getType(1, board, [1, 1]) != "r":
         castle[2] = False
-    if [5, 1, "k"] not in board[1] or [8, 1, "r"] not in board[1]:
+    if getType(1, board, [5, 1]) != "k" or getType(1, board, [8, 1]) != "r":
         castle[3] = False
 
     enP = None
@@ -120,12 +260,33 @@ def updateFlags(side, board, fro, to, flags):
 
 # Given a side, board and piece, it yields all possible legal moves
 # of that piece. This function is an extension/wrapper on rawMoves() 
-def availableMoves(side, board, piece, flags):
+# Only the moves that may leave the king in check are played to test them:
+# those of the king, en-passent, and all moves when in check. Other moves are
+# legal, unless the piece is pinned and leaves the line of the pin. info is
+# from checkInfo(), and is found if not given.
+def availableMoves(side, board, piece, flags, info=None):
+    king, checked, pins = checkInfo(side, board) if info is None else info
+    pin = pins.get(sqIndex(piece))
     for i in rawMoves(side, board, piece, flags):
         if 0 < i[0] < 9 and 0 < i[1] < 9 and not isOccupied(side, board, i):
-            if moveTest(side, board, piece[:2], i):
+            if (checked or piece[2] == "k" or piece[2] == "p"
+                    and i[0] != piece[0] and isEmpty(board, i)):
+                if moveTest(side, board, piece[:2], i):
+                    yield i
+            elif pin is None or (i[0] - king[0]) * pin[1] == (i[1] - king[1]) * pin[0]:
                 yield i
     
+# Yields the squares from [x, y] in the direction [dx, dy], up to the edge of
+# the board or the first piece on the way, which is included.
+def slide(board, x, y, dx, dy):
+    squares = board[2]
+    x, y = x + dx, y + dy
+    while 0 < x < 9 and 0 < y < 9:
+        yield [x, y]
+        if squares[y * 8 + x - 9] is not None:
+            break
+        x, y = x + dx, y + dy
+
 # Given a side, board and piece, it yields all possible moves by the piece.
 # If flags are given, it can also yeild the special moves of chess.
 # It also returns moves that are illegal, therefore the function is for
@@ -159,40 +320,12 @@ def rawMoves(side, board, piece, flags=[None, None]):
         )
 
     elif ptype == "b":
-        for i in range(1, 8):
-            yield [x + i, y + i]
-            if not isEmpty(board, [x + i, y + i]):
-                break
-        for i in range(1, 8):
-            yield [x + i, y - i]
-            if not isEmpty(board, [x + i, y - i]):
-                break
-        for i in range(1, 8):
-            yield [x - i, y + i]
-            if not isEmpty(board, [x - i, y + i]):
-                break
-        for i in range(1, 8):
-            yield [x - i, y - i]
-            if not isEmpty(board, [x - i, y - i]):
-                break
+        for dx, dy in DIAGONAL:
+            yield from slide(board, x, y, dx, dy)
 
     elif ptype == "r":
-        for i in range(1, 8):
-            yield [x + i, y]
-            if not isEmpty(board, [x + i, y]):
-                break
-        for i in range(1, 8):
-            yield [x - i, y]
-            if not isEmpty(board, [x - i, y]):
-                break
-        for i in range(1, 8):
-            yield [x, y + i]
-            if not isEmpty(board, [x, y + i]):
-                break
-        for i in range(1, 8):
-            yield [x, y - i]
-            if not isEmpty(board, [x, y - i]):
-                break
+        for dx, dy in STRAIGHT:
+            yield from slide(board, x, y, dx, dy)
 
     elif ptype == "q":
         yield from rawMoves(side, board, [x, y, "b"])
@@ -200,16 +333,16 @@ def rawMoves(side, board, piece, flags=[None, None]):
 
     elif ptype == "k":
         if flags[0] is not None and not isChecked(side, board):
-            if flags[0][0] and isEmpty(board, [2, 8], [3, 8], [4, 8]):
+            if not side and flags[0][0] and isEmpty(board, [2, 8], [3, 8], [4, 8]):
                 if moveTest(0, board, [5, 8], [4, 8]):
                     yield [3, 8]
-            if flags[0][1] and isEmpty(board, [6, 8], [7, 8]):
+            if not side and flags[0][1] and isEmpty(board, [6, 8], [7, 8]):
                 if moveTest(0, board, [5, 8], [6, 8]):
                     yield [7, 8]
-            if flags[0][2] and isEmpty(board, [2, 1], [3, 1], [4, 1]):
+            if side and flags[0][2] and isEmpty(board, [2, 1], [3, 1], [4, 1]):
                 if moveTest(1, board, [5, 1], [4, 1]):
                     yield [3, 1]
-            if flags[0][3] and isEmpty(board, [6, 1], [7, 1]):
+            if side and flags[0][3] and isEmpty(board, [6, 1], [7, 1]):
                 if moveTest(1, board, [5, 1], [6, 1]):
                     yield [7, 1]
 
@@ -7,6 +7,8 @@ from datetime import datetime
 import os
 import time
 
+from chess.lib.core import indexBoard
+
 LETTER = ["", "a", "b", "c", "d", "e", "f", "g", "h"]
 
 # encode() essentially converts a form of data used by the game to denote moves
@@ -49,7 +51,7 @@ def initBoardVars():
         ]
     ]
     flags = [[True for _ in range(4)], None]
-    return side, board, flags
+    return side, indexBoard(board), flags
     
 # A simple function to undo, num corresponds to the number of moves to undo.
 def undo(moves, num=1):
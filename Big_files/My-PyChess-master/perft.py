@@ -0,0 +1,95 @@
+"""
+This file is a part of My-PyChess application.
+In this file, we test the move generation of chess.lib.core, by counting all
+the move sequences of a given length (perft) from some well known positions,
+and comparing the counts with the known ones. It also times the counts.
+
+Run it from the same folder as pychess.py, like:
+    python perft.py [depth] [fen]
+With a fen, it prints the counts after each move of that position instead.
+"""
+import sys
+import time
+
+from chess.lib.core import legalMoves, doMove, undoMove, indexBoard
+from chess.lib.utils import encode
+
+# Positions with the counts for each depth. The game only promotes to queens,
+# so where there are other promotions the counts are less than the usual ones.
+POSITIONS = [
+    ("start", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -",
+     [20, 400, 8902, 197281]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -",
+     [48, 2039, 97862]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -",
+     [14, 191, 2812, 43238, 674624]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq -",
+     [6, 228, 8087, 320802]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ -",
+     [41, 1373, 54007, 1806790]),
+]
+
+# Return the side, board and flags of a position in Forsyth-Edwards Notation.
+# The rows of the FEN go from the top of the board, like the y coordinate.
+def fromFEN(fen):
+    rows, color, castle, enP = fen.split()[:4]
+    board = [[], []]
+    for y, row in enumerate(rows.split("/"), 1):
+        x = 1
+        for char in row:
+            if char.isdigit():
+                x += int(char)
+            else:
+                board[char.islower()].append([x, y, char.lower()])
+                x += 1
+
+    flags = [[char in castle for char in "QKqk"], None]
+    if enP != "-":
+        flags[1] = [" abcdefgh".index(enP[0]), 9 - int(enP[1])]
+    return color == "b", indexBoard(board), flags
+
+# Count the sequences of depth legal moves from a position.
+def perft(side, board, flags, depth):
+    if depth == 0:
+        return 1
+
+    count = 0
+    for fro, to in legalMoves(side, board, flags):
+        newflags, undo = doMove(side, board, fro, to, flags)
+        count += perft(not side, board, newflags, depth - 1)
+        undoMove(board, undo)
+    return count
+
+# Return the perft count after each move of a position, by move.
+def divide(side, board, flags, depth):
+    ret = {}
+    for fro, to in legalMoves(side, board, flags):
+        newflags, undo = doMove(side, board, fro, to, flags)
+        ret[encode(fro, to)] = perft(not side, board, newflags, depth - 1)
+        undoMove(board, undo)
+    return ret
+
+def main(depth=3, fen=None):
+    if fen is not None:
+        counts = divide(*fromFEN(fen), depth)
+        for move in sorted(counts):
+            print(move, counts[move])
+        print("Total:", sum(counts.values()))
+        return True
+
+    ok = True
+    for name, fen, counts in POSITIONS:
+        for d, expected in enumerate(counts[:depth], 1):
+            start = time.perf_counter()
+            count = perft(*fromFEN(fen), d)
+            secs = time.perf_counter() - start
+            ok = ok and count == expected
+            print("{:12} depth {}: {:9} {:4} {:8.2f}s {:8.0f} nodes/s".format(
+                name, d, count, "OK" if count == expected else "FAIL",
+                secs, count / max(secs, 1e-6)))
+    return ok
+
+if __name__ == "__main__":
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    fen = " ".join(sys.argv[2:]) or None
+    sys.exit(0 if main(depth, fen) else 1)
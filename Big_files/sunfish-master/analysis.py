@@ -0,0 +1,202 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import sunfish
+import tools
+
+################################################################################
+# Analysis. The search only looks for the best move, so for the best n moves
+# (MultiPV) the root is searched n times, each time without the moves found
+# before. Every search is an MTD-bi search like Searcher._search, over the
+# remaining root moves, which keeps all the tables and the draw test working.
+#
+# Files of positions are analysed by a pool of processes, each with its own
+# Searcher, and the results are written as JSON lines as they come in. Since
+# each line tells which position it is about, an interrupted run can be
+# resumed by skipping the positions already in the output.
+################################################################################
+
+
+def bound_moves(searcher, pos, moves, gamma, depth):
+    ''' Like searcher.bound at the root, but only over the given moves.
+        Returns the best score and the move that got it. '''
+    best, best_move = -sunfish.MATE_UPPER, None
+    for move in moves:
+        score = -searcher.bound(pos.move(move), 1-gamma, depth-1, root=False)
+        pos.undo()
+        if best_move is None or score > best:
+            best, best_move = score, move
+        if best >= gamma:
+            break
+    return best, best_move
+
+
+def multipv(searcher, pos, n, history=()):
+    """ Iterative deepening search for the n best moves of pos. Yields the
+    depth and a list of (move, score) for each finished iteration, best move
+    first. Like Searcher.search it ends early if the searcher is stopped. """
+    searcher.new_search(history)
+    # The moves are tried in the order of the last iteration
+    moves = [move for move, _ in tools.gen_legal_moves(pos)]
+    moves.sort(key=pos.value, reverse=True)
+    try:
+        for depth in range(1, 1000):
+            lines, remaining = [], list(moves)
+            while remaining and len(lines) < n:
+                lower, upper = -sunfish.MATE_UPPER, sunfish.MATE_UPPER
+                while lower < upper - sunfish.EVAL_ROUGHNESS:
+                    gamma = (lower+upper+1)//2
+                    score, _ = bound_moves(searcher, pos, remaining, gamma, depth)
+                    if score >= gamma:
+                        lower = score
+                    if score < gamma:
+                        upper = score
+                score, move = bound_moves(searcher, pos, remaining, lower, depth)
+                lines.append((move, score))
+                remaining.remove(move)
+            # Scores are only known up to EVAL_ROUGHNESS, so a later move may
+            # have been found to score a bit higher
+            lines.sort(key=lambda line: line[1], reverse=True)
+            moves = [move for move, _ in lines] + remaining
+            yield depth, lines
+    except sunfish.SearchStopped:
+        return
+
+
+def analyse(searcher, pos, n=1, depth=None, secs=None, history=()):
+    """ Searches pos for the n best moves, to the given depth or for the given
+    number of seconds, whichever comes first. Returns a dict with the depth
+    reached and, for each move, its score for the side to move and its
+    principal variation in UCI notation. """
+    start = time.time()
+    result = {'depth': 0, 'lines': []}
+    for d, lines in multipv(searcher, pos, n, history):
+        result['depth'] = d
+        result['lines'] = [{
+            'move': tools.mrender(pos, move),
+            'san': tools.renderSAN(pos, move),
+            'score': score,
+            'pv': [tools.mrender(pos, move)]
+                  + tools.pv(searcher, pos.move(move), include_scores=False).split(),
+        } for move, score in lines]
+        if depth is not None and d >= depth:
+            break
+        if secs is not None and time.time() - start > secs:
+            break
+    result['nodes'] = searcher.nodes
+    result['time'] = round(time.time() - start, 3)
+    return result
+
+
+################################################################################
+# Batch analysis
+################################################################################
+
+def read_positions(file):
+    ''' Yields the line number, FEN and EPD operations of each position in a
+        file of FENs or EPDs, skipping empty lines '''
+    for i, line in enumerate(file):
+        if not line.strip():
+            continue
+        fen, opts = tools.parseEPD(line)
+        ops = {}
+        for op in opts:
+            parts = op.split(maxsplit=1)
+            if len(parts) == 2:
+                ops[parts[0]] = parts[1]
+        yield i, fen, ops
+
+
+def done_lines(path):
+    ''' The line numbers of the positions already in the output at path. A
+        last line cut off by an interruption is removed from the file. '''
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as file:
+        data = file.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            file.truncate(end)
+    for line in data[:end].splitlines():
+        done.add(json.loads(line)['line'])
+    return done
+
+
+# The searcher of each process in the pool
+_searcher = None
+
+
+def _init_worker(table_mb):
+    global _searcher
+    _searcher = sunfish.Searcher(table_mb)
+
+
+def _analyse_job(job):
+    i, fen, ops, n, depth, secs = job
+    result = {'line': i, 'fen': fen}
+    if 'id' in ops:
+        result['id'] = ops['id']
+    result.update(analyse(_searcher, tools.parseFEN(fen), n, depth, secs))
+    return result
+
+
+def analyse_file(file, out_path, n=1, depth=None, secs=None,
+                 processes=None, table_mb=sunfish.TABLE_MB, resume=True):
+    ''' Analyses the positions of a FEN or EPD file on a pool of processes,
+        appending a JSON line per position to out_path in the order they are
+        finished. With resume, positions already in out_path are skipped.
+        Returns the number of positions analysed. '''
+    done = done_lines(out_path) if resume else set()
+    jobs = [(i, fen, ops, n, depth, secs)
+            for i, fen, ops in read_positions(file) if i not in done]
+    count = 0
+    with open(out_path, 'a' if resume else 'w') as out, \
+            multiprocessing.Pool(processes, _init_worker, (table_mb,)) as pool:
+        for result in pool.imap_unordered(_analyse_job, jobs):
+            out.write(json.dumps(result) + '\n')
+            # Flushed, so an interruption loses at most the running searches
+            out.flush()
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Analyse the positions of a FEN or EPD file, writing the best moves as JSON lines.')
+    parser.add_argument('file', type=argparse.FileType('r'),
+        help='the positions, one FEN or EPD per line.')
+    parser.add_argument('out', type=str,
+        help='the file to write the results to. Positions already in it are skipped.')
+    parser.add_argument('--multipv', type=int, default=1,
+        help='number of best moves to report. Default=%(default)s.')
+    parser.add_argument('--depth', type=int, default=None,
+        help='depth to search each position to.')
+    parser.add_argument('--secs', type=float, default=None,
+        help='seconds to search each position. Default is 1 if no depth is given.')
+    parser.add_argument('--processes', type=int, default=None,
+        help='number of processes. Default is the number of CPUs.')
+    parser.add_argument('--hash', type=int, default=sunfish.TABLE_MB,
+        help='MB of tables per process. Default=%(default)s.')
+    parser.add_argument('--restart', action='store_true',
+        help='overwrite the output rather than resuming.')
+    args = parser.parse_args()
+    if args.depth is None and args.secs is None:
+        args.secs = 1
+    start = time.time()
+    count = analyse_file(args.file, args.out, args.multipv, args.depth, args.secs,
+                         args.processes, args.hash, not args.restart)
+    print('Analysed {} positions in {:.2f}s'.format(count, time.time() - start),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse
+import mmap
+import os
+import time
+
+import sunfish
+import perft
+
+################################################################################
+# Endgame bitbases. For the endings of king and one piece against a lone king,
+# a bitbase tells, for every position, whether the side with the piece wins.
+# They are computed once by retrograde analysis with NumPy, which is only
+# needed for that, and stored as one bit per position. Probing them is done on
+# the memory mapped files in plain Python.
+#
+# Squares are numbered 8*row + col from the view of the side with the piece,
+# with row 0 being the eighth rank, so pawns move towards row 0. The files are
+# mirrored so the strong king is always on files a-d, which halves the size.
+################################################################################
+
+# The endings we can generate. KPK promotes to KQK, so that comes first.
+ENDINGS = ('KQK', 'KRK', 'KPK')
+
+# Where the bitbases are stored by default
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bitbases')
+
+# Score of a won pawn ending, on top of the position's own score. Less than a
+# queen, so that promoting still looks like progress to the search.
+KNOWN_WIN = sunfish.piece['R']
+
+# Positions per side to move, as stored
+SIZE = 32 * 64 * 64
+
+
+def index(sk, wk, x):
+    ''' Stored index of the position with the squares of the strong king, weak
+        king and piece, mirroring the board if the strong king is on files e-h '''
+    if sk & 7 > 3:
+        sk, wk, x = sk ^ 7, wk ^ 7, x ^ 7
+    return ((sk >> 3) * 4 + (sk & 7)) * 4096 + wk * 64 + x
+
+
+class Bitbases:
+    """ The bitbases in a directory, memory mapped. probe(pos) gives the score
+    of a position they cover, or None. """
+
+    # The most pieces in a position we know about
+    pieces = 3
+
+    def __init__(self, directory=DIRECTORY):
+        self.tables = {}
+        self.files = []
+        for name in ENDINGS:
+            path = os.path.join(directory, name + '.bb')
+            if os.path.exists(path):
+                file = open(path, 'rb')
+                self.files.append(file)
+                self.tables[name] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def probe(self, pos):
+        ''' The score of pos for the side to move, if it is covered, else None.
+            Draws are scored 0. Pawn endings that are won get KNOWN_WIN on top
+            of their score, while other wins are left to the search, since it
+            needs to find the actual mate. '''
+        if pos.kp or any(pos.wc) or any(pos.bc):
+            return None
+        board = pos.board
+        pieces = [(i, p) for i, p in enumerate(board) if p.isalpha()]
+        if len(pieces) == 2:
+            return 0
+        if len(pieces) != 3:
+            return None
+        # The side to move can take the king, which the search will do at once
+        if perft.attacked(board, board.find('k')):
+            return None
+        (i, p), = [(i, p) for i, p in pieces if p not in 'Kk']
+        strong = p.isupper()
+        table = self.tables.get('K' + p.upper() + 'K')
+        if table is None:
+            return None
+        # Look at the board from the strong side
+        sk, wk = board.find('K' if strong else 'k'), board.find('k' if strong else 'K')
+        if not strong:
+            sk, wk, i = 119-sk, 119-wk, 119-i
+        sq = lambda j: (j//10 - 2) * 8 + j%10 - 1
+        k = (0 if strong else SIZE) + index(sq(sk), sq(wk), sq(i))
+        if not table[k >> 3] >> (k & 7) & 1:
+            return 0
+        if p.upper() != 'P':
+            return None
+        return pos.score + KNOWN_WIN if strong else pos.score - KNOWN_WIN
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        for file in self.files:
+            file.close()
+
+
+def install(bitbases, sf=sunfish):
+    ''' Makes the search of sf, sunfish or another version of it, probe
+        the bitbases, if there are any '''
+    if bitbases.tables:
+        sf.ENDGAME_PROBE = bitbases.probe
+        sf.ENDGAME_PIECES = bitbases.pieces
+    else:
+        sf.ENDGAME_PROBE = None
+
+
+################################################################################
+# Generation
+################################################################################
+
+def generate(piece, promotions=None):
+    ''' Computes the bitbase of K + piece against K, where piece is one of 'PRQ'.
+        Returns two boolean arrays over 64*64*64 positions, indexed by
+        (strong king, weak king, piece), telling whether the strong side wins
+        with the strong or the weak side to move. Pawns promote to queens, and
+        promotions looks up the weak side to move array of KQK. '''
+    import numpy as np
+
+    n = 64**3
+    sk, wk, x = np.indices((64, 64, 64)).reshape(3, n)
+    row, col = lambda s: s >> 3, lambda s: s & 7
+    dist = lambda a, b: np.maximum(abs(row(a) - row(b)), abs(col(a) - col(b)))
+
+    # step[s, d] is the square one step from s in direction d, or -1
+    deltas = [(-1, 0), (0, 1), (1, 0), (0, -1), (-1, 1), (1, 1), (1, -1), (-1, -1)]
+    rays = np.full((64, 8, 8), -1)
+    for s in range(64):
+        for d, (dr, dc) in enumerate(deltas):
+            for k in range(1, 8):
+                r, c = s//8 + k*dr, s%8 + k*dc
+                if not (0 <= r < 8 and 0 <= c < 8):
+                    break
+                rays[s, d, k] = 8*r + c
+    step = rays[:, :, 1]
+    directions = {'R': range(4), 'Q': range(8)}.get(piece, ())
+
+    def attacks(x, target, blocker):
+        ''' Whether the piece on x attacks target, with blocker in the way '''
+        if piece == 'P':
+            return (target == x-9) & (col(x) > 0) | (target == x-7) & (col(x) < 7)
+        hit = np.zeros(len(x), bool)
+        for d in directions:
+            alive = np.ones(len(x), bool)
+            for k in range(1, 8):
+                t = rays[x, d, k]
+                alive &= (t >= 0)
+                hit |= alive & (t == target)
+                alive &= (t != blocker)
+        return hit
+
+    valid = (sk != wk) & (sk != x) & (wk != x) & (dist(sk, wk) > 1)
+    if piece == 'P':
+        valid &= (row(x) > 0) & (row(x) < 7)
+    in_check = attacks(x, wk, sk)
+    legal_s = valid & ~in_check
+    legal_w = valid
+
+    # Moves of the strong side, as indices into loss_w, then promotions into
+    # the KQK array after it, and a final False for no move
+    succ_s = []
+    for d in range(8):
+        t = step[sk, d]
+        ok = (t >= 0) & (t != x)
+        succ = np.where(ok, (t*64 + wk)*64 + x, 0)
+        succ_s.append(np.where(ok & legal_w[succ], succ, 2*n))
+    for d in directions:
+        alive = np.ones(n, bool)
+        for k in range(1, 8):
+            t = rays[x, d, k]
+            alive &= (t >= 0) & (t != sk) & (t != wk)
+            succ = np.where(alive, (sk*64 + wk)*64 + t, 0)
+            succ_s.append(np.where(alive & legal_w[succ], succ, 2*n))
+    if piece == 'P':
+        for k in (1, 2):
+            t = x - 8*k
+            ok = (t >= 0) & (t != sk) & (t != wk) & (x-8 != sk) & (x-8 != wk)
+            if k == 2:
+                ok &= (row(x) == 6)
+            succ = np.where(ok, (sk*64 + wk)*64 + t, 0)
+            # A pawn reaching row 0 becomes a queen
+            succ = np.where(row(t) == 0, n + succ, succ)
+            succ_s.append(np.where(ok, succ, 2*n))
+    succ_s = np.stack(succ_s, axis=1)
+
+    # Moves of the weak side, as indices into win_s, and a final True for no move
+    succ_w, moves, capture = [], np.zeros(n, bool), np.zeros(n, bool)
+    for d in range(8):
+        t = step[wk, d]
+        ok = (t >= 0) & (t != sk) & (dist(t, sk) > 1)
+        # Taking the piece leaves a draw
+        capture |= ok & (t == x)
+        ok &= (t != x)
+        succ = np.where(ok, (sk*64 + t)*64 + x, 0)
+        ok &= legal_s[succ]
+        moves |= ok
+        succ_w.append(np.where(ok, succ, n))
+    succ_w = np.stack(succ_w, axis=1)
+
+    promoted = promotions if promotions is not None else np.zeros(n, bool)
+    mated = legal_w & in_check & ~moves & ~capture
+    loss_w = mated
+    while True:
+        win_s = legal_s & np.concatenate([loss_w, promoted, [False]])[succ_s].any(axis=1)
+        loss_w1 = mated | legal_w & moves & ~capture \
+                & np.concatenate([win_s, [True]])[succ_w].all(axis=1)
+        if (loss_w1 == loss_w).all():
+            return win_s, loss_w
+        loss_w = loss_w1
+
+
+def store(arrays, path):
+    ''' Writes the arrays from generate to a file, mirrored and one bit per position '''
+    import numpy as np
+    with open(path, 'wb') as file:
+        for a in arrays:
+            # Keep the strong king on files a-d
+            half = a.reshape(8, 8, 64, 64)[:, :4].reshape(-1)
+            file.write(np.packbits(half, bitorder='little').tobytes())
+
+
+def generate_all(directory=DIRECTORY, names=ENDINGS, verbose=True):
+    ''' Generates and stores the bitbases with the given names '''
+    os.makedirs(directory, exist_ok=True)
+    arrays = {}
+    for name in ENDINGS:
+        if name not in names and not (name == 'KQK' and 'KPK' in names):
+            continue
+        start = time.time()
+        promotions = arrays['KQK'][1] if name == 'KPK' else None
+        arrays[name] = generate(name[1], promotions)
+        if name in names:
+            store(arrays[name], os.path.join(directory, name + '.bb'))
+        if verbose:
+            print('{}: {} won positions with the strong side to move, {} with the weak. '
+                  'Time: {:.2f}s'.format(name, arrays[name][0].sum(), arrays[name][1].sum(),
+                                         time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate endgame bitbases for sunfish.')
+    parser.add_argument('names', nargs='*', default=ENDINGS,
+        help='the endings to generate, of {}. Default is all of them.'.format(', '.join(ENDINGS)))
+    parser.add_argument('--dir', type=str, default=DIRECTORY,
+        help='directory to store them in. Default=%(default)s.')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in ENDINGS:
+            parser.error('unknown ending {}'.format(name))
+    generate_all(args.dir, args.names)
+
+
+if __name__ == '__main__':
+    main()
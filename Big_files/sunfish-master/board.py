@@ -0,0 +1,250 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import sunfish
+from sunfish import N, E, S, W, A1, H1, A8, H8, pst, zobrist, zobrist_castle, zobrist_ep, zobrist_kp, swap
+
+################################################################################
+# A mutable alternative to sunfish.Position. Position.move builds a new board
+# string with a number of slices, and rotates it, for every node. Board instead
+# changes a couple of bytes in place, and takes the move back with undo.
+#
+# The board is kept as two bytearrays, one as seen by each side, both in the
+# same layout as Position.board. A move updates the squares in both, so the
+# rotation after a move is just a matter of switching which one we look at.
+# Moves are in the coordinates of the side to move, exactly like Position, so
+# the same moves, table entries and tools work with both.
+################################################################################
+
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, EMPTY = b'PNBRQK.'
+UPPER, LOWER = frozenset(b'PNBRQK'), frozenset(b'pnbrqk')
+# Pieces other than pawns and kings, of the side to move and of the other
+OFFICERS, THEIR_OFFICERS = frozenset(b'NBRQ'), frozenset(b'nbrq')
+# Byte to the same byte seen by the other side
+SWAPCASE = bytes(range(128)).swapcase()
+# The tables of sunfish indexed by bytes rather than letters
+psts = {ord(p): table for p, table in pst.items()}
+zobs = {ord(p): keys for p, keys in zobrist.items()}
+steps = {KNIGHT: sunfish.steps['N'], KING: sunfish.steps['K']}
+rays = {ord(p): table for p, table in sunfish.rays.items()}
+# Values of the pieces of both sides, and of an empty square
+values = {ord(c): v for p, v in sunfish.piece.items() for c in (p, p.lower())}
+values[EMPTY] = 0
+
+
+class Board:
+    """ A position that is changed in place by move and nullmove, and changed
+    back by undo. It has the same score, wc, bc, ep, kp and hash attributes as
+    Position, and the methods sunfish.Searcher uses, so it can be searched
+    instead of a Position. Positions are converted with Board(pos) and
+    board.position().
+
+    boards -- the two 120 byte boards, seen from each side
+    turn -- the index in boards of the side to move
+    pieces -- for each side, a dict of its pieces {square: piece} from its own view
+    officers -- for each side, the number of its pieces other than pawns and the king
+    stack -- what undo needs to restore, for each move made
+    """
+
+    def __init__(self, pos):
+        rotated = pos.board[::-1].swapcase()
+        self.boards = [bytearray(pos.board, 'ascii'), bytearray(rotated, 'ascii')]
+        self.pieces = [{i: ord(p) for i, p in enumerate(board) if p.isupper()}
+                       for board in (pos.board, rotated)]
+        self.officers = [sum(p in OFFICERS for p in pieces.values()) for pieces in self.pieces]
+        self.turn = 0
+        self.score, self.wc, self.bc, self.ep, self.kp, self.hash = pos[1:]
+        self.stack = []
+
+    def position(self):
+        ''' The current position as a sunfish.Position '''
+        return sunfish.Position(self.board, self.score, self.wc, self.bc, self.ep, self.kp, self.hash)
+
+    @property
+    def board(self):
+        ''' The 120 char board of the side to move, like Position.board '''
+        return self.boards[self.turn].decode('ascii')
+
+    def gen_moves(self):
+        ''' Same as Position.gen_moves, but returns a list, since the board
+            may have changed by the time a generator got to run. '''
+        board, ep, kp, wc = self.boards[self.turn], self.ep, self.kp, self.wc
+        moves = []
+        for i, p in self.pieces[self.turn].items():
+            if p == PAWN:
+                if board[i+N] == EMPTY:
+                    moves.append((i, i+N))
+                    j = sunfish.pawn_double[i]
+                    if j and board[j] == EMPTY:
+                        moves.append((i, j))
+                for j in sunfish.pawn_captures[i]:
+                    q = board[j]
+                    if q in LOWER or q == EMPTY and j in (ep, kp, kp-1, kp+1):
+                        moves.append((i, j))
+            elif p == KNIGHT or p == KING:
+                for j in steps[p][i]:
+                    if board[j] not in UPPER:
+                        moves.append((i, j))
+            else:
+                for ray in rays[p][i]:
+                    for j in ray:
+                        q = board[j]
+                        if q in UPPER: break
+                        moves.append((i, j))
+                        if q != EMPTY: break
+                        # Castling, by sliding the rook next to the king
+                        if i == A1 and board[j+E] == KING and wc[0]: moves.append((j+E, j+W))
+                        if i == H1 and board[j+W] == KING and wc[1]: moves.append((j+W, j+E))
+        return moves
+
+    def piece_count(self):
+        ''' Same as Position.piece_count '''
+        return len(self.pieces[0]) + len(self.pieces[1])
+
+    def nonpawn_material(self):
+        ''' Same as Position.nonpawn_material '''
+        return self.officers[self.turn] > 0
+
+    def tactical(self, move):
+        ''' Same as Position.tactical, on the bytes of the board '''
+        i, j = move
+        board = self.boards[self.turn]
+        return board[j] != EMPTY or abs(j - self.kp) < 2 \
+            or board[i] == PAWN and (j == self.ep or A8 <= j <= H8)
+
+    def split_moves(self, skip=None):
+        ''' Same as Position.split_moves, on the bytes of the board '''
+        board, ep, kp = self.boards[self.turn], self.ep, self.kp
+        captures, quiets = [], []
+        for move in self.gen_moves():
+            if move == skip:
+                continue
+            i, j = move
+            p, q = board[i], board[j]
+            promotion = p == PAWN and A8 <= j <= H8
+            if abs(j - kp) < 2:
+                q = KING
+            elif p == PAWN and j == ep:
+                q = PAWN
+            elif q == EMPTY and not promotion:
+                quiets.append(move)
+                continue
+            gain = values[q]
+            if promotion:
+                gain += sunfish.piece['Q'] - sunfish.piece['P']
+            captures.append((gain, -values[p], move))
+        return captures, quiets
+
+    def value(self, move):
+        ''' Same as Position.value '''
+        i, j = move
+        board = self.boards[self.turn]
+        p, q = board[i], board[j]
+        score = psts[p][j] - psts[p][i]
+        if q in LOWER:
+            score += psts[q ^ 32][119-j]
+        if abs(j-self.kp) < 2:
+            score += pst['K'][119-j]
+        if p == KING and abs(i-j) == 2:
+            score += pst['R'][(i+j)//2]
+            score -= pst['R'][A1 if j < i else H1]
+        if p == PAWN:
+            if A8 <= j <= H8:
+                score += pst['Q'][j] - pst['P'][j]
+            if j == self.ep:
+                score += pst['P'][119-(j+S)]
+        return score
+
+    def _put(self, i, p):
+        ''' Puts p on square i of the side to move, in both boards and piece lists '''
+        board, ours, theirs = self.boards[self.turn], self.pieces[self.turn], self.pieces[1-self.turn]
+        q = board[i]
+        if q in UPPER:
+            del ours[i]
+            if q in OFFICERS: self.officers[self.turn] -= 1
+        elif q in LOWER:
+            del theirs[119-i]
+            if q in THEIR_OFFICERS: self.officers[1-self.turn] -= 1
+        board[i] = p
+        self.boards[1-self.turn][119-i] = SWAPCASE[p]
+        if p in UPPER:
+            ours[i] = p
+            if p in OFFICERS: self.officers[self.turn] += 1
+        elif p in LOWER:
+            theirs[119-i] = p ^ 32
+            if p in THEIR_OFFICERS: self.officers[1-self.turn] += 1
+
+    def move(self, move):
+        ''' Makes the move, like Position.move, but in place. Returns the board. '''
+        i, j = move
+        board = self.boards[self.turn]
+        p, q = board[i], board[j]
+        self.stack.append((move, p, q, self.score, self.wc, self.bc, self.ep, self.kp, self.hash))
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        score = self.score + self.value(move)
+        # Actual move, the hash is updated along with the board
+        self._put(j, p)
+        self._put(i, EMPTY)
+        h = self.hash ^ zobs[q][j] ^ zobs[p][j] ^ zobs[p][i]
+        if self.ep or self.kp:
+            h ^= zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        # Castling rights, we move the rook or capture the opponent's
+        if i == A1: wc = (False, wc[1])
+        if i == H1: wc = (wc[0], False)
+        if j == A8: bc = (bc[0], False)
+        if j == H8: bc = (False, bc[1])
+        # Castling
+        if p == KING:
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                self._put(A1 if j < i else H1, EMPTY)
+                self._put(kp, ROOK)
+                h ^= zobrist['R'][A1 if j < i else H1] ^ zobrist['R'][kp]
+        # Pawn promotion, double move and en passant capture
+        if p == PAWN:
+            if A8 <= j <= H8:
+                self._put(j, QUEEN)
+                h ^= zobrist['P'][j] ^ zobrist['Q'][j]
+            if j - i == 2*N:
+                ep = i + N
+            if j == self.ep:
+                self._put(j+S, EMPTY)
+                h ^= zobrist['p'][j+S]
+        if wc != self.wc or bc != self.bc:
+            h ^= zobrist_castle[self.wc] ^ swap(zobrist_castle[self.bc]) \
+                    ^ zobrist_castle[wc] ^ swap(zobrist_castle[bc])
+        if ep or kp:
+            h ^= zobrist_ep[ep] ^ zobrist_kp[kp]
+        # Rotate, so it's ready for the next player
+        self.turn ^= 1
+        self.score, self.wc, self.bc = -score, bc, wc
+        self.ep, self.kp = 119-ep if ep else 0, 119-kp if kp else 0
+        self.hash = swap(h)
+        return self
+
+    def nullmove(self):
+        ''' Like Position.nullmove, but in place. Returns the board. '''
+        self.stack.append((None, 0, 0, self.score, self.wc, self.bc, self.ep, self.kp, self.hash))
+        self.turn ^= 1
+        self.score, self.wc, self.bc = -self.score, self.bc, self.wc
+        self.hash = swap(self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp])
+        self.ep = self.kp = 0
+        return self
+
+    def undo(self):
+        ''' Takes back the last move or null move '''
+        move, p, q, self.score, self.wc, self.bc, self.ep, self.kp, self.hash = self.stack.pop()
+        self.turn ^= 1
+        if move is None:
+            return
+        i, j = move
+        if p == KING and abs(j-i) == 2:
+            self._put((i+j)//2, EMPTY)
+            self._put(A1 if j < i else H1, ROOK)
+        if p == PAWN and j == self.ep:
+            self._put(j+S, PAWN ^ 32)
+        self._put(i, p)
+        self._put(j, q)
@@ -0,0 +1,221 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import array
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import struct
+
+import tools
+
+################################################################################
+# Databases of games and positions. A PGN or EPD file is memory mapped rather
+# than read, and an index of the byte offsets where its records (games or
+# positions) start is built in one pass over it, and saved next to it. The
+# records are then parsed only when they are asked for, by number, in order,
+# or as a random sample, so files much larger than memory can be used.
+#
+# Replaying the moves of a game is what takes time, so it is done on a pool
+# of processes. They map the file themselves and are sent game numbers, and
+# only what is made of the moves is sent back.
+################################################################################
+
+# The index file: magic, kind, size and modification time of the indexed file
+# and number of records, followed by the offsets of the records and the end.
+INDEX_HEADER = struct.Struct('<4s4sQqQ')
+INDEX_MAGIC = b'SFDB'
+
+RESULTS = (b'1-0', b'0-1', b'1/2-1/2', b'*')
+
+
+def lines(data):
+    ''' Yields the offset and the stripped content of each line of data '''
+    at, size = 0, len(data)
+    while at < size:
+        end = data.find(b'\n', at)
+        end = size if end == -1 else end + 1
+        yield at, data[at:end].strip()
+        at = end
+
+
+def scan_pgn(data):
+    ''' The offsets where the games of a PGN file start. Like tools.read_games,
+        a game ends with a result, or with a header or an empty line after
+        its moves. '''
+    starts = array.array('Q')
+    started = moves = comment = False
+    for at, line in lines(data):
+        if not line or line.startswith(b'['):
+            if moves:
+                started = moves = comment = False
+            if line and not started:
+                starts.append(at)
+                started = True
+            continue
+        if not started:
+            starts.append(at)
+            started = True
+        moves = True
+        # Comments may go on over several lines
+        if comment:
+            end = line.find(b'}')
+            comment = end == -1
+            line = b'' if comment else line[end+1:]
+        line = re.sub(rb'{[^}]*}|;.*', b'', line)
+        if b'{' in line:
+            line, comment = line[:line.index(b'{')], True
+        if any(part in RESULTS for part in line.split()):
+            started = moves = comment = False
+    return starts
+
+
+def scan_epd(data):
+    ''' The offsets of the non-empty lines of an EPD or FEN file '''
+    return array.array('Q', (at for at, line in lines(data) if line))
+
+
+class Database:
+    """ The games of a PGN file, or the positions of an EPD or FEN file. The
+    file is memory mapped, and db[i] parses record i: a game as a (SAN moves,
+    result) pair like tools.read_games, a position as a (fen, operations)
+    pair like tools.parseEPD. The index is read from index_path, by default
+    path + '.idx', and rebuilt if the file has changed since. """
+
+    def __init__(self, path, kind=None, index_path=None):
+        self.path = path
+        self.kind = kind or ('pgn' if path.lower().endswith('.pgn') else 'epd')
+        self.index_path = index_path or path + '.idx'
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if os.path.getsize(path) else b''
+        self.offsets = self.load_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+
+    def _header(self, count):
+        stat = os.stat(self.path)
+        return INDEX_HEADER.pack(INDEX_MAGIC, self.kind.encode().ljust(4),
+                                 stat.st_size, stat.st_mtime_ns, count)
+
+    def load_index(self):
+        ''' The offsets from the index file, or None if it is missing or stale '''
+        try:
+            with open(self.index_path, 'rb') as file:
+                header = file.read(INDEX_HEADER.size)
+                if len(header) != INDEX_HEADER.size:
+                    return None
+                count = INDEX_HEADER.unpack(header)[-1]
+                if header != self._header(count):
+                    return None
+                offsets = array.array('Q')
+                offsets.frombytes(file.read())
+        except OSError:
+            return None
+        return offsets if len(offsets) == count + 1 else None
+
+    def build_index(self):
+        ''' Scans the file for the offsets of the records, and saves them if
+            the index file can be written '''
+        offsets = (scan_pgn if self.kind == 'pgn' else scan_epd)(self.data)
+        count = len(offsets)
+        offsets.append(len(self.data))
+        try:
+            with open(self.index_path + '.tmp', 'wb') as file:
+                file.write(self._header(count))
+                file.write(offsets.tobytes())
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError:
+            pass
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, i):
+        ''' The text of record i, as it is in the file '''
+        return self.data[self.offsets[i]:self.offsets[i+1]].decode('utf-8', 'replace')
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError('record {} of {} in {}'.format(i, len(self), self.path))
+        text = self.text(i % len(self))
+        if self.kind == 'epd':
+            return tools.parseEPD(text)
+        return next(tools.read_games(text.splitlines()), ([], None))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def sample(self, k, rand=random):
+        ''' k different records, chosen at random '''
+        return [self[i] for i in rand.sample(range(len(self)), k)]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+################################################################################
+# Replaying games
+################################################################################
+
+def parse_game(msans):
+    ''' The moves of a game from the initial position, as far as sunfish can
+        play them: it doesn't underpromote, and an illegal move ends it too. '''
+    pos, moves = tools.parseFEN(tools.FEN_INITIAL), []
+    for msan in msans:
+        if re.search('=[BNR]', msan):
+            break
+        try:
+            move = tools.parseSAN(pos, msan)
+        except AssertionError:
+            break
+        moves.append(move)
+        pos = pos.move(move)
+    return moves
+
+
+def _play(db, func, i):
+    msans, result = db[i]
+    moves = parse_game(msans)
+    return (moves, result) if func is None else func(moves, result)
+
+
+# The database and function of each process in the pool
+_db = _func = None
+
+
+def _init_worker(path, kind, index_path, func):
+    global _db, _func
+    _db, _func = Database(path, kind, index_path), func
+
+
+def _play_job(i):
+    return _play(_db, _func, i)
+
+
+def replay(db, func=None, indices=None, processes=None, chunksize=64):
+    """ Replays the games of a PGN database with the given numbers, all of
+    them by default, yielding func(moves, result) for each, in order, or the
+    (moves, result) pair without a func. The games are replayed on a pool of
+    processes, unless processes is 1, so func must be a module level function
+    that can be pickled. """
+    if indices is None:
+        indices = range(len(db))
+    if processes == 1:
+        for i in indices:
+            yield _play(db, func, i)
+        return
+    with multiprocessing.Pool(processes, _init_worker,
+                              (db.path, db.kind, db.index_path, func)) as pool:
+        yield from pool.imap(_play_job, indices, chunksize=chunksize)
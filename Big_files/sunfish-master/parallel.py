@@ -0,0 +1,162 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import multiprocessing
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import sunfish
+
+################################################################################
+# Lazy SMP. A number of helper processes run the same iterative deepening search
+# as the main process, with slightly different depths and aspiration points,
+# and all of them read and write the same transposition tables in shared memory.
+# The helpers mostly serve to fill the tables for the main search.
+#
+# Each search has a number, and the helpers are told which search is going on
+# through a shared counter rather than an event, which one search could clear
+# before a helper saw that the one before was over. The counter only goes up,
+# so a helper searches until the counter is no longer at the number of its job.
+################################################################################
+
+
+class ParallelSearcher(sunfish.Searcher):
+    """ A drop in replacement for sunfish.Searcher using `threads` processes """
+
+    def __init__(self, table_mb=sunfish.TABLE_MB, threads=2):
+        super().__init__(0)
+        # Same split between the tables as sunfish.Searcher
+        score_words = int(table_mb * (1 << 20) * 2/3) // 32 * 4
+        move_words = int(table_mb * (1 << 20) / 3) // 8
+        self.shms = [shared_memory.SharedMemory(create=True, size=8*max(words, 4))
+                     for words in (score_words, move_words)]
+        self.tp_score = sunfish.ScoreTable(buf=self.shms[0].buf)
+        self.tp_move = sunfish.MoveTable(buf=self.shms[1].buf)
+        # The main search is stopped by the event, the helpers by the counter
+        self.stop = threading.Event()
+        self.generation = multiprocessing.Value('q', 0)
+        self.results = multiprocessing.Queue()
+        self.search_id = 0
+        self.jobs = []
+        self.helpers = []
+        for wid in range(1, threads):
+            jobs = multiprocessing.Queue()
+            helper = multiprocessing.Process(target=run_helper, daemon=True, args=(
+                wid, [shm.name for shm in self.shms], jobs, self.results, self.generation))
+            helper.start()
+            self.jobs.append(jobs)
+            self.helpers.append(helper)
+
+    def search(self, pos, history=()):
+        """ Iterative deepening MTD-bi search, helped by the other processes.
+        Yields the deepest completed iteration of any of them. Like
+        sunfish.Searcher, the stop event is left to the caller to clear, so a
+        stop set before the search starts still ends it. """
+        history = tuple(history)
+        self.search_id = self.next_generation()
+        # The helpers use the same table age as us
+        for jobs in self.jobs:
+            jobs.put((self.search_id, pos, history, (self.tp_score.age + 1) & 0xff))
+        best = None
+        try:
+            for depth, move, score in super().search(pos, history):
+                if best is None or depth >= best[0]:
+                    best = depth, move, score
+                while True:
+                    try:
+                        search_id, depth, move, score, nodes = self.results.get_nowait()
+                    except queue.Empty:
+                        break
+                    # Results from an older search may still be in the queue
+                    if search_id != self.search_id:
+                        continue
+                    self.nodes += nodes
+                    if move is not None and depth > best[0]:
+                        best = depth, move, score
+                yield best
+        finally:
+            self.next_generation()
+
+    def next_generation(self):
+        ''' Moves the counter on, which stops the helpers, and returns it '''
+        with self.generation.get_lock():
+            self.generation.value += 1
+            return self.generation.value
+
+    def close(self):
+        """ Stops the helpers and frees the shared memory """
+        self.next_generation()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for helper in self.helpers:
+            helper.join()
+        self.tp_score.table.release()
+        self.tp_move.table.release()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+
+class Stopped:
+    """ Set, like the stop event of a Searcher, once the search search_id is
+    over, that is when the shared counter has gone past it """
+
+    def __init__(self, generation, search_id):
+        self.generation, self.search_id = generation, search_id
+
+    def is_set(self):
+        return self.generation.value != self.search_id
+
+
+def run_helper(wid, names, jobs, results, generation):
+    shms = [shared_memory.SharedMemory(name) for name in names]
+    searcher = sunfish.Searcher(0)
+    searcher.tp_score = sunfish.ScoreTable(buf=shms[0].buf)
+    searcher.tp_move = sunfish.MoveTable(buf=shms[1].buf)
+    while True:
+        job = jobs.get()
+        # Skip searches that were already over before we got to them
+        while not jobs.empty():
+            job = jobs.get()
+        if job is None:
+            break
+        search_id, pos, history, age = job
+        stop = searcher.stop = Stopped(generation, search_id)
+        if stop.is_set():
+            continue
+        searcher.new_search(history)
+        searcher.tp_score.age = age
+        try:
+            for depth, move, score in helper_search(searcher, pos, wid, stop):
+                results.put((search_id, depth, move, score, searcher.nodes))
+                searcher.nodes = 0
+        except sunfish.SearchStopped:
+            pass
+    searcher.tp_score.table.release()
+    searcher.tp_move.table.release()
+    for shm in shms:
+        shm.close()
+
+
+def helper_search(searcher, pos, wid, stop):
+    """ Like Searcher.search, but every other helper searches one ply deeper,
+    and each helper starts its binary search on gamma at a different point,
+    so the helpers visit the moves in different orders. """
+    for depth in range(1 + wid % 2, 1000):
+        lower, upper = -sunfish.MATE_UPPER, sunfish.MATE_UPPER
+        gamma = (wid + 1) // 2 * (1 if wid % 2 else -1) * sunfish.EVAL_ROUGHNESS
+        while lower < upper - sunfish.EVAL_ROUGHNESS:
+            if stop.is_set():
+                return
+            score = searcher.bound(pos, gamma, depth)
+            if score >= gamma:
+                lower = score
+            if score < gamma:
+                upper = score
+            gamma = (lower+upper+1)//2
+        if stop.is_set():
+            return
+        score = searcher.bound(pos, lower, depth)
+        yield depth, searcher.tp_move.get(pos.hash), score
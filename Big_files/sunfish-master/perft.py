@@ -0,0 +1,191 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse
+import multiprocessing
+import sys
+import time
+from itertools import count
+
+import sunfish
+import tools
+from sunfish import N, E, S, W
+
+################################################################################
+# Perft counts the number of legal move sequences of a given length from a
+# position. Comparing against known counts is the standard way of testing a
+# move generator. Unlike tools.expand_position, the counter here just recurses
+# on the positions, with no generators of positions in between, and stores the
+# counts of the subtrees it has seen, since many of them are reached by several
+# move orders.
+################################################################################
+
+# The size of the perft table in megabytes, per process.
+TABLE_MB = 64
+
+
+class PerftTable(sunfish.Table):
+    """ Maps (hash, depth) to the number of nodes below. A slot is two words,
+    (key ^ count, count), like sunfish.ScoreTable. Always replaced. """
+    words = 2
+
+    def get(self, h, depth):
+        k = (h ^ depth * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+        t, i = self.table, k % self.size * 2
+        count = t[i+1]
+        return count if t[i] ^ count == k else None
+
+    def put(self, h, depth, count):
+        k = (h ^ depth * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+        t, i = self.table, k % self.size * 2
+        t[i], t[i+1] = k ^ count, count
+
+
+def attacked(board, i):
+    ''' Whether any of our pieces could move to square i by capturing '''
+    for d in sunfish.directions['N']:
+        if board[i+d] == 'N':
+            return True
+    for d in sunfish.directions['Q']:
+        for j in count(i+d, d):
+            q = board[j]
+            if q == '.':
+                continue
+            if q == 'Q' or q == 'R' and d in (N, E, S, W) or q == 'B' and d not in (N, E, S, W):
+                return True
+            if j == i+d and (q == 'K' or q == 'P' and d in (S+E, S+W)):
+                return True
+            break
+    return False
+
+
+def can_kill_king(pos):
+    ''' Same as tools.can_kill_king, but looking out from the opponent king,
+        and the squares it castled through, rather than generating all moves. '''
+    k = pos.board.find('k')
+    if k != -1 and attacked(pos.board, k):
+        return True
+    # Sunfish also counts a pawn moving straight onto one of those squares
+    return bool(pos.kp) and any(attacked(pos.board, j) or pos.board[j] == '.' and pos.board[j+S] == 'P'
+                                for j in (pos.kp-1, pos.kp, pos.kp+1))
+
+
+def perft(pos, depth, table=None):
+    ''' Number of legal move sequences of length depth from pos '''
+    if depth == 0:
+        return 1
+    if table is not None and depth > 1:
+        count = table.get(pos.hash, depth)
+        if count is not None:
+            return count
+    count = 0
+    for move in pos.gen_moves():
+        pos1 = pos.move(move)
+        if can_kill_king(pos1):
+            continue
+        # At the last ply we only need to know that the move is legal
+        count += 1 if depth == 1 else perft(pos1, depth-1, table)
+    if table is not None and depth > 1:
+        table.put(pos.hash, depth, count)
+    return count
+
+
+# Each process keeps its own table
+_table, _table_mb = None, 0
+
+def _init_worker(table_mb):
+    global _table, _table_mb
+    if table_mb != _table_mb:
+        _table, _table_mb = PerftTable(table_mb) if table_mb else None, table_mb
+
+def _perft_move(pos_move_depth):
+    pos, move, depth = pos_move_depth
+    return perft(pos.move(move), depth-1, _table)
+
+
+def new_pool(procs, table_mb=TABLE_MB):
+    """ Pool for splitting root moves, or None to count in this process """
+    if procs > 1:
+        return multiprocessing.Pool(procs, _init_worker, (table_mb,))
+    _init_worker(table_mb)
+    return None
+
+
+def divide(pos, depth, pool=None):
+    ''' Returns [(move, count), ...] for the legal moves of pos. The root moves
+        are split over the processes of the pool from new_pool. '''
+    moves = [move for move in pos.gen_moves() if not can_kill_king(pos.move(move))]
+    jobs = [(pos, move, depth) for move in moves]
+    if pool is not None:
+        counts = pool.map(_perft_move, jobs, chunksize=1)
+    else:
+        counts = list(map(_perft_move, jobs))
+    return list(zip(moves, counts))
+
+
+def check_file(f, depth, pool=None, verbose=True):
+    ''' Checks the counts in an epd-like file, such as tests/queen.fen, with
+        lines of the form fen;count at depth 1;count at depth 2;... '''
+    lines = f.readlines()
+    for d in range(1, depth+1):
+        if verbose:
+            print("Going to depth {}/{}".format(d, depth))
+        for line in lines:
+            parts = line.split(';')
+            if len(parts) <= d:
+                continue
+            if verbose:
+                print(parts[0])
+            pos, score = tools.parseFEN(parts[0]), int(parts[d])
+            splits = divide(pos, d, pool)
+            res = sum(count for _, count in splits)
+            if res != score:
+                print('=========================================')
+                print('ERROR at depth %d. Gave %d rather than %d' % (d, res, score))
+                print('=========================================')
+                print(tools.renderFEN(pos, 0))
+                for move, count in splits:
+                    print('{}: {}'.format(tools.mrender(pos, move), count))
+                return False
+        if verbose:
+            print('')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Count the legal move sequences from a position, for testing the move generator.')
+    parser.add_argument('fen', type=str, nargs='?', default=tools.FEN_INITIAL,
+        help='position to count from. Default is the initial position.')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--divide', action='store_true',
+        help='print the count below each legal move.')
+    parser.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes to split the root moves over. Default=%(default)s.')
+    parser.add_argument('--hash', type=int, default=TABLE_MB, metavar='MB',
+        help='size of the perft table per process, 0 to disable. Default=%(default)s.')
+    parser.add_argument('--file', type=argparse.FileType('r'),
+        help='check all positions and counts in a file such as tests/queen.fen.')
+    args = parser.parse_args()
+
+    pool = new_pool(args.procs, args.hash)
+    start = time.time()
+    if args.file:
+        success = check_file(args.file, args.depth, pool)
+        print('Time: {:.2f}s'.format(time.time() - start))
+        sys.exit(0 if success else 1)
+
+    pos = tools.parseFEN(args.fen)
+    splits = divide(pos, args.depth, pool)
+    if args.divide:
+        for move, count in splits:
+            print('{}: {}'.format(tools.mrender(pos, move), count))
+    total = sum(count for _, count in splits)
+    used = time.time() - start
+    print('Nodes: {}, Time: {:.2f}s, Speed: {:,}N/s'.format(
+        total, used, int(total / max(used, 1e-9))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import analysis
+import sunfish
+import tools
+
+################################################################################
+# Analysis server. A long running process that analyses positions for other
+# programs, so they don't each have to start an engine and fill its tables.
+# Clients connect over a Unix or TCP socket and send one JSON object per line,
+#
+#   {"fen": "...", "moves": ["e2e4", ...], "depth": 8, "secs": 2, "multipv": 1,
+#    "priority": 0, "id": ...}
+#
+# and get one JSON object per line back, with the id, fen and moves of the
+# request and the result of analysis.analyse, or an "error". All the fields
+# are optional, the fen is the initial position by default. The moves are
+# played from it, and the positions since the last irreversible move are
+# kept for the draw test. {"cmd": "stats"} and {"cmd": "ping"} are answered
+# at once. A client may send many requests without waiting, and the results
+# come back as they are finished, so the id tells them apart.
+#
+# The positions are searched by a pool of worker processes. Each keeps its
+# own Searcher from job to job, so its tables stay warm. The jobs wait in a
+# single queue, highest priority first, and in the order they came in.
+################################################################################
+
+# Seconds to search when a request gives neither depth nor secs
+DEFAULT_SECS = 1
+
+
+class AnalysisPool:
+    """ Worker processes analysing the positions of a priority queue. submit
+    queues a job, and calls back with the result when a worker is done. """
+
+    def __init__(self, workers=None, table_mb=sunfish.TABLE_MB):
+        self.table_mb = table_mb
+        self.cond = threading.Condition()
+        self.queue = []
+        self.order = itertools.count()
+        self.closed = False
+        self.started = time.time()
+        self.stats = {'submitted': 0, 'done': 0, 'errors': 0, 'nodes': 0, 'busy': 0}
+        self.workers = [self._start_worker() for _ in range(workers or os.cpu_count() or 1)]
+        self.threads = [threading.Thread(target=self._serve, args=(wid,), daemon=True)
+                        for wid in range(len(self.workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def _start_worker(self):
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_worker, args=(child, self.table_mb), daemon=True)
+        process.start()
+        child.close()
+        return process, conn
+
+    def submit(self, job, callback, priority=0):
+        ''' Queues job, a (pos, history, multipv, depth, secs) tuple, and calls
+            callback with the result dict from one of the pool's threads '''
+        with self.cond:
+            if self.closed:
+                raise ValueError('the pool is closed')
+            heapq.heappush(self.queue, (-priority, next(self.order), time.time(), job, callback))
+            self.stats['submitted'] += 1
+            self.cond.notify()
+
+    def _serve(self, wid):
+        ''' Feeds the jobs to worker wid, one at a time '''
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                _, _, queued, job, callback = heapq.heappop(self.queue)
+                self.stats['busy'] += 1
+            process, conn = self.workers[wid]
+            waited = time.time() - queued
+            try:
+                conn.send(job)
+                result = conn.recv()
+            except (EOFError, OSError):
+                # The worker died, maybe from running out of memory
+                conn.close()
+                process.join()
+                result = {'error': 'worker {} exited with code {}'.format(wid, process.exitcode)}
+                self.workers[wid] = self._start_worker()
+            result['worker'] = wid
+            result['queued'] = round(waited, 3)
+            with self.cond:
+                self.stats['busy'] -= 1
+                self.stats['done'] += 1
+                self.stats['errors'] += 'error' in result
+                self.stats['nodes'] += result.get('nodes', 0)
+            callback(result)
+
+    def status(self):
+        ''' The counters, with the number of queued jobs and workers '''
+        with self.cond:
+            status = dict(self.stats, queued=len(self.queue), workers=len(self.workers))
+        status['uptime'] = round(time.time() - self.started, 3)
+        return status
+
+    def close(self):
+        ''' Stops the workers. Jobs still in the queue are dropped, and the
+            ones being searched are finished first. '''
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        for process, conn in self.workers:
+            conn.send(None)
+            process.join()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_worker(conn, table_mb):
+    ''' Analyses the jobs sent on conn with the same Searcher, until None '''
+    searcher = sunfish.Searcher(table_mb)
+    searcher.stop = threading.Event()
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        pos, history, n, depth, secs = job
+        # analyse only looks at the clock between iterations, so the search
+        # is also stopped when the time is up
+        searcher.stop.clear()
+        timer = threading.Timer(secs, searcher.stop.set) if secs is not None else None
+        if timer is not None:
+            timer.start()
+        try:
+            result = analysis.analyse(searcher, pos, n, depth, secs, history)
+        except Exception as e:
+            result = {'error': '{}: {}'.format(type(e).__name__, e)}
+        finally:
+            if timer is not None:
+                timer.cancel()
+        conn.send(result)
+    conn.close()
+
+
+def parse_request(request):
+    ''' The job of an analysis request, or a ValueError saying what is wrong '''
+    if not isinstance(request, dict):
+        raise ValueError('a request is a JSON object')
+    fen = request.get('fen', tools.FEN_INITIAL)
+    try:
+        pos = tools.parseFEN(fen)
+    except (ValueError, KeyError, AttributeError):
+        raise ValueError('invalid fen: {!r}'.format(fen))
+    moves = request.get('moves', [])
+    if isinstance(moves, str):
+        moves = moves.split()
+    if not isinstance(moves, list) or not all(isinstance(move, str) for move in moves):
+        raise ValueError('moves must be a list of strings, or a string')
+    history = [pos.hash]
+    for move in moves:
+        legal = {tools.mrender(pos, m): m for m in pos.gen_moves()}
+        # Sunfish only promotes to queens, so other promotions are not legal
+        if move not in legal:
+            raise ValueError('illegal move: {!r}'.format(move))
+        if sunfish.irreversible(pos, legal[move]):
+            history = []
+        pos = pos.move(legal[move])
+        history.append(pos.hash)
+    depth, secs, n = request.get('depth'), request.get('secs'), request.get('multipv', 1)
+    for name, value in (('depth', depth), ('secs', secs), ('multipv', n)):
+        if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError('{} must be a positive number'.format(name))
+    if depth is None and secs is None:
+        secs = DEFAULT_SECS
+    return pos, history, int(n), depth, secs
+
+
+################################################################################
+# Sockets
+################################################################################
+
+class Handler(socketserver.StreamRequestHandler):
+    ''' Serves the requests of one client '''
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+        self.pending = threading.Semaphore(0)
+        self.submitted = 0
+
+    def reply(self, result):
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(result) + '\n').encode())
+                self.wfile.flush()
+            except (OSError, ValueError):
+                # The client is gone, only its results are lost
+                pass
+
+    def handle(self):
+        pool = self.server.pool
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.reply({'error': 'not JSON: {!r}'.format(line.decode('utf-8', 'replace').strip())})
+                continue
+            key = {'id': request['id']} if isinstance(request, dict) and 'id' in request else {}
+            cmd = request.get('cmd', 'analyse') if isinstance(request, dict) else 'analyse'
+            if cmd == 'ping':
+                self.reply(dict(key, pong=True))
+            elif cmd == 'stats':
+                self.reply(dict(key, **pool.status()))
+            elif cmd == 'analyse':
+                try:
+                    job = parse_request(request)
+                    priority = request.get('priority', 0)
+                    echo = dict(key, fen=request.get('fen', tools.FEN_INITIAL))
+                    if request.get('moves'):
+                        echo['moves'] = request['moves']
+                    pool.submit(job, self.finish_job(echo),
+                                priority if isinstance(priority, (int, float)) else 0)
+                    self.submitted += 1
+                except ValueError as e:
+                    self.reply(dict(key, error=str(e)))
+                except Exception as e:
+                    # Only this request fails, not the others of the client
+                    self.reply(dict(key, error='{}: {}'.format(type(e).__name__, e)))
+            else:
+                self.reply(dict(key, error='unknown cmd: {!r}'.format(cmd)))
+        # The client may have only shut down its side, so it still gets the
+        # results of the requests it sent
+        for _ in range(self.submitted):
+            self.pending.acquire()
+
+    def finish_job(self, echo):
+        def callback(result):
+            self.reply(dict(echo, **result))
+            self.pending.release()
+        return callback
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(pool, address):
+    ''' A server for the pool, on a (host, port) pair or the path of a Unix socket '''
+    if isinstance(address, str):
+        # A socket file left by a server that is no longer running
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixServer(address, Handler)
+    else:
+        server = TCPServer(address, Handler)
+    server.pool = pool
+    return server
+
+
+class Client:
+    """ A connection to an analysis server. request sends a request and
+    waits for its answer; send and receive let many be in flight. """
+
+    def __init__(self, address):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.file = self.sock.makefile('rwb')
+
+    def send(self, **request):
+        self.file.write((json.dumps(request) + '\n').encode())
+        self.file.flush()
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise EOFError('the server closed the connection')
+        return json.loads(line)
+
+    def request(self, **request):
+        self.send(**request)
+        return self.receive()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve analyses of positions as JSON lines, from a pool of worker processes.')
+    parser.add_argument('--unix', type=str, default=None,
+        help='path of a Unix socket to listen on, rather than a TCP port.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+        help='address to listen on. Default=%(default)s.')
+    parser.add_argument('--port', type=int, default=7701,
+        help='TCP port to listen on. Default=%(default)s.')
+    parser.add_argument('--workers', type=int, default=None,
+        help='number of worker processes. Default is the number of CPUs.')
+    parser.add_argument('--hash', type=int, default=sunfish.TABLE_MB,
+        help='MB of tables per worker. Default=%(default)s.')
+    args = parser.parse_args()
+    address = args.unix or (args.host, args.port)
+    with AnalysisPool(args.workers, args.hash) as pool, make_server(pool, address) as server:
+        print('Serving on {} with {} workers'.format(address, len(pool.workers)), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    if args.unix:
+        os.unlink(args.unix)
+
+
+if __name__ == '__main__':
+    main()
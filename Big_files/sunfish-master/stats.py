@@ -0,0 +1,207 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+import json
+import time
+
+import sunfish
+
+################################################################################
+# Search statistics. StatsSearcher is a Searcher whose bound records what the
+# search does, by looking at the calls it makes to itself and to the tables,
+# so sunfish.Searcher doesn't change and costs nothing extra when we don't
+# want the numbers.
+#
+# A child call tells the node that made it which move it is: a null move is
+# searched three plies shallower than the node, and the move from tp_move is
+# the first other move, if the node had one. The killers and countermoves of
+# the later moves are noted by ordered_moves as it yields them. A node that
+# returns without searching any moves, with the score of the entry it found in
+# the table, was a table cutoff.
+################################################################################
+
+# The counters kept for each iteration
+COUNTERS = ('nodes', 'qnodes', 'mtd_steps', 'tt_probes', 'tt_hits', 'tt_cutoffs',
+            'null_tries', 'null_cutoffs', 'tt_move_tries', 'tt_move_hits',
+            'killer_tries', 'killer_hits', 'countermove_tries', 'countermove_hits',
+            'fail_highs', 'fail_highs_first')
+
+
+class CountingScoreTable(sunfish.ScoreTable):
+    """ A ScoreTable counting the lookups, and remembering the last result """
+    gets = 0
+    last = None
+
+    def get(self, key, default=None):
+        self.gets += 1
+        self.last = super().get(key, default)
+        return self.last
+
+
+class Frame:
+    ''' A node being searched '''
+    __slots__ = ('depth', 'tt_move', 'stage', 'children', 'gets', 'entry', 'probed')
+
+    def __init__(self, depth, tt_move, gets):
+        self.depth, self.tt_move, self.gets = depth, tt_move, gets
+        # 'killer' or 'countermove' for the move ordered_moves yielded last
+        self.stage = None
+        self.children, self.entry, self.probed = 0, None, False
+
+
+class StatsSearcher(sunfish.Searcher):
+    """ A sunfish.Searcher recording statistics of each iteration in
+    self.iterations, a list of dicts with the COUNTERS, nodes_by_ply, and the
+    time the iteration took. """
+
+    def __init__(self, table_mb=sunfish.TABLE_MB):
+        super().__init__(table_mb)
+        self.tp_score = CountingScoreTable(buf=self.tp_score.buf)
+        self.iterations = []
+        self.stack = []
+
+    def new_search(self, history=()):
+        super().new_search(history)
+        self.iterations = []
+        self.stack = []
+        self.start = time.time()
+
+    def _search(self, pos):
+        for depth, move, score in super()._search(pos):
+            self.iterations[-1]['time'] = round(time.time() - self.start, 3)
+            yield depth, move, score
+
+    def bound(self, pos, gamma, depth, root=True):
+        stack, table = self.stack, self.tp_score
+        if not stack:
+            # A new iteration, or another step of the MTD-bi search
+            if not self.iterations or self.iterations[-1]['depth'] != depth:
+                it = dict.fromkeys(COUNTERS, 0)
+                it.update(depth=depth, nodes_by_ply=[])
+                self.iterations.append(it)
+            self.iterations[-1]['mtd_steps'] += 1
+        it = self.iterations[-1]
+        it['nodes'] += 1
+        if depth <= 0:
+            it['qnodes'] += 1
+        by_ply = it['nodes_by_ply']
+        if len(by_ply) <= len(stack):
+            by_ply.append(0)
+        by_ply[len(stack)] += 1
+
+        kind = None
+        if stack:
+            parent = stack[-1]
+            self._probed(parent)
+            if parent.children == 0 and parent.depth > 0 and depth == parent.depth - 3:
+                kind = 'null'
+            else:
+                if parent.tt_move is not None:
+                    kind = 'tt_move'
+                    parent.tt_move = None
+                else:
+                    kind = parent.stage
+                parent.children += 1
+
+        # The move from tp_move, as bound will see it once it gets to the moves
+        tt_move = self.tp_move.get(pos.hash)
+        if tt_move is not None and depth <= 0 and pos.value(tt_move) < sunfish.QS_LIMIT:
+            tt_move = None
+        frame = Frame(max(depth, 0), tt_move, table.gets)
+        stack.append(frame)
+        score = super().bound(pos, gamma, depth, root)
+        stack.pop()
+
+        self._probed(frame)
+        if frame.gets != 0:
+            it['tt_probes'] += 1
+        entry = frame.entry
+        if entry is not None:
+            it['tt_hits'] += 1
+            if frame.children == 0 and (entry.lower >= gamma and score == entry.lower
+                                        or entry.upper < gamma and score == entry.upper):
+                it['tt_cutoffs'] += 1
+        if score >= gamma and depth > 0 and frame.children:
+            it['fail_highs'] += 1
+            if frame.children == 1:
+                it['fail_highs_first'] += 1
+        # The node that called us cuts off if we fail low
+        if kind == 'null':
+            it['null_tries'] += 1
+            it['null_cutoffs'] += score < gamma
+        if kind in ('tt_move', 'killer', 'countermove'):
+            it[kind + '_tries'] += 1
+            it[kind + '_hits'] += score < gamma
+        return score
+
+    def ordered_moves(self, pos, depth, skip=None, prev=None):
+        # The node the moves are for is on top of the stack while they are made
+        frame = self.stack[-1] if self.stack else None
+        killers = self.killers.get(depth, ())
+        countermove = self.countermoves[120*prev[0] + prev[1]] if prev is not None else None
+        for move in super().ordered_moves(pos, depth, skip, prev):
+            if frame is not None:
+                frame.stage = None
+                if move in killers or move == countermove:
+                    if not pos.tactical(move):
+                        frame.stage = 'killer' if move in killers else 'countermove'
+            yield move
+
+    def _probed(self, frame):
+        ''' Notes the table lookups a node made, before it searched any moves '''
+        if frame.probed:
+            return
+        frame.probed = True
+        frame.gets = self.tp_score.gets - frame.gets
+        frame.entry = self.tp_score.last if frame.gets else None
+
+    def profile(self):
+        ''' The statistics of the last search, with totals and rates '''
+        totals = {c: sum(it[c] for it in self.iterations) for c in COUNTERS}
+        by_ply = []
+        for it in self.iterations:
+            by_ply += [0] * (len(it['nodes_by_ply']) - len(by_ply))
+            for ply, n in enumerate(it['nodes_by_ply']):
+                by_ply[ply] += n
+        totals['nodes_by_ply'] = by_ply
+        iterations = [dict(it, **rates(it)) for it in self.iterations]
+        for prev, it in zip(iterations, iterations[1:]):
+            it['branching'] = round(it['nodes'] / max(prev['nodes'], 1), 2)
+        return {'iterations': iterations, 'totals': dict(totals, **rates(totals))}
+
+
+def rates(counts):
+    ''' The rates of interest, as percentages '''
+    pct = lambda a, b: round(100 * a / b, 1) if b else None
+    return {
+        'qnodes_pct': pct(counts['qnodes'], counts['nodes']),
+        'tt_hit_pct': pct(counts['tt_hits'], counts['tt_probes']),
+        'tt_cutoff_pct': pct(counts['tt_cutoffs'], counts['tt_probes']),
+        'null_cutoff_pct': pct(counts['null_cutoffs'], counts['null_tries']),
+        'tt_move_hit_pct': pct(counts['tt_move_hits'], counts['tt_move_tries']),
+        'killer_hit_pct': pct(counts['killer_hits'], counts['killer_tries']),
+        'countermove_hit_pct': pct(counts['countermove_hits'], counts['countermove_tries']),
+        'fail_high_first_pct': pct(counts['fail_highs_first'], counts['fail_highs']),
+    }
+
+
+def info_strings(searcher):
+    ''' UCI info string lines about the last finished iteration '''
+    it = searcher.profile()['iterations'][-1]
+    fmt = lambda v: '-' if v is None else v
+    yield ('info string stats depth {depth} nodes {nodes} qnodes {}% mtd {mtd_steps} ebf {}'
+           ' tthit {}% ttcut {}% nullcut {}% ttmove {}% killer {}% countermove {}%'
+           ' fhfirst {}%'.format(
+               fmt(it['qnodes_pct']), fmt(it.get('branching')), fmt(it['tt_hit_pct']),
+               fmt(it['tt_cutoff_pct']), fmt(it['null_cutoff_pct']), fmt(it['tt_move_hit_pct']),
+               fmt(it['killer_hit_pct']), fmt(it['countermove_hit_pct']),
+               fmt(it['fail_high_first_pct']), **it))
+    yield 'info string stats plies ' + ' '.join(map(str, it['nodes_by_ply']))
+
+
+def write_profile(searcher, path, **extra):
+    ''' Appends the profile of the last search to path, as a JSON line '''
+    with open(path, 'a') as file:
+        file.write(json.dumps(dict(extra, **searcher.profile())) + '\n')
@@ -2,8 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import re, sys, time
-from itertools import count
+import re, sys, time, random
+from itertools import count, takewhile
 from collections import namedtuple
 
 ###############################################################################
@@ -100,6 +100,21 @@ directions = {
     'K': (N, E, S, W, N+E, S+E, S+W, N+W)
 }
 
+# Precomputed move tables, indexed by square. For sliding pieces, the rays of
+# squares in each direction, stopping at the edge of the board. For knights and
+# kings, the squares they can reach. For pawns, the square in front, the square
+# two in front when on the second rank, and the two capture squares.
+on_board = lambda i: 0 < i % 10 < 9 and A8 <= i <= H1
+rays = {p: tuple(tuple(tuple(takewhile(on_board, count(i+d, d)))
+                       for d in directions[p] if on_board(i+d))
+                 for i in range(120))
+        for p in 'BRQ'}
+steps = {p: tuple(tuple(i+d for d in directions[p] if on_board(i+d)) for i in range(120))
+         for p in 'NK'}
+pawn_double = tuple(i+N+N if A1+N <= i <= H1+N else 0 for i in range(120))
+pawn_captures = tuple(tuple(i+d for d in (N+W, N+E) if on_board(i+d)) for i in range(120))
+our_pieces = re.compile('[PNBRQK]')
+
 # Mate value must be greater than 8*queen + 2*(rook+knight+bishop)
 # King value is set to twice this value such that if the opponent is
 # 8 queens up, but we got the king, we still exceed MATE_VALUE.
@@ -108,20 +123,60 @@ directions = {
 MATE_LOWER = piece['K'] - 10*piece['Q']
 MATE_UPPER = piece['K'] + 10*piece['Q']
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e7
+# The size of the transposition tables in megabytes.
+TABLE_MB = 16
+
+# Zobrist keys for hashing positions. The key for an opponent piece is the key
+# of our piece on the mirrored square, with the two 32 bit halves swapped.
+# That way the hash of a rotated position is just the swapped hash, and
+# Position.rotate doesn't have to look at the board.
+swap = lambda h: h >> 32 | (h & 0xffffffff) << 32
+_rand = random.Random(0)
+def _mirrored_keys():
+    keys = [_rand.getrandbits(64) if 0 < i % 10 < 9 else 0 for i in range(60)]
+    return tuple(keys + [swap(keys[119-i]) for i in range(60, 120)])
+zobrist = {p: tuple(_rand.getrandbits(64) if 0 < i % 10 < 9 else 0 for i in range(120))
+           for p in 'PNBRQK'}
+for p in 'PNBRQK':
+    zobrist[p.lower()] = tuple(swap(zobrist[p][119-i]) for i in range(120))
+for p in ' \n.':
+    zobrist[p] = (0,)*120
+# Castling rights and en passant/king passant squares, where 0 means none.
+zobrist_castle = {(a, b): _rand.getrandbits(64) for a in (False, True) for b in (False, True)}
+zobrist_ep, zobrist_kp = _mirrored_keys(), _mirrored_keys()
+
+def zobrist_hash(board, wc, bc, ep, kp):
+    ''' Computes the hash of a position from scratch '''
+    h = zobrist_castle[wc] ^ swap(zobrist_castle[bc]) ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+    for i, p in enumerate(board):
+        h ^= zobrist[p][i]
+    return h
 
 # Constants for tuning search
 QS_LIMIT = 219
 EVAL_ROUGHNESS = 13
 DRAW_TEST = True
 
+# Optional endgame tables, see bitbase.py. A function giving the score of a
+# position, or None if it doesn't know it, and the most pieces it knows about.
+ENDGAME_PROBE = None
+ENDGAME_PIECES = 0
+
+# How often the search checks if it has been stopped
+STOP_NODES = 1024
+
+# The search driver: 'mtd' for the MTD-bi search, or 'pvs' for principal
+# variation search with aspiration windows of ASPIRATION centipawns around
+# the score of the last iteration.
+SEARCH_MODE = 'mtd'
+ASPIRATION = 30
+
 
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+class Position(namedtuple('Position', 'board score wc bc ep kp hash')):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -129,44 +184,57 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    hash - the 64 bit zobrist hash, see zobrist_hash
     """
 
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
-        # as defined in the 'directions' map. The rays are broken e.g. by
-        # captures or immediately in case of pieces such as knights.
-        for i, p in enumerate(self.board):
-            if not p.isupper(): continue
-            for d in directions[p]:
-                for j in count(i+d, d):
-                    q = self.board[j]
-                    # Stay inside the board, and off friendly pieces
-                    if q.isspace() or q.isupper(): break
-                    # Pawn move, double move and capture
-                    if p == 'P' and d in (N, N+N) and q != '.': break
-                    if p == 'P' and d == N+N and (i < A1+N or self.board[i+N] != '.'): break
-                    if p == 'P' and d in (N+W, N+E) and q == '.' \
-                            and j not in (self.ep, self.kp, self.kp-1, self.kp+1): break
-                    # Move it
-                    yield (i, j)
-                    # Stop crawlers from sliding, and sliding after captures
-                    if p in 'PNK' or q.islower(): break
-                    # Castling, by sliding the rook next to the king
-                    if i == A1 and self.board[j+E] == 'K' and self.wc[0]: yield (j+E, j+W)
-                    if i == H1 and self.board[j+W] == 'K' and self.wc[1]: yield (j+W, j+E)
+        # as given by the precomputed tables. The rays are broken e.g. by
+        # captures. Only the squares with our pieces on them are visited.
+        board = self.board
+        for m in our_pieces.finditer(board):
+            i, p = m.start(), m.group()
+            if p == 'P':
+                # Pawn move, double move and capture
+                if board[i+N] == '.':
+                    yield (i, i+N)
+                    j = pawn_double[i]
+                    if j and board[j] == '.':
+                        yield (i, j)
+                for j in pawn_captures[i]:
+                    q = board[j]
+                    if q.islower() or q == '.' and j in (self.ep, self.kp, self.kp-1, self.kp+1):
+                        yield (i, j)
+            elif p in 'NK':
+                for j in steps[p][i]:
+                    if not board[j].isupper():
+                        yield (i, j)
+            else:
+                for ray in rays[p][i]:
+                    for j in ray:
+                        q = board[j]
+                        # Stay off friendly pieces, and stop sliding after captures
+                        if q.isupper(): break
+                        yield (i, j)
+                        if q != '.': break
+                        # Castling, by sliding the rook next to the king
+                        if i == A1 and board[j+E] == 'K' and self.wc[0]: yield (j+E, j+W)
+                        if i == H1 and board[j+W] == 'K' and self.wc[1]: yield (j+W, j+E)
 
     def rotate(self):
         ''' Rotates the board, preserving enpassant '''
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0)
+            119-self.kp if self.kp else 0,
+            swap(self.hash))
 
     def nullmove(self):
         ''' Like rotate, but clears ep and kp '''
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0)
+            self.bc, self.wc, 0, 0,
+            swap(self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]))
 
     def move(self, move):
         i, j = move
@@ -176,9 +244,12 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
         board = self.board
         wc, bc, ep, kp = self.wc, self.bc, 0, 0
         score = self.score + self.value(move)
-        # Actual move
+        # Actual move, the hash is updated along with the board
         board = put(board, j, board[i])
         board = put(board, i, '.')
+        h = self.hash ^ zobrist[q][j] ^ zobrist[p][j] ^ zobrist[p][i]
+        if self.ep or self.kp:
+            h ^= zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
         # Castling rights, we move the rook or capture the opponent's
         if i == A1: wc = (False, wc[1])
         if i == H1: wc = (wc[0], False)
@@ -191,16 +262,66 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                 kp = (i+j)//2
                 board = put(board, A1 if j < i else H1, '.')
                 board = put(board, kp, 'R')
+                h ^= zobrist['R'][A1 if j < i else H1] ^ zobrist['R'][kp]
         # Pawn promotion, double move and en passant capture
         if p == 'P':
             if A8 <= j <= H8:
                 board = put(board, j, 'Q')
+                h ^= zobrist['P'][j] ^ zobrist['Q'][j]
             if j - i == 2*N:
                 ep = i + N
             if j == self.ep:
                 board = put(board, j+S, '.')
+                h ^= zobrist['p'][j+S]
+        if wc != self.wc or bc != self.bc:
+            h ^= zobrist_castle[self.wc] ^ swap(zobrist_castle[self.bc]) \
+                    ^ zobrist_castle[wc] ^ swap(zobrist_castle[bc])
+        if ep or kp:
+            h ^= zobrist_ep[ep] ^ zobrist_kp[kp]
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp).rotate()
+        return Position(board, score, wc, bc, ep, kp, h).rotate()
+
+    def undo(self):
+        ''' Positions don't change, so there is nothing to take back. This lets
+            Searcher work with a board.Board as well, which moves in place. '''
+        pass
+
+    def piece_count(self):
+        ''' The number of pieces of both sides, kings and pawns included '''
+        return 64 - self.board.count('.')
+
+    def nonpawn_material(self):
+        ''' True if the side to move has a piece other than its king and pawns '''
+        return any(c in self.board for c in 'RBNQ')
+
+    def tactical(self, move):
+        ''' Same as tactical(self, self.board, move) '''
+        return tactical(self, self.board, move)
+
+    def split_moves(self, skip=None):
+        ''' The moves, except skip, as a list of the tactical ones, in
+            (gain, -attacker, move) tuples to order them by, and a list of the
+            quiet ones. The gain is the value of the captured piece and of the
+            promotion. '''
+        board = self.board
+        captures, quiets = [], []
+        for move in self.gen_moves():
+            if move == skip:
+                continue
+            if tactical(self, board, move):
+                i, j = move
+                p, q = board[i], board[j]
+                if abs(j - self.kp) < 2:
+                    q = 'K'
+                elif p == 'P' and j == self.ep:
+                    q = 'P'
+                gain = piece.get(q.upper(), 0)
+                if p == 'P' and A8 <= j <= H8:
+                    gain += piece['Q'] - piece['P']
+                captures.append((gain, -piece[p], move))
+            else:
+                quiets.append(move)
+        return captures, quiets
 
     def value(self, move):
         i, j = move
@@ -225,6 +346,32 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                 score += pst['P'][119-(j+S)]
         return score
 
+# The methods above are the reference. Faster ones, with the same results, are
+# in accel.py, which may also be compiled, see there. set_backend chooses.
+REFERENCE = {'gen_moves': Position.gen_moves, 'value': Position.value, 'move': Position.move}
+BACKEND = 'python'
+
+def set_backend(name='auto'):
+    ''' Sets the methods of Position: 'python' for the reference, 'accel' for
+        accel.py, or 'auto' for accel.py if it can be imported. Returns the
+        backend in use, which is 'compiled' if accel.py was. '''
+    global BACKEND
+    methods, BACKEND = REFERENCE, 'python'
+    if name != 'python':
+        try:
+            import accel
+        except ImportError:
+            if name == 'accel':
+                raise
+        else:
+            methods = accel.install(sys.modules[__name__])
+            BACKEND = 'accel' if accel.__file__.endswith('.py') else 'compiled'
+    for key, method in methods.items():
+        setattr(Position, key, method)
+    return BACKEND
+
+set_backend()
+
 ###############################################################################
 # Search logic
 ###############################################################################
@@ -232,18 +379,123 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
 # lower <= s(pos) <= upper
 Entry = namedtuple('Entry', 'lower upper')
 
+class Table:
+    """ A fixed size hash table stored in a flat buffer of 64 bit words.
+    The buffer is allocated up front, so memory use doesn't grow during a game,
+    and nothing is ever thrown away in bulk. New entries just replace old ones
+    in the bucket they hash to. """
+    words = 1 # Number of 64 bit words per bucket
+
+    def __init__(self, mb=0, buf=None):
+        # The table can also be given a buffer, such as shared memory, to live in
+        if buf is None:
+            buf = bytearray(8 * self.words * max(int(mb * (1 << 20)) // (8 * self.words), 1))
+        self.buf = buf
+        self.size = len(buf) // (8 * self.words)
+        self.table = memoryview(buf).cast('Q')
+
+    def clear(self):
+        self.buf[:] = bytes(len(self.buf))
+
+    def hashfull(self):
+        ''' Permill of the first thousand slots in use '''
+        slots = range(min(self.size, 1000))
+        return 1000 * sum(1 for i in slots if self.table[i]) // len(slots)
+
+class ScoreTable(Table):
+    """ Maps (hash, depth, root) to an Entry.
+    Each bucket has two slots, the first is only replaced by a search at least as
+    deep or by any search of a newer age, the second is always replaced. A slot is
+    two words, (key ^ data, data), so an entry torn by a concurrent writer looks
+    like a miss. """
+    words = 4
+    age = 0 # Incremented by every new search, so old entries make way
+
+    def get(self, key, default=None):
+        h, depth, root = key
+        k = (h ^ (2*depth + root) * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+        t, i = self.table, k % self.size * 4
+        data = t[i+1]
+        if t[i] ^ data != k:
+            data = t[i+3]
+            if t[i+2] ^ data != k:
+                return default
+        return Entry((data & 0xfffff) - 0x80000, (data >> 20 & 0xfffff) - 0x80000)
+
+    def __setitem__(self, key, entry):
+        h, depth, root = key
+        k = (h ^ (2*depth + root) * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+        t, i = self.table, k % self.size * 4
+        data = entry.lower + 0x80000 | entry.upper + 0x80000 << 20 \
+                | min(depth, 255) << 40 | self.age << 48
+        old = t[i+1]
+        if t[i] ^ old == k or old >> 48 != self.age or depth >= old >> 40 & 0xff:
+            t[i], t[i+1] = k ^ data, data
+        else:
+            t[i+2], t[i+3] = k ^ data, data
+
+    def hashfull(self):
+        slots = range(1, min(self.size * 4, 2000), 2)
+        return 1000 * sum(1 for i in slots if self.table[i]) // len(slots)
+
+class MoveTable(Table):
+    """ Maps hash to a move. Each slot is a single word holding the high bits of
+    the hash, with the move packed into the low 14 bits. Always replaced. """
+
+    def get(self, h, default=None):
+        w = self.table[h % self.size]
+        if w >> 14 != h >> 14 or not w & 0x3fff:
+            return default
+        return divmod(w & 0x3fff, 120)
+
+    def __setitem__(self, h, move):
+        self.table[h % self.size] = h >> 14 << 14 | (120*move[0] + move[1] if move else 0)
+
+class SearchStopped(Exception):
+    ''' Raised by Searcher.bound when the searcher's stop event is set. A
+        position that is changed in place is left where the search was. '''
+
+
 class Searcher:
-    def __init__(self):
-        self.tp_score = {}
-        self.tp_move = {}
+    """ Searches a Position, or anything else with the same score, hash and
+    board attributes, and gen_moves, value, move, nullmove and undo methods.
+    After searching pos.move(move) or pos.nullmove(), pos.undo() is called, so
+    positions that are changed in place by move get changed back. """
+
+    def __init__(self, table_mb=TABLE_MB):
+        # Moves take half the space of scores, so this gives the same number of slots
+        self.tp_score = ScoreTable(table_mb * 2/3)
+        self.tp_move = MoveTable(table_mb / 3)
+        # Hashes of the positions played in the game, since the last irreversible move
         self.history = set()
+        # Key of the history. The scores are stored under hash ^ rep_key, see bound.
+        self.rep_key = 0
         self.nodes = 0
+        # An event, such as a threading.Event, that another thread may set to
+        # stop the search. It is checked every STOP_NODES nodes.
+        self.stop = None
+        # The search driver, see SEARCH_MODE. The pvs driver keeps the
+        # principal variation of each ply of the current line in pv_table,
+        # and that of the last finished iteration in pv.
+        self.mode = SEARCH_MODE
+        self.pv_table = []
+        self.pv = []
+        # Move ordering, see ordered_moves. Two killers for each depth, and
+        # the history and countermove tables, indexed by 120*i + j for a move
+        # (i, j). The move that led to the node being searched is last_move.
+        self.killers = {}
+        self.history_table = [0] * 14400
+        self.countermoves = [None] * 14400
+        self.last_move = None
 
     def bound(self, pos, gamma, depth, root=True):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)"""
         self.nodes += 1
+        if self.stop is not None and self.nodes % STOP_NODES == 0 and self.stop.is_set():
+            raise SearchStopped()
+        prev = self.last_move
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for
         # calmness, and from this point on there is no difference in behaviour depending on
@@ -265,14 +517,28 @@ class Searcher:
         # FIXME: This is not true, since other positions will be affected by
         # the new values for all the drawn positions.
         if DRAW_TEST:
-            if not root and pos in self.history:
+            if not root and pos.hash in self.history:
                 return 0
 
+        # Positions with few enough pieces may be known from the endgame tables
+        if ENDGAME_PROBE is not None and not root and pos.piece_count() <= ENDGAME_PIECES:
+            score = ENDGAME_PROBE(pos)
+            if score is not None:
+                return score
+
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
+        # The table is kept between searches, but a score is only valid with the
+        # history it was found with: a subtree may run into a position that has
+        # been played since, and is a draw now. So the scores are stored under a
+        # key that includes the history, and only the moves of tp_move are
+        # reused when it changes, as in the next move of a game.
+        key = pos.hash ^ self.rep_key
+        entry = self.tp_score.get((key, depth, root))
+        if entry is None:
+            entry = Entry(-MATE_UPPER, MATE_UPPER)
+        if entry.lower >= gamma and (not root or self.tp_move.get(pos.hash) is not None):
             return entry.lower
         if entry.upper < gamma:
             return entry.upper
@@ -285,8 +551,11 @@ class Searcher:
         def moves():
             # First try not moving at all. We only do this if there is at least one major
             # piece left on the board, since otherwise zugzwangs are too dangerous.
-            if depth > 0 and not root and any(c in pos.board for c in 'RBNQ'):
-                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False)
+            if depth > 0 and not root and pos.nonpawn_material():
+                self.last_move = None
+                score = -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False)
+                pos.undo()
+                yield None, score
             # For QSearch we have a different kind of null-move, namely we can just stop
             # and not capture anythign else.
             if depth == 0:
@@ -295,26 +564,28 @@ class Searcher:
             # Note, we don't have to check for legality, since we've already done it
             # before. Also note that in QS the killer must be a capture, otherwise we
             # will be non deterministic.
-            killer = self.tp_move.get(pos)
+            killer = self.tp_move.get(pos.hash)
             if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
-                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
-            # Then all the other moves
-            for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
-            #for val, move in sorted(((pos.value(move), move) for move in pos.gen_moves()), reverse=True):
-                # If depth == 0 we only try moves with high intrinsic score (captures and
-                # promotions). Otherwise we do all moves.
-                if depth > 0 or pos.value(move) >= QS_LIMIT:
-                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, root=False)
+                self.last_move = killer
+                score = -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
+                pos.undo()
+                yield killer, score
+            # Then all the other moves, in stages
+            for move in self.ordered_moves(pos, depth, killer, prev):
+                self.last_move = move
+                score = -self.bound(pos.move(move), 1-gamma, depth-1, root=False)
+                pos.undo()
+                yield move, score
 
         # Run through the moves, shortcutting when possible
         best = -MATE_UPPER
         for move, score in moves():
             best = max(best, score)
             if best >= gamma:
-                # Clear before setting, so we always have a value
-                if len(self.tp_move) > TABLE_SIZE: self.tp_move.clear()
                 # Save the move for pv construction and killer heuristic
-                self.tp_move[pos] = move
+                self.tp_move[pos.hash] = move
+                if move is not None and depth > 0:
+                    self.note_cutoff(pos, move, depth, prev)
                 break
 
         # Stalemate checking is a bit tricky: Say we failed low, because
@@ -328,29 +599,93 @@ class Searcher:
         # but only if depth == 1, so that's probably fair enough.
         # (Btw, at depth 1 we can also mate without realizing.)
         if best < gamma and best < 0 and depth > 0:
-            is_dead = lambda pos: any(pos.value(m) >= MATE_LOWER for m in pos.gen_moves())
+            def is_dead(pos1):
+                dead = any(pos1.value(m) >= MATE_LOWER for m in pos1.gen_moves())
+                pos.undo()
+                return dead
             if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
                 in_check = is_dead(pos.nullmove())
                 best = -MATE_UPPER if in_check else 0
 
-        # Clear before setting, so we always have a value
-        if len(self.tp_score) > TABLE_SIZE: self.tp_score.clear()
         # Table part 2
         if best >= gamma:
-            self.tp_score[pos, depth, root] = Entry(best, entry.upper)
+            self.tp_score[key, depth, root] = Entry(best, entry.upper)
         if best < gamma:
-            self.tp_score[pos, depth, root] = Entry(entry.lower, best)
+            self.tp_score[key, depth, root] = Entry(entry.lower, best)
 
         return best
 
-    def search(self, pos, history=()):
-        """ Iterative deepening MTD-bi search """
+    def new_search(self, history=()):
+        ''' Prepares for searching a position reached through history, the
+            hashes of the positions played before it. Only the positions
+            since the last irreversible move can come again, so callers may
+            keep just those, see irreversible. '''
         self.nodes = 0
+        self.pv_table, self.pv = [], []
+        # The killers are for this search, the history fades out
+        self.killers = {}
+        self.history_table = [h >> 1 for h in self.history_table]
         if DRAW_TEST:
             self.history = set(history)
-            # print('# Clearing table due to new history')
-            self.tp_score.clear()
+            self.rep_key = 0
+            for h in self.history:
+                self.rep_key ^= h
+        self.tp_score.age = (self.tp_score.age + 1) & 0xff
+
+    def ordered_moves(self, pos, depth, skip=None, prev=None):
+        """ Yields the moves of pos, except skip, in stages: the captures and
+        promotions, most valuable victim first and least valuable attacker
+        next, then the killers of the depth and the countermove of prev, the
+        move that led to pos, and then the other quiet moves by their history.
+        In QS only captures and promotions worth QS_LIMIT are searched. Each
+        stage is only sorted once the search gets to it. """
+        captures, quiets = pos.split_moves(skip)
+        captures.sort(reverse=True)
+        for _, _, move in captures:
+            if depth > 0 or pos.value(move) >= QS_LIMIT:
+                yield move
+        if depth == 0:
+            return
+        candidates = list(self.killers.get(depth, ()))
+        if prev is not None:
+            candidates.append(self.countermoves[120*prev[0] + prev[1]])
+        tried = set()
+        for move in candidates:
+            if move is not None and move not in tried and move in quiets:
+                tried.add(move)
+                yield move
+        history = self.history_table
+        # Sunfish's own values break the ties, such as before anything is known
+        quiets.sort(key=lambda m: (history[120*m[0] + m[1]], pos.value(m)), reverse=True)
+        for move in quiets:
+            if move not in tried:
+                yield move
+
+    def note_cutoff(self, pos, move, depth, prev):
+        ''' Records a move that failed high, for ordered_moves. Only quiet
+            moves count, as the captures are ordered well enough anyway. '''
+        if pos.tactical(move):
+            return
+        killers = self.killers.get(depth, ())
+        if move not in killers:
+            self.killers[depth] = (move,) + killers[:1]
+        self.history_table[120*move[0] + move[1]] += depth * depth
+        if prev is not None:
+            self.countermoves[120*prev[0] + prev[1]] = move
 
+    def search(self, pos, history=()):
+        """ Iterative deepening MTD-bi or PV search, depending on self.mode.
+        Ends early if stopped. """
+        self.new_search(history)
+        try:
+            if self.mode == 'pvs':
+                yield from self._search_pvs(pos)
+            else:
+                yield from self._search(pos)
+        except SearchStopped:
+            return
+
+    def _search(self, pos):
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
         for depth in range(1, 1000):
@@ -368,10 +703,135 @@ class Searcher:
                     upper = score
             # We want to make sure the move to play hasn't been kicked out of the table,
             # So we make another call that must always fail high and thus produce a move.
-            self.bound(pos, lower, depth)
+            score = self.bound(pos, lower, depth)
             # If the game hasn't finished we can retrieve our move from the
             # transposition table.
-            yield depth, self.tp_move.get(pos), self.tp_score.get((pos, depth, True)).lower
+            yield depth, self.tp_move.get(pos.hash), score
+
+    def pvs(self, pos, alpha, beta, depth, ply=0):
+        """ Principal variation search of a node expected to score inside
+        the window alpha < s(pos) < beta. Returns r where
+                s(pos) <= r <= alpha    if s(pos) <= alpha
+                r = s(pos)              if alpha < s(pos) < beta
+                beta <= r <= s(pos)     if s(pos) >= beta
+        and leaves the moves leading to r in self.pv_table[ply]. Only the
+        first move gets the window. The others are tested with bound, and
+        searched again only if they turn out to be better. """
+        self.nodes += 1
+        if self.stop is not None and self.nodes % STOP_NODES == 0 and self.stop.is_set():
+            raise SearchStopped()
+        depth, root, prev = max(depth, 0), ply == 0, self.last_move
+        if ply == len(self.pv_table):
+            self.pv_table.append([])
+        self.pv_table[ply] = []
+
+        # The same tests as in bound. The table is not used to cut off, since
+        # we want the PV, but it is kept up to date for bound.
+        if pos.score <= -MATE_LOWER:
+            return -MATE_UPPER
+        if DRAW_TEST and not root and pos.hash in self.history:
+            return 0
+        if ENDGAME_PROBE is not None and not root and pos.piece_count() <= ENDGAME_PIECES:
+            score = ENDGAME_PROBE(pos)
+            if score is not None:
+                return score
+
+        # The move of the last search first, then as in bound. In QS standing
+        # pat is the first move.
+        moves = list(self.ordered_moves(pos, depth, prev=prev))
+        killer = self.tp_move.get(pos.hash)
+        if killer in moves:
+            moves.remove(killer)
+            moves.insert(0, killer)
+        best, best_move, lower = -MATE_UPPER, None, alpha
+        if depth == 0:
+            best = pos.score
+            alpha = max(alpha, best)
+
+        for n, move in enumerate(moves):
+            if alpha >= beta:
+                break
+            first = n == 0 and depth > 0
+            if not first:
+                self.last_move = move
+                score = -self.bound(pos.move(move), -alpha, depth-1, root=False)
+                pos.undo()
+            if first or alpha < score < beta:
+                self.last_move = move
+                score = -self.pvs(pos.move(move), -beta, -alpha, depth-1, ply+1)
+                pos.undo()
+                line = self.pv_table[ply+1]
+            else: line = []
+            best = max(best, score)
+            if score > alpha:
+                alpha, best_move = score, move
+                self.pv_table[ply] = [move] + line
+                if alpha >= beta and depth > 0:
+                    self.note_cutoff(pos, move, depth, prev)
+
+        # Mated or stalemated, see bound
+        if best < beta and best < 0 and depth > 0:
+            def is_dead(pos1):
+                dead = any(pos1.value(m) >= MATE_LOWER for m in pos1.gen_moves())
+                pos.undo()
+                return dead
+            if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
+                in_check = is_dead(pos.nullmove())
+                best = -MATE_UPPER if in_check else 0
+                best_move, self.pv_table[ply] = None, []
+
+        key = pos.hash ^ self.rep_key
+        if best >= beta:
+            self.tp_score[key, depth, root] = Entry(best, MATE_UPPER)
+        elif best <= lower:
+            self.tp_score[key, depth, root] = Entry(-MATE_UPPER, best)
+        else:
+            self.tp_score[key, depth, root] = Entry(best, best)
+        if best_move is not None:
+            self.tp_move[pos.hash] = best_move
+        return best
+
+    def _search_pvs(self, pos):
+        score = None
+        for depth in range(1, 1000):
+            # Aspiration: a window around the last score, widened on the side
+            # the score falls out of, until the score is inside it.
+            delta = ASPIRATION
+            if score is None:
+                lower, upper = -MATE_UPPER, MATE_UPPER
+            else:
+                lower, upper = max(score - delta, -MATE_UPPER), min(score + delta, MATE_UPPER)
+            while True:
+                score = self.pvs(pos, lower, upper, depth)
+                delta *= 2
+                if -MATE_UPPER < lower and score <= lower:
+                    lower = max(score - delta, -MATE_UPPER)
+                elif score >= upper and upper < MATE_UPPER:
+                    upper = min(score + delta, MATE_UPPER)
+                else:
+                    break
+            self.pv = list(self.pv_table[0])
+            yield depth, (self.pv[0] if self.pv else None), score
+
+    def entry(self, pos, depth, root=True):
+        ''' Looks up the score bounds of pos, wherever they are stored '''
+        return self.tp_score.get((pos.hash ^ self.rep_key, depth, root))
+
+
+def tactical(pos, board, move):
+    ''' True if the move captures, including the king after illegal castling,
+        or promotes, board being pos.board '''
+    i, j = move
+    return board[j] != '.' or abs(j - pos.kp) < 2 \
+        or board[i] == 'P' and (j == pos.ep or A8 <= j <= H8)
+
+
+def irreversible(pos, move):
+    ''' True if no position before the move can come again after it, since it
+        moves a pawn or captures. Losing castling rights is irreversible too,
+        but positions with other rights have other hashes anyway. '''
+    i, j = move
+    return pos.board[i] == 'P' or pos.board[j] != '.'
 
 
 ###############################################################################
@@ -403,7 +863,10 @@ def print_pos(pos):
 
 
 def main():
-    hist = [Position(initial, 0, (True,True), (True,True), 0, 0)]
+    hist = [Position(initial, 0, (True,True), (True,True), 0, 0,
+                     zobrist_hash(initial, (True,True), (True,True), 0, 0))]
+    # Hashes of the positions since the last irreversible move, for the draw test
+    reps = [hist[-1].hash]
     searcher = Searcher()
     while True:
         print_pos(hist[-1])
@@ -421,7 +884,10 @@ def main():
             else:
                 # Inform the user when invalid input (e.g. "help") is entered
                 print("Please enter a move like g8f6")
+        if irreversible(hist[-1], move):
+            del reps[:]
         hist.append(hist[-1].move(move))
+        reps.append(hist[-1].hash)
 
         # After our move we rotate the board and print it again.
         # This allows us to see the effect of our move.
@@ -433,7 +899,7 @@ def main():
 
         # Fire up the engine to look for a move.
         start = time.time()
-        for _depth, move, score in searcher.search(hist[-1], hist):
+        for _depth, move, score in searcher.search(hist[-1], reps):
             if time.time() - start > 1:
                 break
 
@@ -443,7 +909,10 @@ def main():
         # The black player moves from a rotated position, so we have to
         # 'back rotate' the move before printing it.
         print("My move:", render(119-move[0]) + render(119-move[1]))
+        if irreversible(hist[-1], move):
+            del reps[:]
         hist.append(hist[-1].move(move))
+        reps.append(hist[-1].hash)
 
 
 if __name__ == '__main__':
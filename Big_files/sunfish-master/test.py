@@ -10,17 +10,34 @@ import subprocess
 import signal
 import argparse
 import importlib
+import importlib.util
 import itertools
+import json
+import math
 import multiprocessing
 import random
+import tempfile
+import threading
 import unittest
 import warnings
 import chess
 import chess.engine
+import chess.polyglot
+import numpy as np
 import pathlib
 
 import sunfish
 import tools
+import parallel
+import perft
+import board
+import bitbase
+import database
+import timeman
+import analysis
+import server
+import stats
+import tune
 
 ###############################################################################
 # Playing test
@@ -44,7 +61,7 @@ class Tests(unittest.TestCase):
                     + repr(pos))
 
     def test_fen2(self):
-        initial = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+        initial = tools.parseFEN(tools.FEN_INITIAL)
         for pos in tools.flatten_tree(tools.expand_position(initial),3):
             fen = tools.renderFEN(pos)
             self.assertEqual(fen.split()[1], 'wb'[tools.get_color(pos)], "Didn't read color correctly")
@@ -63,6 +80,28 @@ class Tests(unittest.TestCase):
         success = allperft(open(self.perft_file), depth=2, verbose=False)
         self.assertTrue(success)
 
+    def test_perft_divide(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        table = perft.PerftTable(1)
+        splits = perft.divide(pos, 3)
+        self.assertEqual(len(splits), 20)
+        self.assertEqual(sum(count for _, count in splits), 8902)
+        self.assertEqual(perft.perft(pos, 3, table), 8902)
+        # Now from the table
+        self.assertEqual(perft.perft(pos, 3, table), 8902)
+        pool = perft.new_pool(2)
+        self.assertEqual(perft.divide(pos, 3, pool), splits)
+        pool.close()
+
+    def test_can_kill_king(self):
+        path = os.path.join(os.path.dirname(__file__), 'tests/queen.fen')
+        for line in open(path):
+            pos = tools.parseFEN(line.split(';')[0])
+            for pos1 in tools.flatten_tree(tools.expand_position(pos), 2):
+                for move in pos1.gen_moves():
+                    pos2 = pos1.move(move)
+                    self.assertEqual(perft.can_kill_king(pos2), tools.can_kill_king(pos2))
+
     def test_san(self):
         pgn_file = os.path.join(os.path.dirname(__file__), 'tests/pgns.pgn')
         for line in open(pgn_file):
@@ -103,6 +142,529 @@ class Tests(unittest.TestCase):
                 if p.islower(): score -= sunfish.pst[p.upper()][119-i]
             self.assertEqual(pos.rotate().score, score)
 
+    def test_hash(self):
+        for pos in self.positions:
+            self.assertEqual(pos.hash, sunfish.zobrist_hash(pos.board, pos.wc, pos.bc, pos.ep, pos.kp))
+            rot = pos.rotate()
+            self.assertEqual(rot.hash, sunfish.zobrist_hash(rot.board, rot.wc, rot.bc, rot.ep, rot.kp))
+            null = pos.nullmove()
+            self.assertEqual(null.hash, sunfish.zobrist_hash(null.board, null.wc, null.bc, 0, 0))
+
+    def test_irreversible(self):
+        # Moves that are not irreversible don't capture or promote
+        for pos in self.positions:
+            for move in pos.gen_moves():
+                if not sunfish.irreversible(pos, move):
+                    pos1 = pos.move(move)
+                    self.assertEqual(sorted(pos.board.swapcase()), sorted(pos1.board))
+
+    def test_polyglot_key(self):
+        self.assertEqual(tools.polyglot_key(tools.parseFEN(tools.FEN_INITIAL)), 0x463b96181691fc9c)
+        for pos in self.positions:
+            fen = tools.renderFEN(pos)
+            self.assertEqual(tools.polyglot_key(pos), chess.polyglot.zobrist_hash(chess.Board(fen)), fen)
+
+    def test_book(self):
+        path = os.path.join(os.path.dirname(__file__), 'tests/pgns.pgn')
+        with tempfile.TemporaryDirectory() as tmp:
+            book_path = os.path.join(tmp, 'book.bin')
+            tools.build_book([path], book_path, plies=8)
+            book = tools.Book(book_path)
+            with chess.polyglot.open_reader(book_path) as reader:
+                for msans in itertools.islice(tools.read_movetexts(open(path)), 20):
+                    pos, cboard = tools.parseFEN(tools.FEN_INITIAL), chess.Board()
+                    for msan in msans[:8]:
+                        moves = sorted((tools.mrender(pos, m), w) for m, w in book.moves(pos))
+                        self.assertEqual(moves, sorted((e.move.uci(), e.weight) for e in reader.find_all(cboard)))
+                        self.assertIn(book.choose(pos), pos.gen_moves())
+                        pos = pos.move(tools.parseSAN(pos, msan))
+                        cboard.push_san(msan)
+                    # Out of the book
+                    self.assertIsNone(book.choose(pos))
+            book.close()
+
+    def test_read_games(self):
+        pgn = ('[Event "?"]\n\n'
+               '1.e4 e5 {a comment\n over two lines, 2. d4} 2.Nf3 $1 (2.f4 exf4 (2...d5) 3.Nf3)\n'
+               '2...Nc6 ; the rest of the line 3. Bb5\n'
+               '3...a6! 1-0\n\n'
+               '[Event "?"]\n\n1. d4 d5 *\n')
+        games = [(['e4', 'e5', 'Nf3', 'Nc6', 'a6!'], '1-0'), (['d4', 'd5'], '*')]
+        self.assertEqual(list(tools.read_games(pgn.splitlines())), games)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'games.pgn')
+            with open(path, 'w') as file:
+                file.write(pgn)
+            with database.Database(path) as db:
+                self.assertEqual(list(db), games)
+
+    def test_database(self):
+        pgns = os.path.join(os.path.dirname(__file__), 'tests/pgns.pgn')
+        fold = os.path.join(os.path.dirname(__file__), 'tests/3fold_dont.pgn')
+        with tempfile.TemporaryDirectory() as tmp:
+            for path in (pgns, fold):
+                index_path = os.path.join(tmp, os.path.basename(path) + '.idx')
+                with database.Database(path, index_path=index_path) as db:
+                    games = list(tools.read_games(open(path)))
+                    self.assertEqual(list(db), games)
+                    self.assertEqual(db[-1], games[-1])
+                    indices = random.Random(0).sample(range(len(games)), 3)
+                    self.assertEqual(db.sample(3, random.Random(0)), [games[i] for i in indices])
+                # The index is saved, and used the next time
+                with database.Database(path, index_path=index_path) as db:
+                    self.assertIsNotNone(db.load_index())
+                    self.assertEqual(len(db), len(games))
+            # A changed file is indexed again
+            path = os.path.join(tmp, 'games.pgn')
+            with open(path, 'w') as file:
+                file.write(open(pgns).readline())
+            with database.Database(path) as db:
+                self.assertEqual(len(db), 1)
+            with open(path, 'a') as file:
+                file.write('[Event "?"]\n\n1. e4 {a comment} e5 2. Nf3\n\n1. d4 d5 *\n')
+            with database.Database(path) as db:
+                self.assertEqual(list(db), list(tools.read_games(open(path))))
+                self.assertEqual(len(db), 3)
+                # Replaying on a pool of processes, or not
+                moves = [database.parse_game(msans) for msans, _ in db]
+                self.assertEqual([m for m, _ in database.replay(db, processes=1)], moves)
+                self.assertEqual([m for m, _ in database.replay(db, processes=2)], moves)
+                self.assertEqual([len(m) for m in moves[1:]], [3, 2])
+        openings = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
+        with tempfile.TemporaryDirectory() as tmp:
+            with database.Database(openings, index_path=os.path.join(tmp, 'idx')) as db:
+                lines = list(open(openings))
+                self.assertEqual(len(db), len(lines))
+                for fen, _ in db.sample(20):
+                    self.assertIn(fen + '\n', lines)
+
+    def test_bitbase(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bitbase.generate_all(tmp, verbose=False)
+            bitbases = bitbase.Bitbases(tmp)
+            probe = lambda fen: bitbases.probe(tools.parseFEN(fen))
+            # The square rule and a rook pawn with the king in front
+            self.assertGreater(probe('8/8/8/8/8/8/4P3/4K2k w - - 0 1'), bitbase.KNOWN_WIN)
+            self.assertLess(probe('8/8/8/8/8/8/4P3/4K2k b - - 0 1'), -bitbase.KNOWN_WIN)
+            self.assertEqual(probe('k7/8/8/8/8/8/P7/K7 w - - 0 1'), 0)
+            self.assertEqual(probe('k7/p7/8/8/8/8/8/K7 b - - 0 1'), 0)
+            # Kings only, a hanging rook, and wins that are left to the search
+            self.assertEqual(probe('8/8/8/8/8/8/8/K6k w - - 0 1'), 0)
+            self.assertEqual(probe('8/8/8/8/8/8/r7/K6k w - - 0 1'), 0)
+            self.assertIsNone(probe('8/8/8/8/8/8/8/KR5k w - - 0 1'))
+            self.assertIsNone(probe('8/8/8/8/8/3k4/8/KQ6 b - - 0 1'))
+            # Positions where the king can be taken are left to the search
+            self.assertIsNone(probe('8/8/8/8/8/8/1k6/KR6 w - - 0 1'))
+            # Another version of sunfish gets its own probe
+            other = argparse.Namespace(ENDGAME_PROBE=None, ENDGAME_PIECES=0)
+            bitbase.install(bitbases, other)
+            self.assertEqual(other.ENDGAME_PIECES, bitbases.pieces)
+            self.assertIsNone(sunfish.ENDGAME_PROBE)
+            # The search uses them, and finds the winning move
+            try:
+                bitbase.install(bitbases)
+                pos = tools.parseFEN('8/8/8/2P4K/4k3/8/8/8 w - - 0 1')
+                move, _, _ = tools.search(sunfish.Searcher(), pos, secs=.5)
+                self.assertEqual(tools.mrender(pos, move), 'c5c6')
+            finally:
+                bitbase.install(bitbase.Bitbases(os.path.join(tmp, 'none')))
+            bitbases.close()
+
+    def test_kept_table(self):
+        # Scores are only reused with the same history. A position played
+        # since may be reached again in the tree, and be a draw now.
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher()
+        for depth, move, score in searcher.search(pos, [pos.hash]):
+            if depth == 3:
+                break
+        self.assertIsNotNone(searcher.entry(pos, 3))
+        searcher.new_search([pos.hash])
+        self.assertIsNotNone(searcher.entry(pos, 3))
+        # After Nf3 Nf6 Ng1 Ng8, a cycle through the new positions is a draw
+        history, cycle = [pos.hash], pos
+        for msan in ('Nf3', 'Nf6', 'Ng1'):
+            cycle = cycle.move(tools.parseSAN(cycle, msan))
+            history.append(cycle.hash)
+        searcher.new_search(history)
+        self.assertIsNone(searcher.entry(pos, 3))
+        # The moves are still there to start from
+        self.assertEqual(searcher.tp_move.get(pos.hash), move)
+
+    def test_stop(self):
+        searcher = sunfish.Searcher()
+        searcher.stop = threading.Event()
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        threading.Timer(.2, searcher.stop.set).start()
+        start = time.time()
+        depths = [depth for depth, _, _ in searcher.search(pos)]
+        self.assertLess(time.time() - start, 2)
+        self.assertLess(depths[-1], 999)
+        self.assertIsNotNone(searcher.tp_move.get(pos.hash))
+
+    def test_parallel(self):
+        # Searches right after each other, the helpers stop when a search ends
+        searcher = parallel.ParallelSearcher(table_mb=1, threads=2)
+        try:
+            for fen in (tools.FEN_INITIAL, tools.FEN_INITIAL, open(self.perft_file).readline().split(';')[0]):
+                pos = tools.parseFEN(fen)
+                for depth, move, score in searcher.search(pos):
+                    self.assertEqual(parallel.Stopped(searcher.generation, searcher.search_id).is_set(), False)
+                    if depth >= 3:
+                        break
+                self.assertIn(move, pos.gen_moves())
+                # Ending the search moves the counter on, and it never goes back
+                self.assertTrue(parallel.Stopped(searcher.generation, searcher.search_id).is_set())
+                self.assertGreater(searcher.generation.value, searcher.search_id)
+            # A stop that came before the search started is kept
+            searcher.stop.set()
+            start = time.time()
+            depths = [depth for depth, _, _ in searcher.search(pos)]
+            self.assertLess(time.time() - start, 2)
+            self.assertLess(depths[-1] if depths else 0, 999)
+        finally:
+            searcher.close()
+
+    def test_timeman(self):
+        manager = timeman.TimeManager.from_clock(60, 1)
+        self.assertLess(manager.target, manager.maximum)
+        self.assertLess(manager.maximum, 30)
+        # Never more than we have, even with a large increment
+        manager = timeman.TimeManager.from_clock(1, 5, movestogo=1)
+        self.assertLessEqual(manager.maximum, .5)
+        # Iterations growing by a factor 3, at 1000 nodes per second
+        manager = timeman.TimeManager(10)
+        manager.start -= 4
+        manager.iterations = [(100, .1), (400, .4), (1300, 1.3), (4000, 4)]
+        self.assertAlmostEqual(manager.branching(), 3)
+        self.assertAlmostEqual(manager.predict(), 8.1)
+        # The same, pondering until a ponderhit at 1500 nodes. The nodes and
+        # time of the pondering don't count for the speed, only for the sizes
+        # of the iterations.
+        manager = timeman.TimeManager(10)
+        for nodes in (100, 400, 1300):
+            manager.start = time.time() - nodes / 1000
+            manager.update(nodes, (1, 2))
+        manager.restart(1500)
+        manager.start -= 2.5
+        manager.update(4000, (1, 2))
+        self.assertAlmostEqual(manager.branching(), 3)
+        self.assertAlmostEqual(manager.predict(), 8.1, places=1)
+        self.assertTrue(manager.stop())
+        manager.target, manager.maximum = 20, 40
+        self.assertFalse(manager.stop())
+        # A change of the best move gives more time
+        manager.update(4000, (1, 2))
+        manager.update(4000, (3, 4))
+        self.assertGreater(manager.soft_limit(), manager.target)
+        # Searching stops in time, and gives a move
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher()
+        searcher.stop = threading.Event()
+        start = time.time()
+        move, _, _ = timeman.search(searcher, pos, timeman.TimeManager(.2, .5))
+        self.assertLess(time.time() - start, 1)
+        self.assertIn(move, pos.gen_moves())
+
+    def test_multipv(self):
+        path = os.path.join(os.path.dirname(__file__), 'tests/mate1.fen')
+        fens = [line for line in open(path) if line.strip()][:3]
+        pos = tools.parseFEN(fens[0])
+        result = analysis.analyse(sunfish.Searcher(), pos, 3, depth=3)
+        lines = result['lines']
+        self.assertEqual(result['depth'], 3)
+        self.assertEqual(len({line['move'] for line in lines}), 3)
+        self.assertGreaterEqual(lines[0]['score'], sunfish.MATE_LOWER)
+        self.assertEqual([line['score'] for line in lines],
+                         sorted((line['score'] for line in lines), reverse=True))
+        for line in lines:
+            self.assertEqual(line['pv'][0], line['move'])
+        # Batch analysis, resumed after the last line was cut off
+        with tempfile.TemporaryDirectory() as tmp:
+            epd, out = os.path.join(tmp, 'in.fen'), os.path.join(tmp, 'out.jsonl')
+            with open(epd, 'w') as file:
+                file.writelines(fens)
+            with open(epd) as file:
+                self.assertEqual(analysis.analyse_file(file, out, 2, depth=2, processes=2), 3)
+            with open(out) as file:
+                data = file.read()
+            with open(out, 'w') as file:
+                file.write(data[:-10])
+            with open(epd) as file:
+                self.assertEqual(analysis.analyse_file(file, out, 2, depth=2, processes=2), 1)
+            with open(out) as file:
+                results = [json.loads(line) for line in file]
+            self.assertEqual(sorted(r['line'] for r in results), [0, 1, 2])
+            for r in results:
+                self.assertEqual(r['fen'], fens[r['line']].strip())
+
+    def test_suite_job(self):
+        # A mate in one, and a best move found at once
+        fen = open(os.path.join(os.path.dirname(__file__), 'tests/mate1.fen')).readline().strip()
+        _, _, result = suite_job(('sunfish', 0, fen, {}, None, 1000))
+        self.assertTrue(result['solved'])
+        self.assertGreaterEqual(result['nodes'], 1000)
+        self.assertLessEqual(result['solve_nodes'], result['nodes'])
+        fen = '1k1r4/pp1b1R2/3q2pp/4p3/2B5/4Q3/PPP2B2/2K5 b - - 0 1'
+        _, _, result = suite_job(('sunfish', 0, fen, {'am': 'Qd1+'}, None, 100))
+        self.assertTrue(result['solved'])
+        self.assertEqual(result['solve_depth'], 1)
+        # The limits stop the search inside an iteration
+        _, _, result = suite_job(('sunfish', 0, tools.FEN_INITIAL, {}, None, 20000))
+        self.assertGreaterEqual(result['nodes'], 20000)
+        self.assertLessEqual(result['nodes'], 20000 + sunfish.STOP_NODES)
+        _, _, result = suite_job(('sunfish', 0, tools.FEN_INITIAL, {}, .5, None))
+        self.assertLess(result['time'], 1)
+
+    def test_sprt_stats(self):
+        self.assertAlmostEqual(score_elo(elo_score(50)), 50)
+        llr, elo, (lo, hi) = sprt_stats(100, 100, 100, 0, 10)
+        self.assertAlmostEqual(elo, 0)
+        self.assertLess(llr, 0)
+        self.assertAlmostEqual(lo, -hi)
+        # More games, tighter bounds and more evidence
+        llr1, _, (lo1, _) = sprt_stats(1000, 1000, 1000, 0, 10)
+        self.assertLess(llr1, llr)
+        self.assertGreater(lo1, lo)
+        llr, elo, (lo, hi) = sprt_stats(1200, 1000, 800, 0, 10)
+        self.assertGreater(llr, math.log(.95/.05))
+        self.assertLess(lo, elo)
+        self.assertLess(elo, hi)
+
+    def test_sprt_checkpoint(self):
+        # Games played with other settings are not counted with the new ones
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'sprt.json')
+            with open(path, 'w') as file:
+                json.dump({'version1': 'sunfish.py', 'version2': 'sunfish.py', 'secs': 1, 'plus': 0,
+                           'timeman': False, 'seed': 1, 'results': {'0': [1, 0, 0]}}, file)
+            with self.assertRaisesRegex(ValueError, 'secs=1, not 2'):
+                sprt('sunfish.py', 'sunfish.py', 0, 10, .05, .05, 2, 0, checkpoint=path)
+
+    def test_stats(self):
+        fen = 'r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'
+        pos = tools.parseFEN(fen)
+        plain, counted = sunfish.Searcher(), stats.StatsSearcher()
+        # The statistics don't change the search
+        for (d, m, s), (d1, m1, s1) in zip(plain.search(pos), counted.search(pos)):
+            self.assertEqual((d, m, s, plain.nodes), (d1, m1, s1, counted.nodes))
+            if d == 4:
+                break
+        profile = counted.profile()
+        totals = profile['totals']
+        self.assertEqual(totals['nodes'], counted.nodes)
+        self.assertEqual(sum(totals['nodes_by_ply']), counted.nodes)
+        self.assertEqual([it['depth'] for it in profile['iterations']], [1, 2, 3, 4])
+        self.assertLessEqual(totals['tt_cutoffs'], totals['tt_hits'])
+        self.assertLess(totals['tt_hits'], totals['tt_probes'])
+        self.assertLessEqual(totals['null_cutoffs'], totals['null_tries'])
+        for kind in ('tt_move', 'killer', 'countermove'):
+            self.assertLessEqual(totals[kind + '_hits'], totals[kind + '_tries'])
+            self.assertGreater(totals[kind + '_tries'], 0)
+        self.assertGreater(totals['null_tries'], 0)
+        lines = list(stats.info_strings(counted))
+        self.assertTrue(lines[0].startswith('info string stats depth 4 '))
+
+    def test_tune(self):
+        results = [random.choice((0, .5, 1)) for _ in self.positions]
+        data = tune.encode(zip(self.positions, results))
+        params = tune.initial_params()
+        # The features give sunfish's own scores
+        self.assertEqual(list(data.scores(params)), [pos.score for pos in self.positions])
+        # The gradient, against finite differences
+        _, grad = data.gradient(params, .5)
+        for j in (10, 70, 200, 300):
+            step = np.zeros_like(params)
+            step[j] = 1e-3
+            diff = (data.error(params + step, .5) - data.error(params - step, .5)) / 2e-3
+            self.assertAlmostEqual(diff, grad[j])
+        train, validation = data.split(.25)
+        self.assertEqual(train.size + validation.size, data.size)
+        self.assertEqual(list(validation.scores(params)), list(data.scores(params)[train.size:]))
+        tuned = tune.tune(train, params, .5, epochs=20, verbose=False)
+        self.assertLess(train.error(tuned, .5), train.error(params, .5))
+        # The written module has the same tables
+        module = {}
+        exec(tune.render_module(params), module)
+        for p in 'NBRQ':
+            self.assertEqual(module['pst'][p], sunfish.pst[p])
+
+    def test_board(self):
+        for pos in self.positions:
+            b = board.Board(pos)
+            self.assertEqual(b.position(), pos)
+            moves = b.gen_moves()
+            self.assertEqual(sorted(moves), sorted(pos.gen_moves()))
+            for move in moves:
+                self.assertEqual(b.value(move), pos.value(move))
+                self.assertEqual(b.tactical(move), pos.tactical(move))
+                self.assertEqual(b.move(move).position(), pos.move(move))
+                # The counts kept along with the board
+                after = pos.move(move)
+                self.assertEqual(b.piece_count(), after.piece_count())
+                self.assertEqual(b.nonpawn_material(), after.nonpawn_material())
+                self.assertEqual([sorted(ms) for ms in b.split_moves()],
+                                 [sorted(ms) for ms in after.split_moves()])
+                self.assertEqual(b.nullmove().position(), pos.move(move).nullmove())
+                b.undo()
+                b.undo()
+                self.assertEqual(b.position(), pos)
+        # Searching a board leaves it as it was
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        b = board.Board(pos)
+        for depth, move, score in sunfish.Searcher().search(b):
+            if depth == 4:
+                break
+        self.assertIn(move, pos.gen_moves())
+        self.assertEqual(b.position(), pos)
+        self.assertEqual(b.stack, [])
+
+    def test_ordered_moves(self):
+        searcher = sunfish.Searcher()
+        for pos in self.positions:
+            moves = list(pos.gen_moves())
+            skip = random.choice(moves) if moves else None
+            ordered = list(searcher.ordered_moves(pos, 1, skip))
+            self.assertEqual(sorted(ordered), sorted(m for m in moves if m != skip))
+            # Captures and promotions first
+            kinds = [sunfish.tactical(pos, pos.board, m) for m in ordered]
+            self.assertEqual(kinds, sorted(kinds, reverse=True))
+            # QS searches the same moves as before, captures worth QS_LIMIT
+            self.assertEqual(sorted(searcher.ordered_moves(pos, 0)),
+                             sorted(m for m in moves if pos.value(m) >= sunfish.QS_LIMIT))
+        # A quiet move that failed high comes first among the quiet moves
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        move = tools.parseSAN(pos, 'h3')
+        searcher.note_cutoff(pos, move, 3, None)
+        self.assertEqual(next(searcher.ordered_moves(pos, 3)), move)
+        self.assertEqual(next(searcher.ordered_moves(pos, 2)), move)
+
+    def test_pvs(self):
+        path = os.path.join(os.path.dirname(__file__), 'tests/mate2.fen')
+        for line in itertools.islice(open(path), 10):
+            pos = tools.parseFEN(tools.parseEPD(line)[0])
+            searcher = sunfish.Searcher()
+            searcher.mode = 'pvs'
+            for depth, move, score in searcher.search(pos):
+                # The PV starts with the move, and is a line of legal moves
+                self.assertEqual(searcher.pv[0], move)
+                pos1 = pos
+                for move1 in searcher.pv:
+                    self.assertIn(move1, pos1.gen_moves())
+                    pos1 = pos1.move(move1)
+                if score >= sunfish.MATE_LOWER:
+                    break
+            self.assertLessEqual(depth, 4, line)
+        # A board gives the same search, and is left as it was
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searches = []
+        for p in (pos, board.Board(pos)):
+            searcher = sunfish.Searcher()
+            searcher.mode = 'pvs'
+            for depth, move, score in searcher.search(p):
+                if depth == 4:
+                    break
+            searches.append((move, score, searcher.nodes, searcher.pv))
+        self.assertEqual(searches[0], searches[1])
+        self.assertEqual(p.stack, [])
+
+    def test_backends(self):
+        # Each backend gives the same moves, values, positions, perft counts
+        # and searches as the reference methods
+        results = {}
+        try:
+            for backend in ('python', 'accel'):
+                sunfish.set_backend(backend)
+                moves = [list(pos.gen_moves()) for pos in self.positions]
+                values = [[pos.value(m) for m in ms] for pos, ms in zip(self.positions, moves)]
+                children = [[pos.move(m) for m in ms] for pos, ms in zip(self.positions, moves)]
+                counts = [perft.perft(tools.parseFEN(tools.parseEPD(line)[0]), 2)
+                          for line in open(self.perft_file)]
+                searcher = sunfish.Searcher()
+                for depth, move, score in searcher.search(tools.parseFEN(tools.FEN_INITIAL)):
+                    if depth == 4:
+                        break
+                results[backend] = (moves, values, children, counts, move, score, searcher.nodes)
+                self.assertTrue(allperft(open(self.perft_file), depth=2, verbose=False))
+        finally:
+            sunfish.set_backend()
+        self.assertEqual(results['python'], results['accel'])
+        # Another version of sunfish imported alongside has its own tables
+        source = open(sunfish.__file__).read().replace("'P': 100,", "'P': 500,")
+        self.assertIn("'P': 500,", source)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sunfish_pawns.py')
+            with open(path, 'w') as file:
+                file.write(source)
+            spec = importlib.util.spec_from_file_location('sunfish_pawns', path)
+            other = importlib.util.module_from_spec(spec)
+            sys.modules['sunfish_pawns'] = other
+            try:
+                spec.loader.exec_module(other)
+            finally:
+                del sys.modules['sunfish_pawns']
+        fen = 'rnbqkbnr/ppp1pppp/8/3p4/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'
+        pos, pos2 = tools.parseFEN(fen), other.Position(*tools.parseFEN(fen))
+        move = tools.parseSAN(pos, 'exd5')
+        self.assertEqual(pos.value(move), sunfish.REFERENCE['value'](pos, move))
+        self.assertEqual(pos2.value(move), other.REFERENCE['value'](pos2, move))
+        self.assertNotEqual(pos.value(move), pos2.value(move))
+        self.assertIs(type(pos.move(move)), sunfish.Position)
+        self.assertIs(type(pos2.move(move)), other.Position)
+        # The test suites give each version its own positions
+        fen = 'rnbqkbnr/ppp1pppp/8/3P4/8/8/PPPP1PPP/RNBQKBNR b KQkq - 0 2'
+        pos, pos2 = tools.parseFEN(fen), parse_fen(other, fen)
+        self.assertIs(type(pos2), other.Position)
+        self.assertEqual(pos2._replace(score=pos.score), pos)
+        self.assertEqual(pos2.score, pos.score - 400)
+
+    def test_server(self):
+        fen = open(os.path.join(os.path.dirname(__file__), 'tests/mate1.fen')).readline().strip()
+        with tempfile.TemporaryDirectory() as tmp, server.AnalysisPool(2, 1) as pool:
+            address = os.path.join(tmp, 'sunfish.sock')
+            srv = server.make_server(pool, address)
+            threading.Thread(target=srv.serve_forever, daemon=True).start()
+            try:
+                with server.Client(address) as client:
+                    self.assertEqual(client.request(cmd='ping', id=0), {'id': 0, 'pong': True})
+                    result = client.request(fen=fen, depth=2, id=1)
+                    self.assertEqual(result['id'], 1)
+                    self.assertGreaterEqual(result['lines'][0]['score'], sunfish.MATE_LOWER)
+                    # Many requests at once, answered as they are done
+                    for i in range(4):
+                        client.send(moves=['e2e4', 'c7c5'][:i], depth=2, multipv=2, id=i)
+                    results = sorted((client.receive() for _ in range(4)), key=lambda r: r['id'])
+                    self.assertEqual([r['id'] for r in results], [0, 1, 2, 3])
+                    self.assertEqual([len(r['lines']) for r in results], [2]*4)
+                    self.assertIn(results[1]['lines'][0]['move'][1], '5678')
+                    for request in ({'fen': 'nonsense'}, {'moves': ['e2e5']}, {'moves': 5},
+                                    {'moves': [1]}, {'depth': -1}, {'cmd': 'go'}):
+                        self.assertIn('error', client.request(**request))
+                    # A bad request doesn't lose the answers to the others
+                    client.send(depth=2, id=7)
+                    client.send(moves={'e2': 'e4'}, id=8)
+                    results = sorted((client.receive() for _ in range(2)), key=lambda r: r['id'])
+                    self.assertEqual([r['id'] for r in results], [7, 8])
+                    self.assertIn('lines', results[0])
+                    self.assertIn('error', results[1])
+                    stats = client.request(cmd='stats')
+                    self.assertEqual((stats['done'], stats['errors'], stats['queued']), (6, 0, 0))
+            finally:
+                srv.shutdown()
+                srv.server_close()
+        # The highest priority goes first, then the first come
+        with server.AnalysisPool(1, 1) as pool:
+            order, done = [], threading.Semaphore(0)
+            def callback(name):
+                return lambda result: (order.append(name), done.release())
+            job = tools.parseFEN(tools.FEN_INITIAL), [], 1, 3, None
+            for name, priority in (('a', 0), ('b', -1), ('c', 0), ('d', 1)):
+                pool.submit(job, callback(name), priority)
+            for _ in range(4):
+                done.acquire()
+            self.assertLess(order.index('d'), order.index('c'))
+            self.assertLess(order.index('c'), order.index('b'))
+
     def test_xboard(self):
         test_xboard('pypy3', verbose=False)
         test_xboard('python3', verbose=False)
@@ -129,7 +691,7 @@ class Tests(unittest.TestCase):
             for i, (_pgn, pos_moves) in enumerate(tools.readPGN(file)):
                 history = []
                 for pos, move in pos_moves:
-                    history.append(pos)
+                    history.append(pos.hash)
                 last_pos, last_move = pos_moves[-1]
                 # Maybe we just didn't like the position we were in.
                 # This is a kind of crude way of testing that.
@@ -170,28 +732,165 @@ def unstable():
 # Benchmarking
 ###############################################################################
 
-def benchmark(cnt=20, depth=3):
+def benchmark(cnt=20, depth=3, threads=1, use_board=False, mode=sunfish.SEARCH_MODE):
     path = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
     random.seed(0)
+    if threads > 1:
+        # Starting the helper processes is not part of the benchmark
+        searcher = parallel.ParallelSearcher(threads=threads)
     start = time.time()
     nodes = 0
-    for i, line in enumerate(random.sample(list(open(path)), cnt)):
-        pos = tools.parseFEN(line)
-        searcher = sunfish.Searcher()
+    with database.Database(path) as db:
+        fens = [fen for fen, _ in db.sample(cnt)]
+    for i, fen in enumerate(fens):
+        pos = tools.parseFEN(fen)
+        if use_board:
+            pos = board.Board(pos)
+        if threads > 1:
+            searcher.tp_score.clear()
+            searcher.tp_move.clear()
+        else:
+            searcher = sunfish.Searcher()
+            searcher.mode = mode
         start1 = time.time()
         for search_depth, _, _ in searcher.search(pos):
             speed = int(round(searcher.nodes/(time.time()-start1)))
             print('Benchmark: {}/{}, Depth: {}, Speed: {:,}N/s'.format(
                 i+1, cnt, search_depth, speed), end='\r')
             sys.stdout.flush()
-            if search_depth == depth:
+            if search_depth >= depth:
                 nodes += searcher.nodes
                 break
     print()
     total_time = time.time() - start
     speed = int(round(nodes/total_time))
-    print('Total time: {}, Total nodes: {}, Average speed: {:,}N/s'.format(
-        total_time, nodes, speed))
+    print('Total time: {}, Total nodes: {}, Average speed: {:,}N/s ({} backend)'.format(
+        total_time, nodes, speed, sunfish.BACKEND))
+    if threads > 1:
+        searcher.close()
+    return nodes, total_time
+
+def compare_backends(cnt=20, depth=4):
+    """ Runs the benchmark with the reference methods of Position and with the
+    accelerated ones, and reports the gain in nodes per second. """
+    results = {}
+    try:
+        for backend in ('python', 'accel'):
+            backend = sunfish.set_backend(backend)
+            results[backend] = benchmark(cnt, depth)
+    finally:
+        sunfish.set_backend()
+    (name0, (nodes0, time0)), (name1, (nodes1, time1)) = results.items()
+    if nodes0 != nodes1:
+        print('The backends searched a different number of nodes: {} and {}'.format(nodes0, nodes1))
+    speed0, speed1 = nodes0 / time0, nodes1 / time1
+    print('{}: {:,.0f}N/s, {}: {:,.0f}N/s, gain {:+.1%}'.format(
+        name0, speed0, name1, speed1, speed1 / speed0 - 1))
+
+def compare_modes(cnt=20, depth=5, use_board=False):
+    """ Searches the same positions with the MTD-bi and the PVS driver, and
+    compares the nodes and the time it took to get to each depth, summed over
+    the positions, and how often they chose the same move. """
+    path = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
+    random.seed(0)
+    with database.Database(path) as db:
+        fens = [fen for fen, _ in db.sample(cnt)]
+    modes = ('mtd', 'pvs')
+    nodes = {mode: [0]*depth for mode in modes}
+    times = {mode: [0]*depth for mode in modes}
+    moves = {mode: [] for mode in modes}
+    for mode in modes:
+        for i, fen in enumerate(fens):
+            print('{}: {}/{}'.format(mode, i+1, cnt), end='\r', flush=True)
+            pos = tools.parseFEN(fen)
+            if use_board:
+                pos = board.Board(pos)
+            searcher = sunfish.Searcher()
+            searcher.mode = mode
+            start = time.time()
+            for search_depth, move, _ in searcher.search(pos):
+                nodes[mode][search_depth-1] += searcher.nodes
+                times[mode][search_depth-1] += time.time() - start
+                if search_depth >= depth:
+                    break
+            moves[mode].append(move)
+    print()
+    print('{:>5} {:>12} {:>8} {:>12} {:>8} {:>7}'.format(
+        'depth', 'mtd nodes', 'time', 'pvs nodes', 'time', 'ratio'))
+    for d in range(depth):
+        print('{:>5} {:>12,} {:>8.2f} {:>12,} {:>8.2f} {:>7.2f}'.format(
+            d+1, nodes['mtd'][d], times['mtd'][d], nodes['pvs'][d], times['pvs'][d],
+            nodes['pvs'][d] / max(nodes['mtd'][d], 1)))
+    same = sum(a == b for a, b in zip(moves['mtd'], moves['pvs']))
+    print('Same move in {} of {} positions'.format(same, cnt))
+
+def load_test(address=None, clients=4, requests=40, depth=4, workers=None):
+    """ Sends requests for the analysis of random openings to an analysis
+    server from a number of clients at once, and reports the throughput and
+    the latency of the requests. Without an address, a server is started on
+    a temporary Unix socket. """
+    path = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
+    random.seed(0)
+    with database.Database(path) as db:
+        fens = [fen for fen, _ in db.sample(requests)]
+    pool = srv = tmp = None
+    if address is None:
+        tmp = tempfile.TemporaryDirectory()
+        address = os.path.join(tmp.name, 'sunfish.sock')
+        pool = server.AnalysisPool(workers)
+        srv = server.make_server(pool, address)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+    latencies, nodes = [], [0]
+    def run_client(k):
+        with server.Client(address) as client:
+            # One request at a time, like a tool waiting for each answer
+            for fen in fens[k::clients]:
+                start1 = time.time()
+                result = client.request(fen=fen, depth=depth)
+                latencies.append(time.time() - start1)
+                nodes[0] += result.get('nodes', 0)
+    start = time.time()
+    threads = [threading.Thread(target=run_client, args=(k,)) for k in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_time = time.time() - start
+    if srv is not None:
+        srv.shutdown()
+        srv.server_close()
+        pool.close()
+        tmp.cleanup()
+    latencies.sort()
+    print('{} requests from {} clients in {:.2f}s: {:.2f} requests/s, {:,.0f}N/s'.format(
+        len(latencies), clients, total_time, len(latencies)/total_time, nodes[0]/total_time))
+    print('Latency: mean {:.3f}s, median {:.3f}s, 95% {:.3f}s'.format(
+        sum(latencies)/len(latencies), latencies[len(latencies)//2],
+        latencies[int(len(latencies)*.95)]))
+
+def reuse(secs=.5, game=0):
+    """ Plays through a game from tests/pgns.pgn and compares the depth reached
+    with a searcher kept from move to move against a new searcher every move. """
+    path = os.path.join(os.path.dirname(__file__), 'tests/pgns.pgn')
+    with database.Database(path) as db:
+        msans, _ = db[game]
+    pos = tools.parseFEN(tools.FEN_INITIAL)
+    searcher = sunfish.Searcher()
+    history = []
+    total_kept, total_new = 0, 0
+    print('{:>4} {:>8} {:>6} {:>6}'.format('ply', 'move', 'kept', 'new'))
+    for ply, msan in enumerate(msans):
+        if re.search('=[BNR]', msan):
+            break
+        history.append(pos.hash)
+        _, _, depth_kept = tools.search(searcher, pos, secs, history)
+        _, _, depth_new = tools.search(sunfish.Searcher(), pos, secs, history)
+        total_kept += depth_kept
+        total_new += depth_new
+        print('{:>4} {:>8} {:>6} {:>6}'.format(ply+1, msan, depth_kept, depth_new))
+        pos = pos.move(tools.parseSAN(pos, msan))
+    print('Average depth: {:.2f} kept, {:.2f} new'.format(
+        total_kept/(ply+1), total_new/(ply+1)))
 
 
 ###############################################################################
@@ -212,25 +911,30 @@ def selfplay(secs=1):
         print("\nmove", tools.mrender(pos, m))
         pos = pos.move(m)
 
-def self_arena(version1, version2, games, secs, plus):
-    print('Playing {} games of {} vs. {} at {} secs/game + {} secs/move'
-            .format(games, version1, version2, secs, plus))
+def self_arena(version1, version2, games, secs, plus, use_timeman=False):
+    ''' Plays games between two versions. With use_timeman, the first version
+        decides its time per move with timeman.py, which makes it possible to
+        test the time manager by playing a version against itself. '''
+    print('Playing {} games of {}{} vs. {} at {} secs/game + {} secs/move'
+            .format(games, version1, ' with timeman' if use_timeman else '', version2, secs, plus))
     openings_file = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
-    openings = random.sample(list(open(openings_file)), games)
+    with database.Database(openings_file) as db:
+        openings = [fen for fen, _ in db.sample(games)]
     pool = multiprocessing.Pool()
+    player1, player2 = (version1, use_timeman), (version2, False)
     instances = [random.choice([
-        (version1, version2, secs, plus, fen),
-        (version2, version1, secs, plus, fen),
+        (player1, player2, secs, plus, fen),
+        (player2, player1, secs, plus, fen),
         ]) for fen in openings]
     wins = 0
     losses = 0
     for i, r in enumerate(pool.imap_unordered(play, instances)):
         if r is None:
             print('-', end='', flush=True)
-        if r == version1:
+        if r == player1:
             wins += 1
             print('w', end='', flush=True)
-        if r == version2:
+        if r == player2:
             losses += 1
             print('l', end='', flush=True)
         if i % 80 == 79:
@@ -241,14 +945,19 @@ def self_arena(version1, version2, games, secs, plus):
     print('Result: {} wins, {} draws, {} losses out of {}'.format(wins,games-wins-losses,losses,games))
 
 
-def play(version1_version2_secs_plus_fen):
-    ''' returns 1 if fish1 won, 0 for draw and -1 otherwise '''
-    version1, version2, secs, plus, fen = version1_version2_secs_plus_fen
+def play(player1_player2_secs_plus_fen):
+    ''' Players are (version, use_timeman) pairs. Returns the one that won,
+        or None for a draw. '''
+    player1, player2, secs, plus, fen = player1_player2_secs_plus_fen
+    players = player1, player2
+    (version1, _), (version2, _) = players
     modules = [importlib.import_module(version1), importlib.import_module(version2)]
     searchers = []
-    for module in modules:
+    for module, (_, use_timeman) in zip(modules, players):
         if hasattr(module, 'Searcher'):
             searchers.append(module.Searcher())
+            if use_timeman:
+                searchers[-1].stop = threading.Event()
         else: searchers.append(module)
     times = [secs, secs]
     efactor = [1, 1]
@@ -261,15 +970,19 @@ def play(version1_version2_secs_plus_fen):
         use += (times[d%2] - times[(d+1)%2])/10
         use = max(use, plus)
         t = time.time()
-        m, score, depth = tools.search(searchers[d%2], pos, use*efactor[d%2])
-        efactor[d%2] *= (use/(time.time() - t))**.5
+        if players[d%2][1]:
+            manager = timeman.TimeManager.from_clock(times[d%2], plus)
+            m, score, depth = timeman.search(searchers[d%2], pos, manager)
+        else:
+            m, score, depth = tools.search(searchers[d%2], pos, use*efactor[d%2])
+            efactor[d%2] *= (use/(time.time() - t))**.5
         times[d%2] -= time.time() - t
         times[d%2] += plus
         #print('Used {:.2} rather than {:.2}. Off by {:.2}. Remaining: {}'
             #.format(time.time()-t, use, (time.time()-t)/use, times[d%2]))
         if times[d%2] < 0:
             print('{} ran out of time'.format(version2 if d%2 == 1 else version1))
-            return version1 if d%2 == 1 else version2
+            return players[0] if d%2 == 1 else players[1]
             pass
 
         if m is None:
@@ -284,7 +997,7 @@ def play(version1_version2_secs_plus_fen):
             name = version1 if d%2 == 0 else version2
             print('{} made an illegal move {} in position {}. Depth {}, Score {}'.
                     format(name, tools.mrender(pos,m), tools.renderFEN(pos), depth, score))
-            return version2 if d%2 == 0 else version1
+            return players[1] if d%2 == 0 else players[0]
             #assert False
 
         # Make the move
@@ -312,11 +1025,114 @@ def play(version1_version2_secs_plus_fen):
                 name = version1 if d%2 == 0 else version2
                 if score < sunfish.MATE_LOWER:
                     print('{} mated, but did not realize. Only scored {} in position {}, depth {}'.format(name, score, tools.renderFEN(pos), depth))
-                return name
+                return players[d%2]
     print('Game too long', tools.renderFEN(pos))
     return None
 
 
+###############################################################################
+# SPRT tournaments
+###############################################################################
+
+def elo_score(elo):
+    ''' Expected score of a player elo points stronger than the opponent '''
+    return 1 / (1 + 10**(-elo/400))
+
+def score_elo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1/score - 1)
+
+def sprt_stats(wins, draws, losses, elo0, elo1):
+    ''' The log likelihood ratio of elo1 against elo0, for the trinomial model
+        with the variance estimated from the games, and the Elo difference
+        with a 95% confidence interval. '''
+    n = wins + draws + losses
+    if n == 0 or wins + losses == 0:
+        return 0, 0, (-math.inf, math.inf)
+    score = (wins + draws/2) / n
+    var = (wins*(1-score)**2 + draws*(.5-score)**2 + losses*score**2) / n
+    s0, s1 = elo_score(elo0), elo_score(elo1)
+    llr = n * (s1 - s0) * (2*score - s0 - s1) / (2*var) if var > 0 else 0
+    margin = 1.96 * math.sqrt(var / n)
+    return llr, score_elo(score), (score_elo(score - margin), score_elo(score + margin))
+
+def sprt_game(k_white_black_secs_plus_fen):
+    ''' Plays game k with play(). Returns k and the result for the first player. '''
+    k, white, black, secs, plus, fen = k_white_black_secs_plus_fen
+    winner = play((white, black, secs, plus, fen))
+    if winner is None:
+        return k, 'd'
+    # The players may be equal, when a version plays itself, so we compare
+    # the objects. The first player is white in the even games.
+    return k, 'w' if (winner is white) == (k % 2 == 0) else 'l'
+
+def sprt(version1, version2, elo0, elo1, alpha, beta, secs, plus,
+         max_games=20000, checkpoint=None, use_timeman=False):
+    ''' Plays version1 against version2 until the sequential probability ratio
+        test decides between H0: elo = elo0 and H1: elo = elo1, with error
+        rates alpha and beta. Each opening is played twice, with each version
+        having white once. The results are written to checkpoint as they come
+        in, and a run with the same checkpoint continues where it stopped. It
+        must be run with the same versions and time control, as the games
+        are counted together. '''
+    lower, upper = math.log(beta/(1-alpha)), math.log((1-beta)/alpha)
+    state = {'version1': version1, 'version2': version2, 'secs': secs, 'plus': plus,
+             'timeman': use_timeman, 'seed': random.getrandbits(32), 'results': {}}
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as file:
+            saved = json.load(file)
+        changed = [key for key in ('version1', 'version2', 'secs', 'plus', 'timeman')
+                   if saved.get(key) != state[key]]
+        if changed:
+            raise ValueError('{} was played with other settings: {}'.format(checkpoint, ', '.join(
+                '{}={!r}, not {!r}'.format(key, saved.get(key), state[key]) for key in changed)))
+        state = saved
+        print('Resuming from {} games in {}'.format(len(state['results']), checkpoint))
+    results = state['results']
+    openings_file = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
+    player1, player2 = (version1, use_timeman), (version2, False)
+    with database.Database(openings_file) as db:
+        order = list(range(len(db)))
+        random.Random(state['seed']).shuffle(order)
+        # Game k plays opening k//2, and the colors are swapped for odd k
+        instances = [(k,) + ((player1, player2) if k % 2 == 0 else (player2, player1))
+                     + (secs, plus, db[order[k//2 % len(order)]][0])
+                     for k in range(max_games) if str(k) not in results]
+    print('SPRT of {}{} vs. {} at {} secs/game + {} secs/move, elo0={} elo1={} alpha={} beta={}'
+            .format(version1, ' with timeman' if use_timeman else '', version2, secs, plus,
+                    elo0, elo1, alpha, beta))
+
+    def report():
+        counts = [sum(r == c for r in results.values()) for c in 'wdl']
+        llr, elo, (elo_lo, elo_hi) = sprt_stats(*counts, elo0, elo1)
+        print('\nGames: {}, W/D/L: {}/{}/{}, Elo: {:.1f} [{:.1f}, {:.1f}], LLR: {:.2f} [{:.2f}, {:.2f}]'
+              .format(len(results), *counts, elo, elo_lo, elo_hi, llr, lower, upper))
+        return llr
+
+    llr = report()
+    if lower < llr < upper:
+        with multiprocessing.Pool() as pool:
+            for k, r in pool.imap_unordered(sprt_game, instances):
+                results[str(k)] = r
+                print('-' if r == 'd' else r, end='', flush=True)
+                if checkpoint is not None:
+                    with open(checkpoint + '.tmp', 'w') as file:
+                        json.dump(state, file)
+                    os.replace(checkpoint + '.tmp', checkpoint)
+                if len(results) % 80 == 0:
+                    report()
+                counts = [sum(r == c for r in results.values()) for c in 'wdl']
+                llr = sprt_stats(*counts, elo0, elo1)[0]
+                if not lower < llr < upper:
+                    # The games still running can't change the verdict
+                    pool.terminate()
+                    break
+        llr = report()
+    verdict = 'H1 accepted' if llr >= upper else 'H0 accepted' if llr <= lower else 'No verdict'
+    print(verdict)
+    return verdict
+
+
 ###############################################################################
 # Test Xboard
 ###############################################################################
@@ -411,33 +1227,13 @@ def test_uci(python='python3', protocol='uci'):
 # Perft test
 ###############################################################################
 
-def allperft(f, depth=4, verbose=True):
-    import gc
-    lines = f.readlines()
-    for d in range(1, depth+1):
-        if verbose:
-            print("Going to depth {}/{}".format(d, depth))
-        for line in lines:
-            parts = line.split(';')
-            if len(parts) <= d:
-                continue
-            if verbose:
-                print(parts[0])
-
-            pos, score = tools.parseFEN(parts[0]), int(parts[d])
-            res = sum(1 for _ in tools.collect_tree_depth(tools.expand_position(pos), d))
-            if res != score:
-                print('=========================================')
-                print('ERROR at depth %d. Gave %d rather than %d' % (d, res, score))
-                print('=========================================')
-                print(tools.renderFEN(pos,0))
-                for move in pos.gen_moves():
-                    split = sum(1 for _ in tools.collect_tree_depth(tools.expand_position(pos.move(move)),1))
-                    print('{}: {}'.format(tools.mrender(pos, move), split))
-                return False
-        if verbose:
-            print('')
-    return True
+def allperft(f, depth=4, verbose=True, procs=1):
+    pool = perft.new_pool(procs)
+    try:
+        return perft.check_file(f, depth, pool, verbose)
+    finally:
+        if pool is not None:
+            pool.close()
 
 
 ###############################################################################
@@ -541,6 +1337,140 @@ def findbest(f, times):
     print('Total Points: %d/%d', totalpoints, totaltests)
 
 
+###############################################################################
+# Test suites
+###############################################################################
+
+class SuiteStop:
+    """ The stop of a suite search. It is set by the timer, or when the
+    searcher has used its nodes. """
+
+    def __init__(self, searcher, event, nodes):
+        self.searcher, self.event, self.nodes = searcher, event, nodes
+
+    def is_set(self):
+        return self.event.is_set() or self.nodes is not None and self.searcher.nodes >= self.nodes
+
+
+def parse_fen(module, fen):
+    ''' Parses fen into a Position of a version of sunfish, with the score
+        from its own tables, so its evaluation and move methods are the ones
+        searched. '''
+    pos = tools.parseFEN(fen)
+    if module is sunfish:
+        return pos
+    white = pos if fen.split()[1] == 'w' else pos.rotate()
+    fields = white._asdict()
+    fields['score'] = sum(module.pst[p][i] for i, p in enumerate(white.board) if p.isupper()) \
+            - sum(module.pst[p.upper()][119-i] for i, p in enumerate(white.board) if p.islower())
+    if 'hash' in module.Position._fields:
+        fields['hash'] = module.zobrist_hash(white.board, white.wc, white.bc, white.ep, white.kp)
+    pos = module.Position(*(fields[name] for name in module.Position._fields))
+    return pos if fen.split()[1] == 'w' else pos.rotate()
+
+
+def suite_job(job):
+    ''' Searches a position with a version of sunfish, until secs or nodes
+        are used. Positions with bm/am are solved by the right move, others
+        by finding a mate. The solution counts from the first iteration
+        after which it was kept until the end. '''
+    version, i, fen, ops, secs, nodes = job
+    module = importlib.import_module(version)
+    pos = parse_fen(module, fen)
+    bm = [tools.parseSAN(pos, m) for m in ops.get('bm', '').split()]
+    am = [tools.parseSAN(pos, m) for m in ops.get('am', '').split()]
+    searcher = module.Searcher()
+    # The limits are also checked inside the search, so a deep iteration
+    # doesn't run far over them. Versions without a stop check only end
+    # between iterations.
+    stop = threading.Event()
+    if hasattr(module, 'SearchStopped'):
+        searcher.stop = SuiteStop(searcher, stop, nodes)
+    timer = threading.Timer(secs, stop.set) if secs is not None else None
+    start = time.time()
+    if timer is not None:
+        timer.start()
+    result = {'solved': False}
+    depth, move, score = 0, None, 0
+    try:
+        for depth, move, score in searcher.search(pos):
+            if bm or am:
+                solved = (not bm or move in bm) and move not in am
+            else:
+                solved = score >= module.MATE_LOWER
+            used = time.time() - start
+            if not solved:
+                result = {'solved': False}
+            elif not result['solved']:
+                result = {'solved': True, 'solve_time': round(used, 3),
+                          'solve_depth': depth, 'solve_nodes': searcher.nodes}
+            if secs is not None and used > secs or nodes is not None and searcher.nodes >= nodes:
+                break
+    except getattr(module, 'SearchStopped', ()):
+        pass
+    finally:
+        if timer is not None:
+            timer.cancel()
+    result.update(move=tools.mrender(pos, move) if move else None, score=score,
+                  depth=depth, nodes=searcher.nodes, time=round(time.time() - start, 3))
+    return i, version, result
+
+
+def run_suite(f, versions, secs=None, nodes=None, procs=None, report=None):
+    ''' Runs the positions of an EPD or FEN file with each version of sunfish,
+        on a pool of processes. Prints a table of the results, with the
+        positions that one version solves and the other doesn't, and writes
+        them all as JSON to report. '''
+    positions = {i: {'line': i, 'id': ops.get('id', str(i)), 'fen': fen, 'results': {}}
+                 for i, fen, ops in analysis.read_positions(f)}
+    f.seek(0)
+    jobs = [(version, i, fen, ops, secs, nodes)
+            for i, fen, ops in analysis.read_positions(f) for version in versions]
+    print('Running {} positions with {}, {}'.format(len(positions), ' and '.join(versions),
+          'at {} nodes'.format(nodes) if nodes is not None else 'for {} secs'.format(secs)))
+    start = time.time()
+    with multiprocessing.Pool(procs) as pool:
+        for i, version, result in pool.imap_unordered(suite_job, jobs):
+            positions[i]['results'][version] = result
+            print('x' if result['solved'] else '.', end='', flush=True)
+    print()
+
+    print('{:<12}'.format('id') + ''.join('{:>28}'.format(v) for v in versions))
+    for p in positions.values():
+        cells = []
+        for version in versions:
+            r = p['results'][version]
+            cells.append('{:>6} {:>8.2f}s d{:<3} {:>8}'.format(
+                r['move'] or '-', r['solve_time'] if r['solved'] else r['time'],
+                r['solve_depth'] if r['solved'] else r['depth'],
+                'solved' if r['solved'] else ''))
+        print('{:<12}'.format(p['id'][:12]) + ''.join(cells))
+    totals = {}
+    for version in versions:
+        results = [p['results'][version] for p in positions.values()]
+        totals[version] = {
+            'solved': sum(r['solved'] for r in results),
+            'total': len(results),
+            'solve_time': round(sum(r['solve_time'] for r in results if r['solved']), 3),
+            'nodes': sum(r['nodes'] for r in results),
+        }
+        print('{}: solved {solved}/{total}, {solve_time:.2f}s solving, {nodes} nodes'
+              .format(version, **totals[version]))
+    if len(versions) == 2:
+        first, second = versions
+        for name, a, b in (('Regressions', first, second), ('Improvements', second, first)):
+            ids = [p['id'] for p in positions.values()
+                   if p['results'][a]['solved'] and not p['results'][b]['solved']]
+            print('{} ({} solves, {} doesn\'t): {}'.format(name, a, b, ' '.join(ids) or 'none'))
+    print('Time: {:.2f}s'.format(time.time() - start))
+
+    if report is not None:
+        with open(report, 'w') as file:
+            json.dump({'file': f.name, 'versions': versions, 'secs': secs, 'nodes': nodes,
+                       'totals': totals, 'positions': list(positions.values())}, file, indent=1)
+    return totals
+
+
 ###############################################################################
 # Actions
 ###############################################################################
@@ -560,9 +1490,11 @@ def main():
     p = subparsers.add_parser('perft',
         help='tests for correctness and speed of move generator.')
     p.add_argument('--depth', type=int, default=2)
+    p.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes to split the root moves over. Default=%(default)s.')
     p.add_argument('file', type=argparse.FileType('r'),
         help='such as tests/queen.fen.')
-    add_action(p, lambda n: allperft(n.file, n.depth))
+    add_action(p, lambda n: allperft(n.file, n.depth, procs=n.procs))
 
     p = subparsers.add_parser('quickmate',
         help='uses the `bound` function directly to search for moves that will win us the game.')
@@ -602,7 +1534,34 @@ def main():
         help='number of seconds to search per game. Default=%(default)s.')
     p.add_argument('--plus', type=float, default=.1,
         help='seconds time increment per move. Default=%(default)s.')
-    add_action(p, lambda n: self_arena(n.fish1, n.fish2, n.games, n.seconds, n.plus))
+    p.add_argument('--timeman', action='store_true',
+        help='let fish1 manage its time with timeman.py.')
+    add_action(p, lambda n: self_arena(n.fish1, n.fish2, n.games, n.seconds, n.plus, n.timeman))
+
+    p = subparsers.add_parser('sprt',
+        help='play two sunfish versions against each other until an SPRT decides which is stronger.')
+    p.add_argument('fish1', type=str, help='sunfish')
+    p.add_argument('fish2', type=str, help='sunfish2')
+    p.add_argument('--elo0', type=float, default=0,
+        help='Elo difference of H0. Default=%(default)s.')
+    p.add_argument('--elo1', type=float, default=10,
+        help='Elo difference of H1. Default=%(default)s.')
+    p.add_argument('--alpha', type=float, default=.05,
+        help='probability of accepting H1 when H0 is true. Default=%(default)s.')
+    p.add_argument('--beta', type=float, default=.05,
+        help='probability of accepting H0 when H1 is true. Default=%(default)s.')
+    p.add_argument('--seconds', type=float, default=20,
+        help='number of seconds to search per game. Default=%(default)s.')
+    p.add_argument('--plus', type=float, default=.1,
+        help='seconds time increment per move. Default=%(default)s.')
+    p.add_argument('--max-games', type=int, default=20000,
+        help='games to play at most. Default=%(default)s.')
+    p.add_argument('--checkpoint', type=str, default=None,
+        help='JSON file to save the results in, and resume from.')
+    p.add_argument('--timeman', action='store_true',
+        help='let fish1 manage its time with timeman.py.')
+    add_action(p, lambda n: sprt(n.fish1, n.fish2, n.elo0, n.elo1, n.alpha, n.beta,
+        n.seconds, n.plus, n.max_games, n.checkpoint, n.timeman))
 
     p = subparsers.add_parser('findbest',
         help='reports the best moves found at certain positions after certain intervals of time.')
@@ -613,13 +1572,91 @@ def main():
         default=[15, 30, 60, 120])
     add_action(p, lambda n: findbest(n.file, n.times))
 
+    p = subparsers.add_parser('suite',
+        help='run a test suite on all cores, optionally comparing two sunfish versions.')
+    p.add_argument('file', type=argparse.FileType('r'),
+        help='EPD with bm/am, such as tests/bratko_kopec_test.epd, or FEN of mates, such as tests/mate2.fen.')
+    p.add_argument('versions', type=str, nargs='*', default=['sunfish'],
+        help='one or two sunfish versions. Default=%(default)s.')
+    p.add_argument('--secs', type=float, default=None,
+        help='seconds to search each position. Default is 10 if no nodes are given.')
+    p.add_argument('--nodes', type=int, default=None,
+        help='nodes to search each position, which makes the results repeatable.')
+    p.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes. Default=%(default)s.')
+    p.add_argument('--report', type=str, default=None,
+        help='file to write the results to as JSON.')
+    add_action(p, lambda n: run_suite(n.file, n.versions,
+        10 if n.secs is None and n.nodes is None else n.secs, n.nodes, n.procs, n.report))
+
     p = subparsers.add_parser('unstable',
         help='helps debug unstable positions')
     add_action(p, lambda n: unstable())
 
     p = subparsers.add_parser('benchmark',
         help='Search a few positions to a fixed depth (IID), and measure the time it took.')
-    add_action(p, lambda n: benchmark())
+    p.add_argument('--cnt', type=int, default=20,
+        help='number of positions to search. Default=%(default)s.')
+    p.add_argument('--depth', type=int, default=3,
+        help='depth to search each position to. Default=%(default)s.')
+    p.add_argument('--threads', type=int, default=1,
+        help='number of processes searching in parallel, see parallel.py. Default=%(default)s.')
+    p.add_argument('--board', action='store_true',
+        help='search a board.Board rather than a sunfish.Position.')
+    p.add_argument('--mode', choices=('mtd', 'pvs'), default=sunfish.SEARCH_MODE,
+        help='the search driver, see sunfish.SEARCH_MODE. Default=%(default)s.')
+    add_action(p, lambda n: benchmark(n.cnt, n.depth, n.threads, n.board, n.mode))
+
+    p = subparsers.add_parser('modes',
+        help='compare the nodes and time to depth of the MTD-bi and PVS search drivers.')
+    p.add_argument('--cnt', type=int, default=20,
+        help='number of positions to search. Default=%(default)s.')
+    p.add_argument('--depth', type=int, default=5,
+        help='depth to search each position to. Default=%(default)s.')
+    p.add_argument('--board', action='store_true',
+        help='search a board.Board rather than a sunfish.Position.')
+    add_action(p, lambda n: compare_modes(n.cnt, n.depth, n.board))
+
+    p = subparsers.add_parser('backends',
+        help='compare the speed of the reference and the accelerated Position methods, see accel.py.')
+    p.add_argument('--cnt', type=int, default=20,
+        help='number of positions to search. Default=%(default)s.')
+    p.add_argument('--depth', type=int, default=4,
+        help='depth to search each position to. Default=%(default)s.')
+    add_action(p, lambda n: compare_backends(n.cnt, n.depth))
+
+    p = subparsers.add_parser('load',
+        help='measure the throughput of an analysis server, see server.py.')
+    p.add_argument('--unix', type=str, default=None,
+        help='Unix socket of a running server. By default one is started.')
+    p.add_argument('--port', type=int, default=None,
+        help='TCP port of a running server on this machine.')
+    p.add_argument('--clients', type=int, default=4,
+        help='number of clients sending requests at once. Default=%(default)s.')
+    p.add_argument('--requests', type=int, default=40,
+        help='number of positions to analyse. Default=%(default)s.')
+    p.add_argument('--depth', type=int, default=4,
+        help='depth to analyse each position to. Default=%(default)s.')
+    p.add_argument('--workers', type=int, default=None,
+        help='worker processes of the started server. Default is the number of CPUs.')
+    add_action(p, lambda n: load_test(n.unix or (n.port and ('127.0.0.1', n.port)),
+                                      n.clients, n.requests, n.depth, n.workers))
+
+    p = subparsers.add_parser('reuse',
+        help='play through a game and compare the depth reached when the tables are kept between moves.')
+    p.add_argument('--secs', type=float, default=.5,
+        help='number of seconds to search per move. Default=%(default)s.')
+    p.add_argument('--game', type=int, default=0,
+        help='which game of tests/pgns.pgn to play through. Default=%(default)s.')
+    add_action(p, lambda n: reuse(n.secs, n.game))
+
+    p = subparsers.add_parser('book',
+        help='build a Polyglot opening book from the first moves of the games in some PGN files.')
+    p.add_argument('book', help='the book file to write.')
+    p.add_argument('pgns', nargs='+', help='PGN files, such as tests/pgns.pgn.')
+    p.add_argument('--plies', type=int, default=16,
+        help='number of moves from the start of each game to include. Default=%(default)s.')
+    add_action(p, lambda n: print(tools.build_book(n.pgns, n.book, n.plies), 'entries written'))
 
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(Tests)
     p = subparsers.add_parser('unittest',
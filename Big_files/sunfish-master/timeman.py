@@ -0,0 +1,142 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+import threading
+import time
+
+################################################################################
+# Time management. Iterative deepening can be stopped after any iteration, so
+# the question for each move is how much time to aim for, and whether the next
+# iteration is worth starting. The time an iteration takes is predicted from
+# the nodes of the iterations before it: their ratio is the effective branching
+# factor, and the nodes per second so far turn nodes into seconds.
+################################################################################
+
+# Moves we plan to play with the time left, when the GUI doesn't say
+MOVES_TO_GO = 30
+# Seconds lost per move to the GUI and the operating system
+MOVE_OVERHEAD = .05
+# We may use up to this many times the target on a single move
+MAX_FACTOR = 4
+# ... but never more than this share of the time left
+MAX_SHARE = .5
+# Extra target for each recent change of the best move
+CHANGE_BONUS = .5
+# An iteration is only started if it should end before this many times the target
+OVERSHOOT = 1.5
+# Branching factor to assume, before we have seen two iterations
+DEFAULT_BRANCHING = 4
+
+
+class TimeManager:
+    """ Decides when to stop the iterative deepening of one move. All times are
+    in seconds. target is the time we aim to use, and maximum the time we must
+    never go over. Call update after each iteration, and stop to know if the
+    next one should be started. """
+
+    def __init__(self, target, maximum=None):
+        self.target = target
+        self.maximum = max(target, maximum or target)
+        # (nodes, seconds) of each finished iteration, and how often the best
+        # move changed, decaying by half every iteration.
+        self.iterations = []
+        self.changes = 0
+        self.move = None
+        # Nodes per second, measured since the clock was started
+        self.speed = None
+        self.restart()
+
+    @classmethod
+    def from_clock(cls, time_left, inc=0, movestogo=0):
+        ''' A manager for a move with time_left on our clock, and inc added
+            after the move. movestogo is the number of moves until the next
+            time control, or 0 if the rest of the game is played on this. '''
+        time_left = max(time_left - MOVE_OVERHEAD, .001)
+        moves = min(movestogo or MOVES_TO_GO, MOVES_TO_GO)
+        maximum = min(time_left * MAX_SHARE, (time_left/moves + inc) * MAX_FACTOR)
+        target = min(time_left/moves + inc * 3/4, maximum)
+        return cls(target, maximum)
+
+    def restart(self, nodes=0):
+        ''' Starts the clock, such as at a ponderhit, when nodes were already
+            searched. The iterations so far are kept for the branching
+            factor, but the speed is measured from here on. '''
+        self.start = time.time()
+        self.offset = nodes
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def update(self, nodes, move):
+        ''' Records an iteration that finished, with the total number of nodes
+            searched so far, and the best move it found. '''
+        elapsed = self.elapsed()
+        self.iterations.append((nodes, elapsed))
+        self.speed = (nodes - self.offset) / max(elapsed, 1e-3)
+        self.changes /= 2
+        if self.move is not None and move != self.move:
+            self.changes += 1
+        self.move = move
+
+    def branching(self):
+        ''' Effective branching factor of the last iterations '''
+        nodes = [n for n, _ in self.iterations]
+        sizes = [b - a for a, b in zip([0] + nodes, nodes)]
+        ratios = [b / a for a, b in zip(sizes, sizes[1:]) if a > 0][-2:]
+        if not ratios:
+            return DEFAULT_BRANCHING
+        # The geometric mean, since the ratios alternate between odd and even depths
+        product = 1
+        for r in ratios:
+            product *= r
+        return max(product ** (1 / len(ratios)), 1)
+
+    def predict(self):
+        ''' Seconds the next iteration is likely to take '''
+        if not self.iterations:
+            return 0
+        nodes, seconds = self.iterations[-1]
+        last = nodes - (self.iterations[-2][0] if len(self.iterations) > 1 else 0)
+        nps = self.speed or nodes / max(seconds, 1e-3)
+        return last * self.branching() / nps
+
+    def soft_limit(self):
+        ''' The target, with more time when the best move keeps changing '''
+        return min(self.target * (1 + CHANGE_BONUS * self.changes), self.maximum)
+
+    def stop(self):
+        ''' Whether to stop before the next iteration, since we used our time,
+            or since it isn't going to finish in time '''
+        elapsed, soft = self.elapsed(), self.soft_limit()
+        return elapsed >= soft or elapsed + self.predict() > min(soft * OVERSHOOT, self.maximum)
+
+    def timer(self, stop):
+        ''' A started timer that sets the stop event of a searcher when the
+            maximum is up. Cancel it when the search is over. '''
+        timer = threading.Timer(max(self.maximum - self.elapsed(), 0), stop.set)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+def search(searcher, pos, manager, history=()):
+    """ Like tools.search, but with the time decided by a TimeManager. If the
+    searcher has a stop event, it is also stopped in the middle of an
+    iteration when the maximum is up. """
+    timer, stop = None, getattr(searcher, 'stop', None)
+    if stop is not None:
+        stop.clear()
+        timer = manager.timer(stop)
+    move = score = None
+    depth = 0
+    try:
+        for depth, move, score in searcher.search(pos, history):
+            manager.update(searcher.nodes, move)
+            if manager.stop():
+                break
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return move, score, depth
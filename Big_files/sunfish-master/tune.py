@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+import argparse
+import array
+import math
+import time
+
+import numpy as np
+
+import database
+import sunfish
+import tools
+from tools import WHITE
+
+################################################################################
+# Texel tuning of the piece-square tables. Sunfish's evaluation is a sum over
+# the pieces of pst[piece][square], so a position is a sparse vector with +1
+# for each of white's (piece, square) and -1 for each of black's, mirrored,
+# and its score is the dot product with the tables. We fit the tables so that
+# sigmoid(score) predicts the results of the games the positions came from.
+#
+# The positions are encoded once, as the (row, column, value) triplets of a
+# sparse matrix, and every epoch is then a few NumPy operations over all of
+# them: np.bincount does the sparse matrix-vector products.
+################################################################################
+
+PIECES = 'PNBRQK'
+RESULTS = {'1-0': 1, '0-1': 0, '1/2-1/2': .5}
+
+# Plies at the start of each game that are not used, as they are mostly book
+SKIP_PLIES = 8
+# Weight of the pull towards the current tables, which keeps the values of
+# squares that are seldom seen from wandering off
+REGULARIZATION = 1e-4
+
+
+def square(i):
+    ''' The index into the 64 square tables, from the 120 char board '''
+    return (i//10 - 2) * 8 + i%10 - 1
+
+
+def initial_params(pst=None):
+    ''' The tables, with the piece values included, as one vector '''
+    pst = pst or sunfish.pst
+    return np.array([pst[p][i] for p in PIECES for i in range(120) if sunfish.on_board(i)],
+                    dtype=np.float64)
+
+
+def quiet(pos, move):
+    ''' Whether the score of pos can be trusted: we are not in check, the
+        move played is not a capture, and the quiescence search would have
+        nothing to look at '''
+    return not pos.board[move[1]].islower() \
+        and not tools.can_kill_king(pos.nullmove()) \
+        and all(pos.value(m) < sunfish.QS_LIMIT for m in pos.gen_moves())
+
+
+def game_positions(moves, result):
+    ''' The quiet positions of a game from database.replay, seen from white,
+        with the result of the game for white '''
+    positions = []
+    if result not in RESULTS:
+        return positions
+    pos, color = tools.parseFEN(tools.FEN_INITIAL), WHITE
+    for ply, move in enumerate(moves):
+        if ply >= SKIP_PLIES and quiet(pos, move):
+            positions.append(((pos if color == WHITE else pos.rotate()), RESULTS[result]))
+        pos, color = pos.move(move), 1-color
+    return positions
+
+
+def quiet_positions(paths, processes=None):
+    ''' Yields the quiet positions of the games in some PGN files, replaying
+        the games on a pool of processes '''
+    for path in paths:
+        with database.Database(path, 'pgn') as db:
+            for positions in database.replay(db, game_positions, processes=processes):
+                yield from positions
+
+
+class Dataset:
+    """ Positions encoded as a sparse matrix in coordinate form: vals[j] is
+    the entry at (rows[j], cols[j]). The results are the targets. """
+
+    def __init__(self, rows, cols, vals, results):
+        self.rows, self.cols, self.vals, self.results = rows, cols, vals, results
+        self.size = len(results)
+
+    def split(self, fraction):
+        ''' Splits off the last fraction of the positions, for validation '''
+        cut = self.size - int(self.size * fraction)
+        at = np.searchsorted(self.rows, cut)
+        return (Dataset(self.rows[:at], self.cols[:at], self.vals[:at], self.results[:cut]),
+                Dataset(self.rows[at:] - cut, self.cols[at:], self.vals[at:], self.results[cut:]))
+
+    def scores(self, params):
+        return np.bincount(self.rows, weights=self.vals * params[self.cols], minlength=self.size)
+
+    def gradient(self, params, k):
+        ''' The mean squared error of the predictions, and its gradient '''
+        s = sigmoid(self.scores(params), k)
+        err = s - self.results
+        ds = 2 * err * s * (1-s) * k * math.log(10) / 400 / self.size
+        grad = np.bincount(self.cols, weights=self.vals * ds[self.rows], minlength=len(params))
+        return np.mean(err**2), grad
+
+    def error(self, params, k):
+        return np.mean((sigmoid(self.scores(params), k) - self.results)**2)
+
+
+def encode(positions):
+    ''' A Dataset of (position, result) pairs. The triplets are collected in
+        compact arrays, since there are about 30 for each position. '''
+    rows, cols, vals, results = array.array('i'), array.array('i'), array.array('b'), array.array('d')
+    for n, (pos, result) in enumerate(positions):
+        for i, p in enumerate(pos.board):
+            if p.isupper():
+                rows.append(n)
+                cols.append(PIECES.index(p) * 64 + square(i))
+                vals.append(1)
+            elif p.islower():
+                rows.append(n)
+                cols.append(PIECES.index(p.upper()) * 64 + square(119-i))
+                vals.append(-1)
+        results.append(result)
+    return Dataset(*(np.array(a, dtype=t) for a, t in
+                     ((rows, np.int64), (cols, np.int64), (vals, np.int8), (results, np.float64))))
+
+
+def sigmoid(scores, k):
+    ''' Expected result for white, of positions with the given scores '''
+    return 1 / (1 + 10**(-k * scores / 400))
+
+
+def fit_k(data, params, lo=.1, hi=4, iterations=40):
+    ''' The scaling of the scores that fits the results best, by golden section search '''
+    g = (math.sqrt(5) - 1) / 2
+    for _ in range(iterations):
+        a, b = hi - g*(hi-lo), lo + g*(hi-lo)
+        if data.error(params, a) < data.error(params, b):
+            hi = b
+        else:
+            lo = a
+    return (lo + hi) / 2
+
+
+def tune(data, params, k, epochs=500, lr=1, validation=None, verbose=True):
+    ''' Fits the params with Adam, on all the positions every epoch '''
+    start, prior = params.copy(), params.copy()
+    m, v = np.zeros_like(params), np.zeros_like(params)
+    b1, b2, eps = .9, .999, 1e-8
+    for epoch in range(1, epochs+1):
+        err, grad = data.gradient(params, k)
+        grad += 2 * REGULARIZATION * (params - prior) / len(params)
+        m = b1*m + (1-b1)*grad
+        v = b2*v + (1-b2)*grad**2
+        params = params - lr * (m / (1-b1**epoch)) / (np.sqrt(v / (1-b2**epoch)) + eps)
+        if verbose and (epoch % 50 == 0 or epoch == epochs):
+            line = 'Epoch {}: error {:.6f}'.format(epoch, err)
+            if validation is not None:
+                line += ', validation {:.6f} (was {:.6f})'.format(
+                    validation.error(params, k), validation.error(start, k))
+            print(line)
+    return params
+
+
+def render_module(params, note=''):
+    ''' A pst module like the top of sunfish.py, for uci.py --tables '''
+    tables = params.reshape(6, 64).round().astype(int)
+    lines = ['# -*- coding: utf-8 -*-', '']
+    if note:
+        lines += ['# ' + note, '']
+    pieces = {}
+    for p, table in zip(PIECES, tables):
+        # Pawns are never on the first and last rank
+        squares = table[8:56] if p == 'P' else table
+        pieces[p] = sunfish.piece['K'] if p == 'K' else int(round(squares.mean()))
+    lines.append('piece = { ' + ', '.join("'{}': {}".format(p, pieces[p]) for p in PIECES) + ' }')
+    lines.append('pst = {')
+    for p, table in zip(PIECES, tables):
+        if p == 'K':
+            table = table - int(round(table.mean()))
+        else:
+            table = table - pieces[p]
+        if p == 'P':
+            table[:8] = table[56:] = 0
+        rows = [','.join('{:4}'.format(x) for x in table[r*8:r*8+8]) for r in range(8)]
+        lines.append("    '{}': (".format(p) + (',\n' + ' '*10).join(rows) + '),')
+    lines += [
+        '}',
+        '# Pad tables and join piece and pst dictionaries',
+        'for k, table in pst.items():',
+        '    padrow = lambda row: (0,) + tuple(x+piece[k] for x in row) + (0,)',
+        '    pst[k] = sum((padrow(table[i*8:i*8+8]) for i in range(8)), ())',
+        '    pst[k] = (0,)*20 + pst[k] + (0,)*20',
+        '']
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tune the piece-square tables of sunfish on the results of the games in PGN files.')
+    parser.add_argument('pgns', nargs='+', help='PGN files, such as tests/pgns.pgn.')
+    parser.add_argument('--out', type=str, default='pst_tuned.py',
+        help='the pst module to write, for uci.py --tables. Default=%(default)s.')
+    parser.add_argument('--epochs', type=int, default=500,
+        help='passes over all the positions. Default=%(default)s.')
+    parser.add_argument('--lr', type=float, default=1,
+        help='learning rate, in centipawns per step. Default=%(default)s.')
+    parser.add_argument('--validation', type=float, default=.1,
+        help='fraction of the positions held out to check the fit. Default=%(default)s.')
+    args = parser.parse_args()
+
+    start = time.time()
+    data = encode(quiet_positions(args.pgns))
+    print('Encoded {} positions in {:.1f}s'.format(data.size, time.time() - start))
+    train, validation = data.split(args.validation)
+    params = initial_params()
+    k = fit_k(train, params)
+    print('K = {:.3f}, error {:.6f}'.format(k, train.error(params, k)))
+    start = time.time()
+    params = tune(train, params, k, args.epochs, args.lr, validation)
+    print('Tuned in {:.1f}s'.format(time.time() - start))
+    with open(args.out, 'w') as file:
+        file.write(render_module(params, 'Tuned by tune.py on {} positions from {}'.format(
+            data.size, ', '.join(args.pgns))))
+    print('Wrote', args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,15 @@ import re
 import sys
 import time
 import logging
+import threading
 import argparse
 
 import tools
 import sunfish
+import parallel
+import bitbase
+import timeman
+import stats
 
 from tools import WHITE, BLACK, Unbuffered
 
@@ -25,17 +30,108 @@ def main():
     if args.tables is not None:
         pst_module = importlib.import_module(args.tables)
         sunfish.pst = pst_module.pst
+    # Endgame bitbases, if they have been generated, see bitbase.py
+    bitbase.install(bitbase.Bitbases(), sunfish)
 
     logging.basicConfig(filename='sunfish.log', level=logging.DEBUG)
     out = Unbuffered(sys.stdout)
+    # The search runs on its own thread, which outputs too
+    output_lock = threading.Lock()
     def output(line):
-        print(line, file=out)
-        logging.debug(line)
+        with output_lock:
+            print(line, file=out)
+            logging.debug(line)
     pos = tools.parseFEN(tools.FEN_INITIAL)
-    searcher = sunfish.Searcher()
+    # Hashes of the positions since the last irreversible move, for the draw test
+    history = [pos.hash]
+    table_mb, threads = sunfish.TABLE_MB, 1
+    # Search statistics, see stats.py, and a file to write them to
+    search_stats, stats_file = False, None
+    # The search driver, see sunfish.SEARCH_MODE
+    search_mode = sunfish.SEARCH_MODE
+    def new_searcher():
+        if threads > 1:
+            # Its stop event also stops the helpers, which search with MTD-bi
+            searcher = parallel.ParallelSearcher(table_mb, threads)
+        else:
+            searcher = (stats.StatsSearcher if search_stats else sunfish.Searcher)(table_mb)
+            searcher.stop = threading.Event()
+        # The statistics are those of the MTD-bi search
+        if not search_stats:
+            searcher.mode = search_mode
+        return searcher
+    searcher = new_searcher()
     color = WHITE
-    our_time, opp_time = 1000, 1000 # time in centi-seconds
+    our_time, opp_time = 1000, 1000 # time in milliseconds
     show_thinking = True
+    own_book, book = False, None
+
+    # The thread running the current search, and an event that is set once
+    # the search may use its own time, at once or at the ponderhit. The
+    # time manager and the timer stopping the search when its time is up.
+    thinker, ponderhit = None, threading.Event()
+    manager, timer = None, None
+    start = time.time()
+
+    def think(pos, history, depth):
+        ''' Searches pos and outputs the best move. Until ponderhit is set we
+            are pondering, and don't look at the clock or give the move. '''
+        moves, sdepth = '', 0
+        for sdepth, move, score in searcher.search(pos, history):
+            # The PV of the pvs driver, if it is the one of the move we got
+            if searcher.pv and searcher.pv[0] == move:
+                moves = tools.render_moves(pos, searcher.pv)
+            else:
+                moves = tools.pv(searcher, pos, include_scores=False)
+
+            if show_thinking:
+                # With helpers, the entry may have been replaced in the shared table
+                entry = searcher.entry(pos, sdepth)
+                if entry is not None:
+                    score = int(round((entry.lower + entry.upper)/2))
+                usedtime = int((time.time() - start) * 1000)
+                moves_str = moves if len(moves) < 15 else ''
+                output('info depth {} score cp {} time {} nodes {} pv {}'.format(sdepth, score, usedtime, searcher.nodes, moves_str))
+                if isinstance(searcher, stats.StatsSearcher):
+                    for line in stats.info_strings(searcher):
+                        output(line)
+
+            if sdepth >= depth:
+                break
+
+            if manager is None:
+                continue
+            manager.update(searcher.nodes, move)
+            if ponderhit.is_set() and manager.stop():
+                break
+
+        # The GUI only wants the move after a ponderhit or stop
+        ponderhit.wait()
+        if timer is not None:
+            timer.cancel()
+        if stats_file and isinstance(searcher, stats.StatsSearcher):
+            stats.write_profile(searcher, stats_file, fen=tools.renderFEN(pos))
+        entry = searcher.entry(pos, sdepth)
+        # We only resign once we are mated.. That's never?
+        if entry is not None and entry.lower == -sunfish.MATE_UPPER:
+            output('resign')
+        elif not moves:
+            # Stopped before the first iteration was done
+            legal = [move for move, _ in tools.gen_legal_moves(pos)]
+            output('bestmove ' + (tools.mrender(pos, legal[0]) if legal else '0000'))
+        else:
+            moves = moves.split(' ')
+            if len(moves) > 1:
+                output(f'bestmove {moves[0]} ponder {moves[1]}')
+            else:
+                output('bestmove ' + moves[0])
+
+    def stop():
+        ''' Stops the search, if any, and waits for it to give its move '''
+        if thinker is not None and thinker.is_alive():
+            searcher.stop.set()
+            ponderhit.set()
+            thinker.join()
 
     stack = []
     while True:
@@ -46,87 +142,151 @@ def main():
         logging.debug(f'>>> {smove} ')
 
         if smove == 'quit':
+            stop()
+            if threads > 1:
+                searcher.close()
             break
 
         elif smove == 'uci':
             output('id name Sunfish')
             output('id author Thomas Ahle & Contributors')
+            output('option name Hash type spin default {} min 1 max 65536'.format(sunfish.TABLE_MB))
+            output('option name Threads type spin default 1 min 1 max 256')
+            output('option name Ponder type check default false')
+            output('option name OwnBook type check default false')
+            output('option name BookFile type string default <empty>')
+            output('option name SearchStats type check default false')
+            output('option name StatsFile type string default <empty>')
+            output('option name SearchMode type combo default {} var mtd var pvs'.format(sunfish.SEARCH_MODE))
             output('uciok')
 
         elif smove == 'isready':
             output('readyok')
 
+        elif smove.startswith('setoption'):
+            stop()
+            match = re.match('setoption name (.*?)(?: value (.*))?$', smove)
+            if match:
+                name, val = match.groups()
+                if name in ('Hash', 'Threads', 'SearchStats'):
+                    if threads > 1:
+                        searcher.close()
+                    if name == 'Hash':
+                        table_mb = int(val)
+                    if name == 'Threads':
+                        threads = int(val)
+                    if name == 'SearchStats':
+                        search_stats = val == 'true'
+                    searcher = new_searcher()
+                if name == 'SearchMode' and val in ('mtd', 'pvs'):
+                    search_mode = val
+                    if not search_stats:
+                        searcher.mode = val
+                if name == 'StatsFile':
+                    stats_file = val if val and val != '<empty>' else None
+                if name == 'OwnBook':
+                    own_book = val == 'true'
+                if name == 'BookFile':
+                    if book is not None:
+                        book.close()
+                    book = tools.Book(val) if val and val != '<empty>' else None
+
         elif smove == 'ucinewgame':
+            stop()
             stack.append('position fen ' + tools.FEN_INITIAL)
+            # The tables are kept from move to move, but not between games
+            if threads > 1:
+                searcher.close()
+            searcher = new_searcher()
 
         elif smove.startswith('position fen'):
+            stop()
             _, _, fen = smove.split(' ', 2)
             pos = tools.parseFEN(fen)
             color = WHITE if fen.split()[1] == 'w' else BLACK
+            history = [pos.hash]
 
         elif smove.startswith('position startpos'):
+            stop()
             params = smove.split(' ')
             pos = tools.parseFEN(tools.FEN_INITIAL)
             color = WHITE
+            history = [pos.hash]
 
             if len(params) > 2 and params[2] == 'moves':
                 for move in params[3:]:
-                    pos = pos.move(tools.mparse(color, move))
+                    move = tools.mparse(color, move)
+                    if sunfish.irreversible(pos, move):
+                        history = []
+                    pos = pos.move(move)
+                    history.append(pos.hash)
                     color = 1 - color
 
         elif smove.startswith('go'):
+            # Known openings are played from the book, without searching
+            book_move = book.choose(pos) if own_book and book is not None else None
+            if book_move is not None:
+                output('bestmove ' + tools.mrender(pos, book_move))
+                continue
+
             #  default options
             depth = 1000
             movetime = -1
+            inc, movestogo = 0, 0
+            infinite = pondering = clock = False
 
             _, *params = smove.split(' ')
+            if 'infinite' in params:
+                params.remove('infinite')
+                infinite = True
+            if 'ponder' in params:
+                params.remove('ponder')
+                pondering = True
             for param, val in zip(*2*(iter(params),)):
+                if param in ('movetime', 'wtime', 'btime'):
+                    clock = True
                 if param == 'depth':
                     depth = int(val)
                 if param == 'movetime':
                     movetime = int(val)
-                if param == 'wtime':
+                if param == ('wtime' if color == WHITE else 'btime'):
                     our_time = int(val)
-                if param == 'btime':
+                if param == ('btime' if color == WHITE else 'wtime'):
                     opp_time = int(val)
+                if param == ('winc' if color == WHITE else 'binc'):
+                    inc = int(val)
+                if param == 'movestogo':
+                    movestogo = int(val)
 
-            moves_remain = 40
-
+            stop()
+            searcher.stop.clear()
             start = time.time()
-            ponder = None
-            for sdepth, _move, _score in searcher.search(pos):
-                moves = tools.pv(searcher, pos, include_scores=False)
-
-                if show_thinking:
-                    entry = searcher.tp_score.get((pos, sdepth, True))
-                    score = int(round((entry.lower + entry.upper)/2))
-                    usedtime = int((time.time() - start) * 1000)
-                    moves_str = moves if len(moves) < 15 else ''
-                    output('info depth {} score cp {} time {} nodes {} pv {}'.format(sdepth, score, usedtime, searcher.nodes, moves_str))
-
-                if len(moves) > 5:
-                    ponder = moves[1]
-
-                if movetime > 0 and (time.time() - start) * 1000 > movetime:
-                    break
-
-                if (time.time() - start) * 1000 > our_time/moves_remain:
-                    break
+            if infinite or depth < 1000 and not clock:
+                manager = None
+            elif movetime > 0:
+                manager = timeman.TimeManager(movetime/1000)
+            else:
+                manager = timeman.TimeManager.from_clock(our_time/1000, inc/1000, movestogo)
+            timer = None
+            if pondering or infinite:
+                ponderhit.clear()
+            else:
+                ponderhit.set()
+                if manager is not None:
+                    timer = manager.timer(searcher.stop)
+            thinker = threading.Thread(target=think, args=(pos, history, depth))
+            thinker.start()
 
-                if sdepth >= depth:
-                    break
+        elif smove == 'ponderhit':
+            # The opponent played the move we pondered on, so now it's our time
+            start = time.time()
+            if manager is not None:
+                manager.restart(searcher.nodes)
+                timer = manager.timer(searcher.stop)
+            ponderhit.set()
 
-            entry = searcher.tp_score.get((pos, sdepth, True))
-            m, s = searcher.tp_move.get(pos), entry.lower
-            # We only resign once we are mated.. That's never?
-            if s == -sunfish.MATE_UPPER:
-                output('resign')
-            else:
-                moves = moves.split(' ')
-                if len(moves) > 1:
-                    output(f'bestmove {moves[0]} ponder {moves[1]}')
-                else:
-                    output('bestmove ' + moves[0])
+        elif smove == 'stop':
+            stop()
 
         elif smove.startswith('time'):
             our_time = int(smove.split()[1])
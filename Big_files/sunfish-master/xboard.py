@@ -12,6 +12,8 @@ import time
 from datetime import datetime
 
 import tools
+import perft
+import bitbase
 from tools import WHITE, BLACK
 
 
@@ -30,6 +32,8 @@ def main():
     if args.tables is not None:
         pst_module = importlib.import_module(args.tables)
         sunfish.pst = pst_module.pst
+    # Endgame bitbases, if they have been generated, see bitbase.py
+    bitbase.install(bitbase.Bitbases())
 
     sys.stdout = tools.Unbuffered(sys.stdout)
 
@@ -38,13 +42,15 @@ def main():
     sys.stderr = open(path, 'a')
 
     pos = tools.parseFEN(tools.FEN_INITIAL)
-    searcher = sunfish.Searcher()
+    table_mb = sunfish.TABLE_MB
+    searcher = sunfish.Searcher(table_mb)
     forced = False
     color = WHITE
     our_time, opp_time = 1000, 1000 # time in centi-seconds
     show_thinking = False
     options = {}
     history = []
+    book = None
 
     stack = []
     while True:
@@ -66,16 +72,18 @@ def main():
             print('feature ping=1')
             print('feature sigint=0')
             print('feature nps=0')
+            print('feature memory=1')
             print('feature variants="normal"')
             print('feature option="qs_limit -spin {} -100 1000"'.format(sunfish.QS_LIMIT))
             print('feature option="eval_roughness -spin {} 1 1000"'.format(sunfish.EVAL_ROUGHNESS))
             print('feature option="draw_test -spin {} 0 1"'.format(int(sunfish.DRAW_TEST)))
+            print('feature option="book_file -file "')
             print('feature done=1')
 
         elif smove == 'new':
             stack.append('setboard ' + tools.FEN_INITIAL)
             # Clear out the old searcher, including the tables
-            searcher = sunfish.Searcher()
+            searcher = sunfish.Searcher(table_mb)
             del history[:]
 
         elif smove.startswith('setboard'):
@@ -84,6 +92,10 @@ def main():
             color = WHITE if fen.split()[1] == 'w' else BLACK
             del history[:]
 
+        elif smove.startswith('memory'):
+            table_mb = int(smove.split()[1])
+            searcher = sunfish.Searcher(table_mb)
+
         elif smove == 'force':
             forced = True
 
@@ -98,6 +110,10 @@ def main():
                 sunfish.EVAL_ROUGHNESS = int(val)
             if name == 'draw_test':
                 sunfish.DRAW_TEST = bool(int(val))
+            if name == 'book_file':
+                if book is not None:
+                    book.close()
+                book = tools.Book(val) if val else None
             options[name] = val
 
         elif smove == 'go':
@@ -110,29 +126,35 @@ def main():
                 use *= our_time/opp_time
 
             start = time.time()
-            for ply, move, score in searcher.search(pos, history):
-                entry = searcher.tp_score.get((pos, ply, True))
-                score = int(round((entry.lower + entry.upper)/2))
-                if show_thinking:
-                    used = int((time.time() - start)*100 + .5)
-                    moves = tools.pv(searcher, pos, include_scores=False)
-                    print('{:>3} {:>8} {:>8} {:>13} \t{}'.format(
-                        ply, score, used, searcher.nodes, moves))
-                    print('# Hashfull: {:.3f}%; {} <= score < {}'.format(
-                        len(searcher.tp_score)/sunfish.TABLE_SIZE*100, entry.lower, entry.upper))
-                # If found mate, just stop
-                if entry.lower >= sunfish.MATE_UPPER:
-                    break
-                if time.time() - start > use/100:
-                    break
+            # Known openings are played from the book, without searching
+            move = book.choose(pos) if book is not None else None
+            score = 0
+            if move is None:
+                for ply, move, score in searcher.search(pos, history):
+                    entry = searcher.entry(pos, ply)
+                    score = int(round((entry.lower + entry.upper)/2))
+                    if show_thinking:
+                        used = int((time.time() - start)*100 + .5)
+                        moves = tools.pv(searcher, pos, include_scores=False)
+                        print('{:>3} {:>8} {:>8} {:>13} \t{}'.format(
+                            ply, score, used, searcher.nodes, moves))
+                        print('# Hashfull: {:.3f}%; {} <= score < {}'.format(
+                            searcher.tp_score.hashfull()/10, entry.lower, entry.upper))
+                    # If found mate, just stop
+                    if entry.lower >= sunfish.MATE_UPPER:
+                        break
+                    if time.time() - start > use/100:
+                        break
             # We sometimes make illegal moves when we're losing,
             # so it's safer to just resign.
             if score == -sunfish.MATE_UPPER:
                 print('resign')
             else:
                 print('move', tools.mrender(pos, move))
+            if sunfish.irreversible(pos, move):
+                del history[:]
             pos = pos.move(move)
-            history.append(pos)
+            history.append(pos.hash)
             color = 1-color
 
         elif smove.startswith('ping'):
@@ -142,8 +164,10 @@ def main():
         elif smove.startswith('usermove'):
             _, smove = smove.split()
             m = tools.mparse(color, smove)
+            if sunfish.irreversible(pos, m):
+                del history[:]
             pos = pos.move(m)
-            history.append(pos)
+            history.append(pos.hash)
             color = 1-color
             if not forced:
                 stack.append('go')
@@ -156,8 +180,9 @@ def main():
 
         elif smove.startswith('perft'):
             start = time.time()
+            table = perft.PerftTable(perft.TABLE_MB)
             for d in range(1,10):
-                res = sum(1 for _ in tools.collect_tree_depth(tools.expand_position(pos), d))
+                res = perft.perft(pos, d, table)
                 print('{:>8} {:>8}'.format(res, time.time()-start))
 
         elif smove.startswith('post'):